@@ -1,5 +1,6 @@
 from fastapi import Header, HTTPException
 from sqlalchemy.orm import Session
+from .config import ADMIN_TOKEN
 from .db import SessionLocal, User
 
 def get_db():
@@ -30,3 +31,7 @@ def get_or_create_user(db: Session, user_id: str | None, plan_header: str | None
         user.plan = plan_header
         db.add(user); db.commit()
     return user
+
+def require_admin(x_admin_token: str | None = Header(default=None)):
+    if not ADMIN_TOKEN or x_admin_token != ADMIN_TOKEN:
+        raise HTTPException(403, "Yetkisiz")
@@ -0,0 +1,157 @@
+import csv
+import hashlib
+import io
+import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, Any, List, Iterator, Tuple
+from pydantic import ValidationError
+from .config import BATCH_CONCURRENCY, BATCH_MAX_ITEMS
+from .db import SessionLocal, BatchItemResult
+from .pipelines import GuardRejected, run_quiz, run_single_lab
+from . import scheduler
+from .quiz_cache import QUIZ_ENUMS, QUIZ_LIST_FIELDS
+from .schemas import QuizAnswers, LabTestResult, QuizResponse, LabAnalysisResponse
+
+class BatchError(ValueError):
+    """Malformed batch input; the message is returned to the client"""
+
+def _validate(raw: Dict[str, Any], line_no: int) -> Dict[str, Any]:
+    item_type = raw.get("type")
+    try:
+        if item_type == "quiz":
+            payload = QuizAnswers(**(raw.get("answers") or {})).model_dump()
+        elif item_type == "lab":
+            payload = LabTestResult(**(raw.get("test") or {})).model_dump()
+        else:
+            raise BatchError(f"Satır {line_no}: type 'quiz' veya 'lab' olmalı")
+    except ValidationError as e:
+        raise BatchError(f"Satır {line_no}: geçersiz veri ({e.errors()[0]['msg']})")
+    return {"id": str(raw.get("id") or line_no), "type": item_type, "payload": payload}
+
+def parse_ndjson(text: str) -> List[Dict[str, Any]]:
+    """One object per line: {"id", "type": "quiz", "answers": {...}} or {"id", "type": "lab", "test": {...}}"""
+    items = []
+    for line_no, line in enumerate(text.splitlines(), 1):
+        if not line.strip():
+            continue
+        try:
+            raw = json.loads(line)
+        except json.JSONDecodeError:
+            raise BatchError(f"Satır {line_no}: geçersiz JSON")
+        if not isinstance(raw, dict):
+            raise BatchError(f"Satır {line_no}: JSON nesnesi bekleniyor")
+        items.append(_validate(raw, line_no))
+    return items
+
+def parse_csv(text: str) -> List[Dict[str, Any]]:
+    """Header row with id,type and either lab columns (name,value,unit,reference_range)
+    or quiz columns (QuizAnswers fields; list fields separated by ';')"""
+    items = []
+    for line_no, row in enumerate(csv.DictReader(io.StringIO(text)), 2):
+        row = {k.strip(): (v or "").strip() for k, v in row.items() if k}
+        raw: Dict[str, Any] = {"id": row.get("id"), "type": row.get("type")}
+        if row.get("type") == "quiz":
+            answers: Dict[str, Any] = {f: row.get(f, "") for f in QUIZ_ENUMS}
+            for f in QUIZ_LIST_FIELDS:
+                answers[f] = [v.strip() for v in row.get(f, "").split(";") if v.strip()]
+            raw["answers"] = answers
+        else:
+            raw["test"] = {"name": row.get("name", ""), "value": row.get("value", ""), "unit": row.get("unit", ""),
+                           "reference_range": row.get("reference_range") or None}
+        items.append(_validate(raw, line_no))
+    return items
+
+def parse_items(body: bytes, content_type: str) -> List[Dict[str, Any]]:
+    try:
+        text = body.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        raise BatchError("Batch UTF-8 olarak kodlanmalı")
+    items = parse_csv(text) if "csv" in (content_type or "") else parse_ndjson(text)
+    if not items:
+        raise BatchError("Boş batch")
+    if len(items) > BATCH_MAX_ITEMS:
+        raise BatchError(f"En fazla {BATCH_MAX_ITEMS} öğe gönderilebilir")
+    return items
+
+def item_hash(item: Dict[str, Any]) -> str:
+    canonical = json.dumps(item["payload"], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(f"{item['type']}|{canonical}".encode("utf-8")).hexdigest()
+
+def batch_token(user_id: int, hashes: List[str]) -> str:
+    """Deterministic resume token: resending the same items resumes the same batch"""
+    digest = hashlib.sha256(f"{user_id}|{'|'.join(sorted(set(hashes)))}".encode("utf-8"))
+    return digest.hexdigest()[:32]
+
+def _run_item(token: str, user_id: int, h: str, item: Dict[str, Any]) -> Tuple[str, Dict[str, Any]]:
+    """Run one unique item and persist its result so a dropped connection doesn't redo it"""
+    sched_token = scheduler.set_class(scheduler.classify(None, "batch", origin="batch"))
+    db = SessionLocal()
+    try:
+        try:
+            if item["type"] == "quiz":
+                data = run_quiz(db, user_id, item["payload"])
+                response_model = QuizResponse
+            else:
+                data = run_single_lab(db, user_id, item["payload"])
+                response_model = LabAnalysisResponse
+            # Same shape the single-item endpoints return through their response_model
+            status, result = "ok", response_model.model_validate(data).model_dump()
+        except GuardRejected as e:
+            status, result = "error", {"detail": str(e)}
+        except Exception as e:
+            # Transient failures are not persisted so a resume retries them
+            print(f"Batch item {h[:12]} failed: {e}")
+            return "error", {"detail": "Analiz geçici olarak başarısız oldu"}
+        db.add(BatchItemResult(batch_id=token, user_id=user_id, item_hash=h, status=status, result=result))
+        db.commit()
+        return status, result
+    finally:
+        db.close()
+        scheduler.reset_class(sched_token)
+
+def _line(obj: Dict[str, Any]) -> str:
+    return json.dumps(obj, ensure_ascii=False) + "\n"
+
+def stream_batch(user_id: int, items: List[Dict[str, Any]], token: str | None = None) -> Iterator[str]:
+    """Yield NDJSON lines: a header with the resume token, one line per item as it completes
+    (identical items are computed once), then a summary line. Only the user's own results
+    are resumed, whatever token the client sends."""
+    ids_by_hash: Dict[str, List[str]] = {}
+    unique: Dict[str, Dict[str, Any]] = {}
+    for item in items:
+        h = item_hash(item)
+        ids_by_hash.setdefault(h, []).append(item["id"])
+        unique.setdefault(h, item)
+    token = token or batch_token(user_id, list(unique))
+
+    db = SessionLocal()
+    try:
+        finished = {row.item_hash: row for row in
+                    db.query(BatchItemResult).filter(BatchItemResult.batch_id == token,
+                                                     BatchItemResult.user_id == user_id,
+                                                     BatchItemResult.item_hash.in_(list(unique))).all()}
+    finally:
+        db.close()
+
+    yield _line({"batch_id": token, "total": len(items), "unique": len(unique), "resumed": len(finished)})
+    counts = {"ok": 0, "error": 0}
+    for h, row in finished.items():
+        counts[row.status] = counts.get(row.status, 0) + len(ids_by_hash[h])
+        for item_id in ids_by_hash[h]:
+            yield _line({"id": item_id, "status": row.status, "result": row.result, "resumed": True})
+
+    pending = [h for h in unique if h not in finished]
+    executor = ThreadPoolExecutor(max_workers=max(1, min(BATCH_CONCURRENCY, len(pending) or 1)))
+    try:
+        futures = {executor.submit(_run_item, token, user_id, h, unique[h]): h for h in pending}
+        for future in as_completed(futures):
+            h = futures[future]
+            status, result = future.result()
+            counts[status] = counts.get(status, 0) + len(ids_by_hash[h])
+            for item_id in ids_by_hash[h]:
+                yield _line({"id": item_id, "status": status, "result": result})
+    finally:
+        # On client disconnect the generator is closed: running items still finish and
+        # persist, queued ones are dropped and picked up again on resume
+        executor.shutdown(wait=False, cancel_futures=True)
+    yield _line({"done": True, "batch_id": token, "ok": counts.get("ok", 0), "error": counts.get("error", 0)})
@@ -0,0 +1,84 @@
+"""Submit a batch file to /ai/batch and write streamed results as NDJSON.
+
+Usage:
+    python -m backend.batch_cli items.ndjson --url http://localhost:8000 --user-id partner-1 --out results.ndjson
+    python -m backend.batch_cli items.csv --out results.ndjson
+
+Dropped connections are retried with the resume token; items already written to --out are skipped.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import httpx
+
+def _read_done(path: str) -> set[str]:
+    done = set()
+    if path and os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    obj = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if "id" in obj:
+                    done.add(obj["id"])
+    return done
+
+def main():
+    parser = argparse.ArgumentParser(description="Longopass batch analysis client")
+    parser.add_argument("file", help="NDJSON or CSV input")
+    parser.add_argument("--url", default=os.getenv("LONGOPASS_AI_BASE", "http://localhost:8000"))
+    parser.add_argument("--user-id", default=None)
+    parser.add_argument("--plan", default="premium")
+    parser.add_argument("--out", default=None, help="results file (default: stdout)")
+    parser.add_argument("--retries", type=int, default=5)
+    args = parser.parse_args()
+
+    with open(args.file, "rb") as f:
+        body = f.read()
+    content_type = "text/csv" if args.file.lower().endswith(".csv") else "application/x-ndjson"
+    headers = {"Content-Type": content_type, "X-User-Plan": args.plan}
+    if args.user_id:
+        headers["X-User-Id"] = args.user_id
+
+    done = _read_done(args.out)
+    out = open(args.out, "a", encoding="utf-8") if args.out else sys.stdout
+    token = None
+    try:
+        for attempt in range(args.retries + 1):
+            if token:
+                headers["X-Batch-Resume"] = token
+            try:
+                with httpx.stream("POST", f"{args.url}/ai/batch", content=body, headers=headers, timeout=None) as r:
+                    if r.status_code != 200:
+                        r.read()
+                        print(f"Batch rejected ({r.status_code}): {r.text}", file=sys.stderr)
+                        sys.exit(1)
+                    for line in r.iter_lines():
+                        if not line.strip():
+                            continue
+                        obj = json.loads(line)
+                        if "batch_id" in obj and "total" in obj:
+                            token = obj["batch_id"]
+                            print(f"batch {token}: {obj['total']} items, {obj['unique']} unique, {obj['resumed']} resumed", file=sys.stderr)
+                        elif obj.get("done"):
+                            print(f"done: {obj['ok']} ok, {obj['error']} error", file=sys.stderr)
+                            return
+                        elif obj.get("id") not in done:
+                            done.add(obj["id"])
+                            out.write(json.dumps(obj, ensure_ascii=False) + "\n")
+                            out.flush()
+            except (httpx.TransportError, httpx.RemoteProtocolError) as e:
+                wait = min(2 ** attempt, 30)
+                print(f"Connection dropped ({e}), resuming in {wait}s", file=sys.stderr)
+                time.sleep(wait)
+        print("Giving up after retries", file=sys.stderr)
+        sys.exit(1)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+if __name__ == "__main__":
+    main()
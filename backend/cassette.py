@@ -0,0 +1,106 @@
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import deque, Counter
+from typing import List, Dict, Any
+from .config import OPENROUTER_CASSETTE_PATH
+
+# Cassette format: gzip'd JSON lines, one upstream call per line. Request bodies are stored
+# only as hashes; the provider response body is stored verbatim so replay returns the same
+# content and usage.
+
+class CassetteMiss(Exception):
+    """No recorded response for this request in replay mode"""
+
+_lock = threading.Lock()
+_entries: Dict[str, deque] | None = None
+_by_messages: Dict[str, deque] = {}
+_by_model: Dict[str, deque] = {}
+_stats: Counter = Counter()
+
+def messages_hash(messages: List[Dict[str, Any]]) -> str:
+    return hashlib.sha256(json.dumps(messages, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+def request_key(model: str, messages: List[Dict[str, Any]], temperature: float, max_tokens: int) -> str:
+    return hashlib.sha256(f"{model}|{temperature}|{max_tokens}|{messages_hash(messages)}".encode("utf-8")).hexdigest()
+
+def record(model: str, messages: List[Dict[str, Any]], temperature: float, max_tokens: int,
+           latency_ms: int, body: Dict[str, Any] | None, error: str | None = None):
+    entry = {
+        "key": request_key(model, messages, temperature, max_tokens),
+        "model": model,
+        "messages_hash": messages_hash(messages),
+        "latency_ms": latency_ms,
+        "ts": time.time(),
+    }
+    if error is not None:
+        entry["error"] = error
+    else:
+        entry["body"] = body
+    line = (json.dumps(entry, ensure_ascii=False) + "\n").encode("utf-8")
+    usage = (body or {}).get("usage") or {}
+    with _lock:
+        _stats["calls"] += 1
+        _stats["prompt_tokens"] += usage.get("prompt_tokens", 0)
+        _stats["completion_tokens"] += usage.get("completion_tokens", 0)
+        os.makedirs(os.path.dirname(OPENROUTER_CASSETTE_PATH) or ".", exist_ok=True)
+        # Each append is its own gzip member; gzip.open reads them back as one stream
+        with gzip.open(OPENROUTER_CASSETTE_PATH, "ab") as f:
+            f.write(line)
+
+def _load():
+    global _entries
+    entries: Dict[str, deque] = {}
+    if os.path.exists(OPENROUTER_CASSETTE_PATH):
+        with gzip.open(OPENROUTER_CASSETTE_PATH, "rt", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                e = json.loads(line)
+                entries.setdefault(e["key"], deque()).append(e)
+                _by_messages.setdefault(f"{e['model']}|{e['messages_hash']}", deque()).append(e)
+                _by_model.setdefault(e["model"], deque()).append(e)
+    _entries = entries
+
+def _take(queue: deque) -> Dict[str, Any]:
+    # Round-robin so repeated identical requests replay their recorded sequence
+    e = queue.popleft()
+    queue.append(e)
+    return e
+
+def replay(model: str, messages: List[Dict[str, Any]], temperature: float, max_tokens: int) -> Dict[str, Any]:
+    """Serve the recorded response with its original latency. Exact request match first, then
+    same model+messages (different sampling params), then any response of the same model so
+    changed orchestration strategies can still be replayed."""
+    with _lock:
+        if _entries is None:
+            _load()
+        queue = (_entries.get(request_key(model, messages, temperature, max_tokens))
+                 or _by_messages.get(f"{model}|{messages_hash(messages)}"))
+        match = "exact"
+        if not queue:
+            queue = _by_model.get(model)
+            match = "model"
+        if not queue:
+            _stats["misses"] += 1
+            raise CassetteMiss(f"No recorded response for {model}")
+        e = _take(queue)
+        _stats["calls"] += 1
+        _stats[f"match:{match}"] += 1
+        usage = (e.get("body") or {}).get("usage") or {}
+        _stats["prompt_tokens"] += usage.get("prompt_tokens", 0)
+        _stats["completion_tokens"] += usage.get("completion_tokens", 0)
+    time.sleep(e["latency_ms"] / 1000)
+    if "error" in e:
+        raise RuntimeError(f"Replayed upstream error: {e['error']}")
+    return e
+
+def stats(reset: bool = False) -> Dict[str, int]:
+    with _lock:
+        out = dict(_stats)
+        if reset:
+            _stats.clear()
+    return out
@@ -1,3 +1,4 @@
+import json
 import os
 from dotenv import load_dotenv
 
@@ -33,6 +34,7 @@ PARALLEL_TIMEOUT_MS = int(os.getenv("PARALLEL_TIMEOUT_MS", "8000"))
 CASCADE_TIMEOUT_MS = PARALLEL_TIMEOUT_MS
 CASCADE_MIN_CHARS = int(os.getenv("CASCADE_MIN_CHARS", "200"))
 CHAT_HISTORY_MAX = int(os.getenv("CHAT_HISTORY_MAX", "20"))
+CHAT_HISTORY_PAGE_MAX = int(os.getenv("CHAT_HISTORY_PAGE_MAX", "200"))  # upper bound for ?limit= on history
 FREE_ANALYZE_LIMIT = int(os.getenv("FREE_ANALYZE_LIMIT", "1"))
 
 HEALTH_MODE = os.getenv("HEALTH_MODE", "topic")
@@ -48,3 +50,135 @@ DAILY_CHAT_LIMIT = int(os.getenv("DAILY_CHAT_LIMIT", "100"))
 # Health moderation via LLM (stable, fast model for topic classification)
 MODERATION_MODEL = os.getenv("MODERATION_MODEL", "google/gemini-2.5-flash")
 MODERATION_TIMEOUT_MS = int(os.getenv("MODERATION_TIMEOUT_MS", "3000"))
+
+# Map-reduce lab summaries (large test panels are split into panel groups)
+LAB_CHUNK_MIN_TESTS = int(os.getenv("LAB_CHUNK_MIN_TESTS", "12"))
+LAB_GROUP_MAX_TESTS = int(os.getenv("LAB_GROUP_MAX_TESTS", "10"))
+LAB_MAP_MODEL = os.getenv("LAB_MAP_MODEL", "openai/gpt-4o-mini")
+
+# Local lab reference-range engine
+LAB_TEMPLATE_NORMAL = os.getenv("LAB_TEMPLATE_NORMAL", "true").lower() == "true"
+LAB_CACHE_TTL_S = int(os.getenv("LAB_CACHE_TTL_S", "86400"))
+
+# Precomputed quiz recommendations for common answer profiles
+QUIZ_CACHE_TTL_DAYS = int(os.getenv("QUIZ_CACHE_TTL_DAYS", "30"))
+QUIZ_PRECOMPUTE_WORKERS = int(os.getenv("QUIZ_PRECOMPUTE_WORKERS", "2"))
+QUIZ_PRECOMPUTE_RPS = float(os.getenv("QUIZ_PRECOMPUTE_RPS", "0.5"))
+
+# Bulk/batch analysis API
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "4"))
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "1000"))
+
+# Record/replay of upstream calls: off | record | replay
+OPENROUTER_CASSETTE_MODE = os.getenv("OPENROUTER_CASSETTE_MODE", "off").lower()
+OPENROUTER_CASSETTE_PATH = os.getenv("OPENROUTER_CASSETTE_PATH", "./cassettes/openrouter.jsonl.gz")
+
+# Background retention/compaction (honors RETENTION_DAYS and LOG_PROVIDER_RAW)
+MAINTENANCE_INTERVAL_S = int(os.getenv("MAINTENANCE_INTERVAL_S", "3600"))
+MAINTENANCE_BATCH_SIZE = int(os.getenv("MAINTENANCE_BATCH_SIZE", "500"))
+MAINTENANCE_VACUUM_PAGES = int(os.getenv("MAINTENANCE_VACUUM_PAGES", "2000"))
+MAINTENANCE_ARCHIVE_DIR = os.getenv("MAINTENANCE_ARCHIVE_DIR", "")  # empty: purge without archiving
+
+# Admin/debug endpoints (raw payloads, profiling); empty token disables them
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
+# In-memory recent turns of active conversations (per worker, LRU)
+CONVERSATION_CACHE_SIZE = int(os.getenv("CONVERSATION_CACHE_SIZE", "1000"))
+
+# Request routing: fast (one model), dual (two models + synthesis) or full (all PARALLEL_MODELS +
+# synthesis + finalize). "validate": false accepts any non-empty chat reply instead of requiring
+# CASCADE_MIN_CHARS and a health topic (small talk). ROUTE_PROFILES (JSON) overrides fields per profile, e.g.
+# {"dual": {"models": ["openai/gpt-4o", "google/gemini-2.5-flash"]}}
+ROUTING_ENABLED = os.getenv("ROUTING_ENABLED", "true").lower() == "true"
+ROUTE_FAST_MODEL = os.getenv("ROUTE_FAST_MODEL", "openai/gpt-4o-mini")
+ROUTE_SHORT_CHARS = int(os.getenv("ROUTE_SHORT_CHARS", "40"))
+ROUTE_LONG_CHARS = int(os.getenv("ROUTE_LONG_CHARS", "300"))
+ROUTE_PROFILES = {
+    "fast": {"models": [ROUTE_FAST_MODEL], "synthesis": False, "finalize": False, "validate": False},
+    "dual": {"models": PARALLEL_MODELS[:2], "synthesis": True, "finalize": False},
+    "full": {"models": PARALLEL_MODELS, "synthesis": True, "finalize": True},
+}
+for _name, _override in json.loads(os.getenv("ROUTE_PROFILES", "{}")).items():
+    ROUTE_PROFILES.setdefault(_name, dict(ROUTE_PROFILES["full"])).update(_override)
+
+# Near-duplicate cache for context-free first chat turns
+FAQ_CACHE_ENABLED = os.getenv("FAQ_CACHE_ENABLED", "true").lower() == "true"
+FAQ_SIMILARITY_THRESHOLD = float(os.getenv("FAQ_SIMILARITY_THRESHOLD", "0.8"))
+FAQ_TTL_DAYS = int(os.getenv("FAQ_TTL_DAYS", "14"))
+FAQ_MAX_ENTRIES = int(os.getenv("FAQ_MAX_ENTRIES", "5000"))
+FAQ_MIN_CHARS = int(os.getenv("FAQ_MIN_CHARS", "12"))
+
+# Provider prompt caching: explicit cache_control breakpoints on the system prefix for model
+# families that need them (OpenAI, DeepSeek and Grok cache matching prefixes automatically)
+PROMPT_CACHE_ENABLED = os.getenv("PROMPT_CACHE_ENABLED", "true").lower() == "true"
+PROMPT_CACHE_MODELS = [m.strip() for m in os.getenv("PROMPT_CACHE_MODELS", "anthropic/,google/gemini").split(",") if m.strip()]
+
+# Idempotency-Key support on the expensive POST endpoints
+IDEMPOTENCY_TTL_S = int(os.getenv("IDEMPOTENCY_TTL_S", "86400"))  # how long results are replayed
+IDEMPOTENCY_WAIT_S = int(os.getenv("IDEMPOTENCY_WAIT_S", "120"))  # a retry waits this long for the original run
+IDEMPOTENCY_STALE_S = int(os.getenv("IDEMPOTENCY_STALE_S", "600"))  # in-progress keys older than this are taken over
+
+# Opt-in profiling (admin endpoints under /admin/profile)
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))  # fraction of requests profiled
+PROFILE_INTERVAL_MS = int(os.getenv("PROFILE_INTERVAL_MS", "5"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "./profiles")
+
+# Micro-batched moderation: classification requests arriving within the window share one call
+MODERATION_BATCH_ENABLED = os.getenv("MODERATION_BATCH_ENABLED", "true").lower() == "true"
+MODERATION_BATCH_WINDOW_MS = int(os.getenv("MODERATION_BATCH_WINDOW_MS", "10"))
+MODERATION_BATCH_MAX = int(os.getenv("MODERATION_BATCH_MAX", "16"))
+
+# Request deadlines: total time budget per request (ms); a client's X-Request-Deadline-Ms can only
+# shorten it. REQUEST_DEADLINE_PATHS overrides it per path, 0 = no deadline (streamed batches)
+REQUEST_DEADLINE_MS = int(os.getenv("REQUEST_DEADLINE_MS", "25000"))
+REQUEST_DEADLINE_PATHS = json.loads(os.getenv("REQUEST_DEADLINE_PATHS", '{"/ai/batch": 0}'))
+DEADLINE_MIN_CALL_MS = int(os.getenv("DEADLINE_MIN_CALL_MS", "500"))  # don't start an upstream call with less left
+SYNTHESIS_MIN_BUDGET_MS = int(os.getenv("SYNTHESIS_MIN_BUDGET_MS", "4000"))  # below this, skip synthesis/finalize
+
+# Adaptive max_tokens: once TOKEN_BUDGET_MIN_SAMPLES completions of a stage/model are seen, its
+# budget is their p{TOKEN_BUDGET_PERCENTILE} * TOKEN_BUDGET_HEADROOM, at most TOKEN_BUDGET_MAX_FACTOR
+# times the call site's static max_tokens
+TOKEN_BUDGET_ENABLED = os.getenv("TOKEN_BUDGET_ENABLED", "true").lower() == "true"
+TOKEN_BUDGET_PERCENTILE = float(os.getenv("TOKEN_BUDGET_PERCENTILE", "95"))
+TOKEN_BUDGET_HEADROOM = float(os.getenv("TOKEN_BUDGET_HEADROOM", "1.2"))
+TOKEN_BUDGET_MIN_SAMPLES = int(os.getenv("TOKEN_BUDGET_MIN_SAMPLES", "20"))
+TOKEN_BUDGET_WINDOW = int(os.getenv("TOKEN_BUDGET_WINDOW", "500"))
+TOKEN_BUDGET_MAX_FACTOR = float(os.getenv("TOKEN_BUDGET_MAX_FACTOR", "2.0"))
+TOKEN_BUDGET_EXPLORE_RATE = float(os.getenv("TOKEN_BUDGET_EXPLORE_RATE", "0.1"))  # chat calls left without a length hint
+
+# Upstream pool: OPENROUTER_UPSTREAMS is a JSON list of {"name", "base_url", "api_key", "weight", "models", "openrouter"};
+# without it, one upstream per key in OPENROUTER_API_KEYS (comma separated) on OPENROUTER_BASE_URL
+OPENROUTER_API_KEYS = [k.strip() for k in os.getenv("OPENROUTER_API_KEYS", "").split(",") if k.strip()]
+OPENROUTER_UPSTREAMS = json.loads(os.getenv("OPENROUTER_UPSTREAMS", "[]"))
+UPSTREAM_COOLDOWN_S = float(os.getenv("UPSTREAM_COOLDOWN_S", "5"))  # after a 429 without Retry-After
+UPSTREAM_MAX_CONNECTIONS = int(os.getenv("UPSTREAM_MAX_CONNECTIONS", "50"))  # per upstream
+
+# Scheduler: at most SCHED_UPSTREAM_SLOTS concurrent upstream calls (0 = unlimited), shared between
+# priority classes by weight; a class with queue_limit calls waiting gets 503s
+SCHED_UPSTREAM_SLOTS = int(os.getenv("SCHED_UPSTREAM_SLOTS", "32"))
+SCHED_CLASSES = {
+    "premium_chat": {"weight": 8, "queue_limit": 64},
+    "premium": {"weight": 4, "queue_limit": 64},
+    "free": {"weight": 2, "queue_limit": 32},
+    "batch": {"weight": 1, "queue_limit": 128},
+}
+SCHED_CLASSES.update(json.loads(os.getenv("SCHED_CLASSES", "{}")))
+SCHED_DEFAULT_CLASS = os.getenv("SCHED_DEFAULT_CLASS", "premium")  # calls outside a request (moderation batches)
+SCHED_MAX_WAIT_S = float(os.getenv("SCHED_MAX_WAIT_S", "30"))  # slot wait without a request deadline
+CANCEL_ON_DISCONNECT = os.getenv("CANCEL_ON_DISCONNECT", "true").lower() == "true"  # stop upstream work for clients that left
+
+# Startup and probes: /readyz fails until warmup is done, while the database is unreachable, or
+# while every upstream has failed UPSTREAM_UNHEALTHY_AFTER calls in a row (0 = never unhealthy)
+WARMUP_ENABLED = os.getenv("WARMUP_ENABLED", "true").lower() == "true"
+WARMUP_TIMEOUT_S = float(os.getenv("WARMUP_TIMEOUT_S", "5"))  # per upstream connection
+UPSTREAM_UNHEALTHY_AFTER = int(os.getenv("UPSTREAM_UNHEALTHY_AFTER", "5"))
+
+# Multi-worker mode (python -m backend.serve): WEB_WORKERS processes, 0 = one per available CPU;
+# the supervisor passes the resolved count to its workers. State shared between workers
+# (moderation/lab caches, upstream cooldowns, conversation cache versions, the maintenance lease)
+# goes through SHARED_STATE_BACKEND: "local" (in-process), "sqlite" (WAL file at SHARED_STATE_PATH,
+# default next to DB_PATH) or "auto" (sqlite with more than one worker)
+WEB_WORKERS = int(os.getenv("WEB_WORKERS", "0"))
+WEB_GRACEFUL_TIMEOUT_S = int(os.getenv("WEB_GRACEFUL_TIMEOUT_S", "30"))  # in-flight requests on reload/stop
+SHARED_STATE_BACKEND = os.getenv("SHARED_STATE_BACKEND", "auto")
+SHARED_STATE_PATH = os.getenv("SHARED_STATE_PATH", "")
@@ -0,0 +1,95 @@
+"""Per-worker cache of each conversation's recent turns.
+
+Every stored message bumps the conversation's version in the shared state. A worker only
+appends to (or serves) its cached turns while their version is current, so with several
+workers a message written by another worker makes the next read reload from the database.
+"""
+import threading
+from collections import OrderedDict, deque
+from typing import Dict, List
+from sqlalchemy.orm import Session
+from .config import CHAT_HISTORY_MAX, CONVERSATION_CACHE_SIZE
+from .db import Message
+from .shared_state import get_state
+
+# Versions only need to outlive the cached entries they guard
+VERSION_TTL_S = 7 * 86400
+
+# conversation id -> last CHAT_HISTORY_MAX turns, least recently used first
+_cache: "OrderedDict[int, deque]" = OrderedDict()
+# conversation id -> shared version the cached turns reflect
+_versions: Dict[int, int] = {}
+# conversation id -> written to while its turns were being loaded from the DB
+_loading: Dict[int, bool] = {}
+# conversation id -> messages being stored and not yet versioned
+_writing: Dict[int, int] = {}
+_lock = threading.Lock()
+
+def add_message(db: Session, conversation_id: int, role: str, content: str, **fields) -> Message:
+    """Persist a chat message and append it to the cached turns of its conversation"""
+    m = Message(conversation_id=conversation_id, role=role, content=content, **fields)
+    with _lock:
+        # Loads overlapping the commit may or may not see m; none of them may be cached
+        _writing[conversation_id] = _writing.get(conversation_id, 0) + 1
+        if conversation_id in _loading:
+            _loading[conversation_id] = True
+    version = None
+    try:
+        db.add(m); db.commit()
+        version = get_state().incr("conversation", str(conversation_id), VERSION_TTL_S)
+    finally:
+        with _lock:
+            pending = _writing.pop(conversation_id) - 1
+            if pending:
+                _writing[conversation_id] = pending
+            turns = _cache.get(conversation_id)
+            if turns is not None and version is not None and not pending \
+                    and _versions.get(conversation_id) == version - 1:
+                turns.append({"role": role, "content": content})
+                _versions[conversation_id] = version
+                _cache.move_to_end(conversation_id)
+            elif turns is not None:
+                # Another write landed in between; reload on the next read
+                _cache.pop(conversation_id, None)
+                _versions.pop(conversation_id, None)
+            if conversation_id in _loading:
+                _loading[conversation_id] = True
+    return m
+
+def _load(db: Session, conversation_id: int) -> deque:
+    rows = (db.query(Message.role, Message.content)
+              .filter(Message.conversation_id==conversation_id)
+              .order_by(Message.id.desc()).limit(CHAT_HISTORY_MAX).all())
+    return deque(({"role": r.role, "content": r.content} for r in reversed(rows)), maxlen=CHAT_HISTORY_MAX)
+
+def recent_turns(db: Session, conversation_id: int, n: int = CHAT_HISTORY_MAX) -> List[Dict[str, str]]:
+    """Last n turns, oldest first. Falls back to the DB on a miss (cold conversation, restart)."""
+    version = int(get_state().get("conversation", str(conversation_id)) or 0)
+    with _lock:
+        turns = _cache.get(conversation_id)
+        if turns is not None and _versions.get(conversation_id) == version:
+            _cache.move_to_end(conversation_id)
+            return list(turns)[-n:]
+        _loading[conversation_id] = False
+
+    turns = _load(db, conversation_id)
+    with _lock:
+        # A write that landed during the load may be missing from the snapshot; serve it but don't cache it
+        stale = _loading.pop(conversation_id, True) or conversation_id in _writing
+        if not stale and _versions.get(conversation_id) != version:
+            _cache[conversation_id] = turns
+            _versions[conversation_id] = version
+            _cache.move_to_end(conversation_id)
+            while len(_cache) > CONVERSATION_CACHE_SIZE:
+                evicted, _ = _cache.popitem(last=False)
+                _versions.pop(evicted, None)
+    return list(turns)[-n:]
+
+def evict(conversation_id: int):
+    with _lock:
+        _cache.pop(conversation_id, None)
+        _versions.pop(conversation_id, None)
+
+def stats() -> Dict[str, int]:
+    with _lock:
+        return {"conversations": len(_cache), "capacity": CONVERSATION_CACHE_SIZE}
@@ -1,13 +1,27 @@
-from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime, Enum, ForeignKey, Boolean, JSON
-from sqlalchemy.orm import sessionmaker, declarative_base, relationship
+from sqlalchemy import create_engine, event, text, Column, Integer, String, Text, DateTime, Enum, ForeignKey, Boolean, JSON, LargeBinary
+from sqlalchemy.orm import sessionmaker, declarative_base, relationship, deferred
 import datetime
+import json
 import os
+import zlib
 
 # Allow overriding DB path via environment variable for container persistence
 DB_PATH = os.getenv("DB_PATH", "./app.db")
 DATABASE_URL = f"sqlite:///{DB_PATH}"
+# WAL lets readers (and the other workers) proceed while one connection writes
+SQLITE_WAL = os.getenv("SQLITE_WAL", "true").lower() == "true"
 
 engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+
+@event.listens_for(engine, "connect")
+def _sqlite_pragmas(dbapi_conn, _record):
+    # Only takes effect on a fresh database (or after VACUUM); lets maintenance reclaim pages incrementally
+    cur = dbapi_conn.cursor()
+    cur.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    if SQLITE_WAL:
+        cur.execute("PRAGMA journal_mode=WAL")
+        cur.execute("PRAGMA synchronous=NORMAL")
+    cur.close()
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
@@ -43,7 +57,8 @@ class Message(Base):
     tokens_in = Column(Integer, nullable=True)
     tokens_out = Column(Integer, nullable=True)
     cost_usd = Column(String, nullable=True)
-    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    route_profile = Column(String, nullable=True)  # routing.profile label, e.g. "dual" or "full:online"
+    created_at = Column(DateTime, default=datetime.datetime.utcnow, index=True)
 
     conversation = relationship("Conversation", back_populates="messages")
     metas = relationship("MessageMeta", back_populates="message")
@@ -51,9 +66,100 @@ class Message(Base):
 class MessageMeta(Base):
     __tablename__ = "message_meta"
     id = Column(Integer, primary_key=True, index=True)
-    message_id = Column(Integer, ForeignKey("messages.id"))
-    raw_provider_payload = Column(JSON, nullable=True)
+    message_id = Column(Integer, ForeignKey("messages.id"), index=True)
+    # Legacy uncompressed payloads; new rows use raw_provider_blob. Both load only on access.
+    raw_provider_payload = deferred(Column(JSON, nullable=True))
+    raw_provider_blob = deferred(Column(LargeBinary, nullable=True))  # zlib-compressed JSON
     raw_provider_name = Column(String, nullable=True)
-    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow, index=True)
 
     message = relationship("Message", back_populates="metas")
+
+    @property
+    def payload(self):
+        if self.raw_provider_blob is not None:
+            return unpack_payload(self.raw_provider_blob)
+        return self.raw_provider_payload
+
+def pack_payload(obj) -> bytes | None:
+    if obj is None:
+        return None
+    return zlib.compress(json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8"), 6)
+
+def unpack_payload(blob: bytes | None):
+    if blob is None:
+        return None
+    return json.loads(zlib.decompress(blob).decode("utf-8"))
+
+class LabResult(Base):
+    __tablename__ = "lab_results"
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, index=True)
+    test_key = Column(String, index=True)  # normalized test name
+    name = Column(String)
+    value = Column(String)
+    unit = Column(String, nullable=True)
+    reference_range = Column(String, nullable=True)
+    interpretation = Column(JSON, nullable=True)  # per-test detail from the summary
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+class QuizProfile(Base):
+    __tablename__ = "quiz_profiles"
+    id = Column(Integer, primary_key=True, index=True)
+    profile_key = Column(String, unique=True, index=True)
+    answers = Column(JSON)
+    hits = Column(Integer, default=0)
+    content = Column(Text, nullable=True)  # precomputed quiz JSON
+    generated_at = Column(DateTime, nullable=True)
+    last_seen_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+class BatchItemResult(Base):
+    __tablename__ = "batch_item_results"
+    id = Column(Integer, primary_key=True, index=True)
+    batch_id = Column(String, index=True)  # resume token
+    user_id = Column(Integer, index=True)  # a resume token only ever matches its owner's results
+    item_hash = Column(String, index=True)
+    status = Column(String)  # ok/error
+    result = Column(JSON, nullable=True)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+class IdempotencyKey(Base):
+    __tablename__ = "idempotency_keys"
+    id = Column(Integer, primary_key=True, index=True)
+    scope_key = Column(String, unique=True, index=True)  # user|endpoint|Idempotency-Key
+    request_hash = Column(String)
+    status = Column(String, default="in_progress")  # in_progress/done
+    status_code = Column(Integer, nullable=True)
+    response = Column(JSON, nullable=True)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow, index=True)
+
+# create_all() does not touch existing tables, so indexes added later are created here
+_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS ix_messages_created_at ON messages (created_at)",
+    "CREATE INDEX IF NOT EXISTS ix_messages_conversation_id_id ON messages (conversation_id, id)",
+    "CREATE INDEX IF NOT EXISTS ix_message_meta_created_at ON message_meta (created_at)",
+    "CREATE INDEX IF NOT EXISTS ix_message_meta_message_id ON message_meta (message_id)",
+    "CREATE INDEX IF NOT EXISTS ix_lab_results_user_id_test_key ON lab_results (user_id, test_key, id)",
+    "CREATE INDEX IF NOT EXISTS ix_batch_item_results_user_id ON batch_item_results (user_id)",
+]
+
+# Columns added after the first release: (table, column, SQLite type)
+_COLUMNS = [
+    ("message_meta", "raw_provider_blob", "BLOB"),
+    ("messages", "route_profile", "VARCHAR"),
+    ("batch_item_results", "user_id", "INTEGER"),
+]
+
+def ensure_schema():
+    with engine.begin() as conn:
+        for table, column, col_type in _COLUMNS:
+            existing = {row[1] for row in conn.execute(text(f"PRAGMA table_info({table})"))}
+            if column not in existing:
+                conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {col_type}"))
+        for stmt in _INDEXES:
+            conn.execute(text(stmt))
+
+def init_db():
+    """Create missing tables, columns and indexes; run once at startup, not on import"""
+    Base.metadata.create_all(bind=engine)
+    ensure_schema()
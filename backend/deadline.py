@@ -0,0 +1,177 @@
+"""Request-scoped time budget.
+
+DeadlineMiddleware gives every HTTP request a Deadline: REQUEST_DEADLINE_MS, or the path's entry
+in REQUEST_DEADLINE_PATHS, shortened by the client's X-Request-Deadline-Ms header (the time it is
+still willing to wait). The deadline lives in a contextvar, so it follows the request into the
+endpoint thread; worker pools must start tasks through submit() to carry it along.
+
+call_chat_model() caps each upstream timeout at the remaining budget and refuses to start a call
+with less than DEADLINE_MIN_CALL_MS left, so fallbacks run out quickly instead of overrunning.
+Optional stages (synthesis, finalize, lab reduce) check can_afford() first and are skipped with
+less than SYNTHESIS_MIN_BUDGET_MS left; the caller then returns its best single response.
+
+With CANCEL_ON_DISCONNECT the middleware also buffers the request body and watches the
+connection; when the client goes away the deadline is cancelled, which leaves no budget: no
+further upstream call, slot wait or optional stage starts, and fan-outs stop waiting for calls
+already in flight (see cancelled()). Requests with an Idempotency-Key are never cancelled, a
+retry will pick up their stored result.
+"""
+import asyncio
+import contextvars
+import threading
+import time
+from collections import Counter
+from typing import Dict, Optional
+from .config import (REQUEST_DEADLINE_MS, REQUEST_DEADLINE_PATHS, DEADLINE_MIN_CALL_MS, SYNTHESIS_MIN_BUDGET_MS,
+                     CANCEL_ON_DISCONNECT)
+
+HEADER = b"x-request-deadline-ms"
+IDEMPOTENCY_HEADER = b"idempotency-key"
+
+class DeadlineExceeded(TimeoutError):
+    """Not enough of the request's budget left to start an upstream call"""
+
+class RequestCancelled(DeadlineExceeded):
+    """The client disconnected; nobody will read the result"""
+
+class Deadline:
+    def __init__(self, budget_ms: int):
+        self.budget_ms = budget_ms
+        self.expires_at = time.monotonic() + budget_ms / 1000
+        self.cancelled = threading.Event()
+
+    def remaining_s(self) -> float:
+        if self.cancelled.is_set():
+            return 0.0
+        return self.expires_at - time.monotonic()
+
+    def cancel(self):
+        self.cancelled.set()
+
+_current: contextvars.ContextVar[Optional[Deadline]] = contextvars.ContextVar("deadline", default=None)
+_skipped: Counter = Counter()
+_cancel_stats: Counter = Counter()
+_skipped_lock = threading.Lock()
+
+def current() -> Optional[Deadline]:
+    return _current.get()
+
+def cancelled() -> bool:
+    d = _current.get()
+    return d is not None and d.cancelled.is_set()
+
+def record_saved(key: str, n: int = 1):
+    with _skipped_lock:
+        _cancel_stats[key] += n
+
+def start(budget_ms: int) -> contextvars.Token:
+    return _current.set(Deadline(budget_ms))
+
+def timeout_for(cap_s: float) -> float:
+    """Upstream timeout for a call that would normally get cap_s seconds"""
+    d = _current.get()
+    if d is None:
+        return cap_s
+    if d.cancelled.is_set():
+        record_saved("upstream_calls_saved")
+        raise RequestCancelled("client disconnected")
+    remaining = d.remaining_s()
+    if remaining * 1000 < DEADLINE_MIN_CALL_MS:
+        raise DeadlineExceeded(f"{int(remaining * 1000)} ms of {d.budget_ms} ms budget left")
+    return min(cap_s, remaining)
+
+def can_afford(stage: str, min_ms: int = SYNTHESIS_MIN_BUDGET_MS) -> bool:
+    """Whether an optional stage still fits; skipped stages are counted per name"""
+    d = _current.get()
+    if d is None or d.remaining_s() * 1000 >= min_ms:
+        return True
+    if d.cancelled.is_set():
+        record_saved("upstream_calls_saved")
+        return False
+    with _skipped_lock:
+        _skipped[stage] += 1
+    print(f"Deadline: skipping {stage}, {int(d.remaining_s() * 1000)} ms left of {d.budget_ms} ms")
+    return False
+
+def submit(executor, fn, *args, **kwargs):
+    """executor.submit() that runs fn under a copy of the caller's context (and deadline)"""
+    return executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+def stats() -> Dict[str, Dict[str, int]]:
+    with _skipped_lock:
+        return {"skipped_stages": dict(_skipped), "cancellation": dict(_cancel_stats)}
+
+def _budget_ms(scope) -> int:
+    budget = REQUEST_DEADLINE_PATHS.get(scope["path"], REQUEST_DEADLINE_MS)
+    for name, value in scope.get("headers", []):
+        if name == HEADER:
+            try:
+                client_ms = int(value)
+            except ValueError:
+                break
+            if client_ms > 0:
+                budget = min(budget, client_ms) if budget else client_ms
+            break
+    return budget
+
+class DeadlineMiddleware:
+    """Pure ASGI middleware; a budget of 0 means no deadline for that path"""
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        budget = _budget_ms(scope)
+        if not budget:
+            return await self.app(scope, receive, send)
+        token = start(budget)
+        watcher = None
+        try:
+            if CANCEL_ON_DISCONNECT and scope["method"] == "POST" and \
+                    not any(name == IDEMPOTENCY_HEADER for name, _ in scope.get("headers", [])):
+                receive, send, watcher = await self._watch(_current.get(), receive, send)
+            await self.app(scope, receive, send)
+        finally:
+            if watcher is not None:
+                watcher.cancel()
+            _current.reset(token)
+
+    async def _watch(self, d: Deadline, receive, send):
+        """Buffer the body, then cancel d if the client disconnects before the response is sent"""
+        buffered = []
+        while True:
+            message = await receive()
+            buffered.append(message)
+            if message["type"] != "http.request" or not message.get("more_body"):
+                break
+        disconnected = asyncio.Event()
+        responded = False
+
+        async def watch():
+            while True:
+                message = await receive()
+                if message["type"] == "http.disconnect":
+                    if not responded:
+                        d.cancel()
+                        record_saved("disconnects")
+                    disconnected.set()
+                    return
+
+        async def replay():
+            if buffered:
+                return buffered.pop(0)
+            await disconnected.wait()
+            return {"type": "http.disconnect"}
+
+        async def tracked_send(message):
+            nonlocal responded
+            if message["type"] == "http.response.body" and not message.get("more_body"):
+                responded = True
+            await send(message)
+
+        if buffered[-1]["type"] == "http.disconnect":
+            d.cancel()
+            record_saved("disconnects")
+            return replay, tracked_send, None
+        return replay, tracked_send, asyncio.create_task(watch())
@@ -0,0 +1,213 @@
+"""Near-duplicate cache for context-free first chat turns.
+
+Questions are folded with normalize_text(), question words dropped and tokens cut to a crude stem, then
+compared by character 3-gram TF-IDF cosine. A hit additionally requires identical "salient"
+tokens (short codes and anything with a digit: d, b12, k2, omega3) so "D vitamini eksikliği"
+never answers "B12 eksikliği". The index is built from past user→assistant first turns in the
+DB on first use and extended as new first turns are answered.
+
+Evaluate the threshold on a labeled sample of question pairs ({"a", "b", "same"} per line),
+or measure the hit rate the current history would have had:
+    python -m backend.faq_cache --eval bench/faq_labeled.jsonl
+    python -m backend.faq_cache --replay
+"""
+import argparse
+import datetime
+import json
+import math
+import re
+import threading
+from collections import Counter
+from typing import Dict, Any, List, Optional, Tuple
+from sqlalchemy import func
+from .config import FAQ_CACHE_ENABLED, FAQ_SIMILARITY_THRESHOLD, FAQ_TTL_DAYS, FAQ_MAX_ENTRIES, FAQ_MIN_CHARS
+from .db import SessionLocal, Message
+from .utils import normalize_text
+
+# Dropped before comparison; they carry no topic ("X nedir?" == "X ne demek")
+STOP_WORDS = {"ne", "nedir", "nelerdir", "neler", "nedenleri", "neden", "nasil", "hangi", "hangileri", "mi", "mu",
+              "midir", "mudur", "var", "varmi", "bir", "bu", "ve", "ile", "icin", "hakkinda", "bilgi", "ver",
+              "verir", "misin", "musun", "lutfen", "acaba", "olur", "olan", "demek", "de", "da", "ki", "en"}
+STEM_CHARS = 6
+CANDIDATES = 50
+
+# Codes that must match exactly; everything under 3 chars or containing a digit
+def _salient(tokens: List[str]) -> frozenset:
+    return frozenset(t for t in tokens if len(t) < 3 or any(c.isdigit() for c in t))
+
+def _tokens(text: str) -> List[str]:
+    return [t for t in re.findall(r"[a-z0-9]+", normalize_text(text)) if t not in STOP_WORDS]
+
+def _features(tokens: List[str]) -> Counter:
+    grams: Counter = Counter()
+    for tok in tokens:
+        stem = f" {tok[:STEM_CHARS]} "
+        grams.update(stem[i:i + 3] for i in range(len(stem) - 2))
+    return grams
+
+class FaqIndex:
+    def __init__(self):
+        self.entries: Dict[int, Dict[str, Any]] = {}
+        self.postings: Dict[str, set] = {}
+        self.df: Counter = Counter()
+        self.next_id = 0
+        self.lock = threading.Lock()
+
+    def add(self, question: str, answer: str, created_at: datetime.datetime) -> None:
+        tokens = _tokens(question)
+        if len(question.strip()) < FAQ_MIN_CHARS or not tokens:
+            return
+        feats = _features(tokens)
+        with self.lock:
+            if len(self.entries) >= FAQ_MAX_ENTRIES:
+                self._remove(min(self.entries, key=lambda i: self.entries[i]["created_at"]))
+            entry_id = self.next_id
+            self.next_id += 1
+            self.entries[entry_id] = {"question": question, "answer": answer, "created_at": created_at,
+                                      "features": feats, "salient": _salient(tokens)}
+            for g in feats:
+                self.postings.setdefault(g, set()).add(entry_id)
+                self.df[g] += 1
+
+    def _remove(self, entry_id: int) -> None:
+        entry = self.entries.pop(entry_id)
+        for g in entry["features"]:
+            self.postings[g].discard(entry_id)
+            self.df[g] -= 1
+
+    def _vector(self, feats: Counter) -> Dict[str, float]:
+        n = len(self.entries) + 1
+        vec = {g: tf * math.log(n / (1 + self.df.get(g, 0))) + tf for g, tf in feats.items()}
+        norm = math.sqrt(sum(v * v for v in vec.values())) or 1.0
+        return {g: v / norm for g, v in vec.items()}
+
+    def best(self, question: str) -> Tuple[float, Optional[Dict[str, Any]]]:
+        """Most similar live entry with the same salient tokens, and its cosine similarity"""
+        tokens = _tokens(question)
+        if not tokens:
+            return 0.0, None
+        feats = _features(tokens)
+        salient = _salient(tokens)
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=FAQ_TTL_DAYS)
+        with self.lock:
+            shared: Counter = Counter()
+            for g in feats:
+                shared.update(self.postings.get(g, ()))
+            query = self._vector(feats)
+            best_score, best_entry = 0.0, None
+            for entry_id, _ in shared.most_common(CANDIDATES):
+                entry = self.entries[entry_id]
+                if entry["salient"] != salient or entry["created_at"] < cutoff:
+                    continue
+                vec = self._vector(entry["features"])
+                score = sum(w * vec.get(g, 0.0) for g, w in query.items())
+                if score > best_score:
+                    best_score, best_entry = score, entry
+        return best_score, best_entry
+
+    def __len__(self):
+        return len(self.entries)
+
+_index: Optional[FaqIndex] = None
+_index_lock = threading.Lock()
+
+def _first_turns(db, since: datetime.datetime) -> List[Tuple[str, str, datetime.datetime]]:
+    """(question, answer, created_at) of conversations whose first answer came from the models"""
+    first_user = dict(db.query(Message.conversation_id, func.min(Message.id))
+                        .filter(Message.role == "user", Message.created_at >= since)
+                        .group_by(Message.conversation_id).all())
+    first_reply = dict(db.query(Message.conversation_id, func.min(Message.id))
+                         .filter(Message.role == "assistant", Message.created_at >= since)
+                         .group_by(Message.conversation_id).all())
+    ids = [i for pair in ((first_user[c], first_reply[c]) for c in first_user if c in first_reply) for i in pair]
+    rows = {}
+    for start in range(0, len(ids), 500):
+        chunk = ids[start:start + 500]
+        for r in db.query(Message.id, Message.content, Message.model_name, Message.created_at).filter(Message.id.in_(chunk)):
+            rows[r.id] = r
+    pairs = []
+    for conv_id, q_id in first_user.items():
+        a_id = first_reply.get(conv_id)
+        if a_id is None or a_id < q_id or rows[a_id].model_name in ("guard", "faq"):
+            continue
+        pairs.append((rows[q_id].content, rows[a_id].content, rows[a_id].created_at))
+    pairs.sort(key=lambda p: p[2])
+    return pairs
+
+def _get_index() -> FaqIndex:
+    global _index
+    with _index_lock:
+        if _index is None:
+            index = FaqIndex()
+            db = SessionLocal()
+            try:
+                since = datetime.datetime.utcnow() - datetime.timedelta(days=FAQ_TTL_DAYS)
+                for question, answer, created_at in _first_turns(db, since)[-FAQ_MAX_ENTRIES:]:
+                    index.add(question, answer, created_at)
+            finally:
+                db.close()
+            _index = index
+        return _index
+
+def lookup(question: str) -> Optional[str]:
+    """Cached answer to a near-identical first-turn question, if any"""
+    if not FAQ_CACHE_ENABLED or len(question.strip()) < FAQ_MIN_CHARS:
+        return None
+    score, entry = _get_index().best(question)
+    return entry["answer"] if entry and score >= FAQ_SIMILARITY_THRESHOLD else None
+
+def remember(question: str, answer: str) -> None:
+    if FAQ_CACHE_ENABLED and answer.strip():
+        _get_index().add(question, answer, datetime.datetime.utcnow())
+
+def similarity(a: str, b: str) -> float:
+    """Cosine similarity of two questions (0 when their salient tokens differ), for evaluation"""
+    index = FaqIndex()
+    index.add(a, "", datetime.datetime.utcnow())
+    return index.best(b)[0] if len(index) else 0.0
+
+def evaluate(path: str, threshold: float) -> Dict[str, Any]:
+    with open(path, "r", encoding="utf-8") as f:
+        pairs = [json.loads(line) for line in f if line.strip()]
+    scored = [(similarity(p["a"], p["b"]), bool(p["same"])) for p in pairs]
+    positives = sum(1 for _, same in scored if same)
+    negatives = len(scored) - positives
+    report = {"pairs": len(scored), "threshold": threshold, "sweep": {}}
+    for t in sorted({threshold, 0.7, 0.75, 0.8, 0.85, 0.9}):
+        hits = sum(1 for s, same in scored if same and s >= t)
+        false_hits = sum(1 for s, same in scored if not same and s >= t)
+        report["sweep"][f"{t:.2f}"] = {"hit_rate": round(hits / positives, 3) if positives else None,
+                                      "false_positive_rate": round(false_hits / negatives, 3) if negatives else None}
+    report["false_positives"] = [p for p, (s, same) in zip(pairs, scored) if not same and s >= threshold]
+    return report
+
+def replay(threshold: float) -> Dict[str, Any]:
+    """Hit rate the cache would have had over stored first turns, in chronological order"""
+    db = SessionLocal()
+    try:
+        since = datetime.datetime.utcnow() - datetime.timedelta(days=FAQ_TTL_DAYS)
+        pairs = _first_turns(db, since)
+    finally:
+        db.close()
+    index = FaqIndex()
+    hits = 0
+    for question, answer, created_at in pairs:
+        score, entry = index.best(question)
+        if entry and score >= threshold:
+            hits += 1
+        index.add(question, answer, created_at)
+    return {"first_turns": len(pairs), "hits": hits, "hit_rate": round(hits / len(pairs), 3) if pairs else None}
+
+def main():
+    parser = argparse.ArgumentParser(description="FAQ cache evaluation")
+    parser.add_argument("--eval", help="labeled JSONL of question pairs")
+    parser.add_argument("--replay", action="store_true", help="hit rate over stored first turns")
+    parser.add_argument("--threshold", type=float, default=FAQ_SIMILARITY_THRESHOLD)
+    args = parser.parse_args()
+    if args.eval:
+        print(json.dumps(evaluate(args.eval, args.threshold), ensure_ascii=False, indent=2))
+    if args.replay:
+        print(json.dumps(replay(args.threshold), indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,18 @@
-from typing import Tuple
+from typing import Dict, List, Tuple
 import re
 import difflib
 import time
 import hashlib
-from .config import PRESCRIPTION_BLOCK, HEALTH_MODE, MODERATION_MODEL, MODERATION_TIMEOUT_MS
+import queue
+import threading
+from collections import Counter
+from concurrent.futures import Future
+from .config import (PRESCRIPTION_BLOCK, HEALTH_MODE, MODERATION_MODEL, MODERATION_TIMEOUT_MS,
+                     MODERATION_BATCH_ENABLED, MODERATION_BATCH_WINDOW_MS, MODERATION_BATCH_MAX)
 from .openrouter_client import call_chat_model
+from .utils import normalize_text
+from .shared_state import get_state
+from . import deadline
 
 ALLOW_KEYWORDS = [
     "sağlık", "beslenme", "supplement", "vitamin", "mineral", "diyet", "uyku",
@@ -17,35 +25,43 @@ DENY_KEYWORDS = [
     "siyaset", "politika", "vergi", "emlak"
 ]
 
-def _normalize(t: str) -> str:
-    t = (t or "").lower()
-    return (t.replace("ı", "i").replace("ö", "o").replace("ü", "u")
-             .replace("ş", "s").replace("ğ", "g").replace("ç", "c"))
+# Compiled once at import (and exercised by warmup) instead of on every guarded message
+_TOKEN = re.compile(r"[a-z0-9]+")
+_LAB_UNITS = re.compile(r"\b(mg\/dl|mmol\/l|mui\/ml|miu\/l|ng\/ml|ug\/l|iu|ml)\b")
+_LABS = re.compile(r"\b(hdl|ldl|hba1c|tsh|crp|trigliserid|triglyceride|kolesterol|ferritin|b12|d vitamini|vit d)\b")
+_ORGANS = re.compile(r"\b(karaciger|bobrek|tiroid|kalp|akciger)\b")
+_SYMPTOMS = re.compile(r"\b(ates|oksuruk|bas agrisi|mide bulantisi|ishal|agrisi|agrim var|agriyor|nabiz|tansiyon|iyi hissetmiyorum|kotu hissediyorum|halsizim|yorgunum|rahatsizim|hasta hissediyorum)\b")
+_DOSE = re.compile(r"\b\d+(\.\d+)?\s?(mg|mcg|ug|g|iu|ml|mg\/dl|mmol\/l)\b")
+_FREQ = re.compile(r"(gunde\s?\d+|her\s?\d+\s?(saat|gun)|\b[1-4]x\b)")
+_ALLOW_NORMALIZED = [normalize_text(k) for k in ALLOW_KEYWORDS]
 
 def _fuzzy_any(text: str, candidates: list[str], threshold: float = 0.82) -> bool:
-    # token-level fuzzy match using difflib (std lib)
-    tokens = re.findall(r"[a-z0-9]+", text)
-    for cand in candidates:
-        c = _normalize(cand)
+    # token-level fuzzy match using difflib (std lib); candidates are already normalized
+    tokens = _TOKEN.findall(text)
+    for c in candidates:
         for tok in tokens:
             if difflib.SequenceMatcher(None, tok, c).ratio() >= threshold:
                 return True
     return False
 
-def is_health_topic(text: str) -> bool:
-    t = _normalize(text)
-    if any(k in t for k in DENY_KEYWORDS):
-        return False
-    if any(k in t for k in ALLOW_KEYWORDS) or _fuzzy_any(t, ALLOW_KEYWORDS):
+def _topic_signal(t: str) -> bool:
+    if any(k in t for k in ALLOW_KEYWORDS) or _fuzzy_any(t, _ALLOW_NORMALIZED):
         return True
     # widen health detection with lab/organ/symptom patterns
-    lab_units = r"\b(mg\/dl|mmol\/l|mui\/ml|miu\/l|ng\/ml|ug\/l|iu|ml)\b"
-    labs = r"\b(hdl|ldl|hba1c|tsh|crp|trigliserid|triglyceride|kolesterol|ferritin|b12|d vitamini|vit d)\b"
-    organs = r"\b(karaciger|bobrek|tiroid|kalp|akciger)\b"
-    symptoms = r"\b(ates|oksuruk|bas agrisi|mide bulantisi|ishal|agrisi|agrim var|agriyor|nabiz|tansiyon|iyi hissetmiyorum|kotu hissediyorum|halsizim|yorgunum|rahatsizim|hasta hissediyorum)\b"
-    if re.search(lab_units, t) and re.search(labs, t):
+    if _LAB_UNITS.search(t) and _LABS.search(t):
         return True
-    if re.search(organs, t) or re.search(symptoms, t):
+    return bool(_ORGANS.search(t) or _SYMPTOMS.search(t))
+
+def has_health_signal(text: str) -> bool:
+    """Health keywords, lab values, organs, symptoms or a dose in the text, whatever HEALTH_MODE says"""
+    t = normalize_text(text)
+    return _topic_signal(t) or bool(_DOSE.search(t))
+
+def is_health_topic(text: str) -> bool:
+    t = normalize_text(text)
+    if any(k in t for k in DENY_KEYWORDS):
+        return False
+    if _topic_signal(t):
         return True
     # lenient mode: allow if not explicitly denied
     if (HEALTH_MODE or "").lower() == "lenient":
@@ -55,14 +71,9 @@ def is_health_topic(text: str) -> bool:
 def is_prescription_like(text: str) -> bool:
     if not PRESCRIPTION_BLOCK:
         return False
-    t = (text or "").lower()
-    t = (t
-         .replace("ı", "i").replace("ö", "o").replace("ü", "u")
-         .replace("ş", "s").replace("ğ", "g").replace("ç", "c"))
-    dose = r"\b\d+(\.\d+)?\s?(mg|mcg|ug|g|iu|ml|mg\/dl|mmol\/l)\b"
-    freq = r"(gunde\s?\d+|her\s?\d+\s?(saat|gun)|\b[1-4]x\b)"
+    t = normalize_text(text)
     verbs = ["doz", "dozu", "kac mg", "recete", "yaz", "ilac", "antibiyotik", "antidepresan", "agri kesici"]
-    if re.search(dose, t) and re.search(freq, t):
+    if _DOSE.search(t) and _FREQ.search(t):
         return True
     if any(v in t for v in verbs):
         return True
@@ -121,27 +132,165 @@ def guard_or_message(text: str) -> Tuple[bool, str]:
         return True, ""
 
 
-# ---------- Topic classifier (LLM) with small TTL cache ----------
+# ---------- Topic classifier (LLM) with small TTL cache, shared between workers ----------
 _TOPIC_CACHE_TTL_S = 1800  # 30 minutes
-_topic_cache: dict[str, tuple[str, float]] = {}
 
 def _cache_key(text: str) -> str:
-    t = _normalize(text)
+    t = normalize_text(text)
     return hashlib.sha256(t.encode("utf-8")).hexdigest()
 
 def _cache_get(k: str) -> str | None:
-    now = time.time()
-    item = _topic_cache.get(k)
-    if not item:
-        return None
-    label, exp = item
-    if now > exp:
-        _topic_cache.pop(k, None)
-        return None
-    return label
+    return get_state().get("topic", k)
 
 def _cache_set(k: str, label: str):
-    _topic_cache[k] = (label, time.time() + _TOPIC_CACHE_TTL_S)
+    get_state().set("topic", k, label, _TOPIC_CACHE_TTL_S)
+
+_CLASSIFIER_SYSTEM = (
+    "Sen Longopass AI için health topic classifier'sın. "
+    "Kullanıcı sorusunu analiz et ve SADECE şu kategorilerden birini döndür: "
+    "HEALTH, NON_HEALTH, MEDICAL_PROHIBITED, AMBIGUOUS"
+    "\n\nKATEGORİLER:"
+    "\n• HEALTH: Sağlık, beslenme, supplement, vitamin, mineral, laboratuvar, semptom konuları"
+    "\n• MEDICAL_PROHIBITED: İlaç yazma, doz önerme, teşhis koyma talepleri"
+    "\n• NON_HEALTH: Kripto, borsa, siyaset, spor, teknoloji, eğlence vb."
+    "\n• AMBIGUOUS: Belirsiz veya karma konular"
+    "\n\nSADECE ETİKETİ DÖNDÜR, AÇIKLAMA YAPMA!"
+)
+_CLASSIFIER_BATCH_SYSTEM = (
+    _CLASSIFIER_SYSTEM +
+    "\n\nSorular numaralı liste halinde gelir. Her soru için aynı numarayla tek satır döndür, "
+    "örn: \"1. HEALTH\". Başka hiçbir şey yazma."
+)
+
+def _normalize_label(raw: str) -> str:
+    label = (raw or "").strip().upper()
+    # Normalize to known set with better pattern matching. NON_HEALTH is checked before HEALTH,
+    # which it contains; checked the other way round it was read as HEALTH and allowed.
+    if any(word in label for word in ["MEDICAL", "PROHIBITED", "İLAÇ", "DOZ", "TEŞHİS"]):
+        return "MEDICAL_PROHIBITED"
+    elif any(word in label for word in ["NON", "OLMAYAN", "DEĞİL"]):
+        return "NON_HEALTH"
+    elif any(word in label for word in ["HEALTH", "SAĞLIK", "VİTAMİN", "SUPPLEMENT"]):
+        return "HEALTH"
+    elif any(word in label for word in ["AMBIG", "BELİRSİZ", "KARMA"]):
+        return "AMBIGUOUS"
+    # Default fallback - be conservative
+    return "AMBIGUOUS"
+
+def _classify_single(text: str) -> str:
+    out = call_chat_model(MODERATION_MODEL,
+                          [{"role": "system", "content": _CLASSIFIER_SYSTEM},
+                           {"role": "user", "content": f"Kullanıcı sorusu: {text}"}],
+                          temperature=0.1, max_tokens=5, timeout=MODERATION_TIMEOUT_MS / 1000)
+    return _normalize_label(out.get("content"))
+
+def _classify_batch(texts: List[str]) -> List[str | None]:
+    """One call for several texts; None where the reply has no usable line for an item"""
+    numbered = "\n".join(f"{i}. {' '.join(t.split())}" for i, t in enumerate(texts, 1))
+    out = call_chat_model(MODERATION_MODEL,
+                          [{"role": "system", "content": _CLASSIFIER_BATCH_SYSTEM},
+                           {"role": "user", "content": f"Kullanıcı soruları:\n{numbered}"}],
+                          temperature=0.1, max_tokens=8 * len(texts),
+                          timeout=MODERATION_TIMEOUT_MS / 1000)
+    labels: List[str | None] = [None] * len(texts)
+    for m in re.finditer(r"^\s*(\d+)\s*[.):-]\s*(\S.*)$", out.get("content") or "", re.MULTILINE):
+        idx = int(m.group(1)) - 1
+        if 0 <= idx < len(texts) and labels[idx] is None:
+            labels[idx] = _normalize_label(m.group(2))
+    return labels
+
+# Allowance for a collected batch to be handed to its dispatch thread
+_DISPATCH_SLACK_S = 0.5
+
+class _Pending:
+    __slots__ = ("text", "future", "dispatched")
+
+    def __init__(self, text: str):
+        self.text = text
+        self.future: Future = Future()
+        self.dispatched = threading.Event()
+
+class ModerationBatcher:
+    """Collects classification requests for up to MODERATION_BATCH_WINDOW_MS (or
+    MODERATION_BATCH_MAX items) and sends them as one numbered-list prompt.
+
+    Every batch gets its own dispatch thread, so batching never allows fewer calls in flight
+    than one call per text would. Items the batch reply leaves unlabelled are classified one
+    by one, in parallel, so a caller waits at most one batch call plus one single call."""
+    def __init__(self):
+        self.queue: "queue.Queue[_Pending]" = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread: threading.Thread | None = None
+        self.stats: Counter = Counter()
+
+    def submit(self, text: str) -> _Pending:
+        item = _Pending(text)
+        self.queue.put(item)
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._collect, name="moderation-batcher", daemon=True)
+                self.thread.start()
+        return item
+
+    def _collect(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.time() + MODERATION_BATCH_WINDOW_MS / 1000
+            while len(batch) < MODERATION_BATCH_MAX:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            threading.Thread(target=self._dispatch, args=(batch,), name="moderation-dispatch", daemon=True).start()
+
+    def _dispatch(self, batch: List[_Pending]):
+        for item in batch:
+            item.dispatched.set()
+        # Identical texts in one window are classified once
+        by_key: Dict[str, List[_Pending]] = {}
+        for item in batch:
+            by_key.setdefault(_cache_key(item.text), []).append(item)
+        keys = list(by_key)
+        texts = [by_key[k][0].text for k in keys]
+        self.stats["batches"] += 1
+        self.stats["items"] += len(batch)
+        labels: List[str | None] = [None] * len(texts)
+        if len(texts) > 1:
+            try:
+                labels = _classify_batch(texts)
+            except Exception as e:
+                print(f"Moderation batch of {len(texts)} failed: {e}, classifying one by one")
+        fallbacks = []
+        for key, text, label in zip(keys, texts, labels):
+            if label is None:
+                if len(texts) > 1:
+                    self.stats["fallbacks"] += 1
+                fallbacks.append((text, by_key[key]))
+            else:
+                for item in by_key[key]:
+                    item.future.set_result(label)
+        for args in fallbacks[1:]:
+            threading.Thread(target=self._classify_one, args=args, name="moderation-fallback", daemon=True).start()
+        if fallbacks:
+            self._classify_one(*fallbacks[0])
+
+    def _classify_one(self, text: str, waiters: List[_Pending]):
+        try:
+            label = _classify_single(text)
+        except Exception as e:
+            for item in waiters:
+                item.future.set_exception(e)
+            return
+        for item in waiters:
+            item.future.set_result(label)
+
+_batcher = ModerationBatcher()
+
+def moderation_stats() -> Dict[str, int]:
+    return dict(_batcher.stats)
 
 def classify_topic_llm(text: str) -> str:
     """Return one of: HEALTH | NON_HEALTH | MEDICAL_PROHIBITED | AMBIGUOUS"""
@@ -149,39 +298,14 @@ def classify_topic_llm(text: str) -> str:
     cached = _cache_get(key)
     if cached:
         return cached
-    
-    sys = (
-        "Sen Longopass AI için health topic classifier'sın. "
-        "Kullanıcı sorusunu analiz et ve SADECE şu kategorilerden birini döndür: "
-        "HEALTH, NON_HEALTH, MEDICAL_PROHIBITED, AMBIGUOUS"
-        "\n\nKATEGORİLER:"
-        "\n• HEALTH: Sağlık, beslenme, supplement, vitamin, mineral, laboratuvar, semptom konuları"
-        "\n• MEDICAL_PROHIBITED: İlaç yazma, doz önerme, teşhis koyma talepleri"
-        "\n• NON_HEALTH: Kripto, borsa, siyaset, spor, teknoloji, eğlence vb."
-        "\n• AMBIGUOUS: Belirsiz veya karma konular"
-        "\n\nSADECE ETİKETİ DÖNDÜR, AÇIKLAMA YAPMA!"
-    )
-    
-    usr = f"Kullanıcı sorusu: {text}"
-    
-    out = call_chat_model(MODERATION_MODEL,
-                          [{"role": "system", "content": sys}, {"role": "user", "content": usr}],
-                          temperature=0.1, max_tokens=5)
-    
-    label = (out.get("content") or "").strip().upper()
-    
-    # Normalize to known set with better pattern matching
-    if any(word in label for word in ["MEDICAL", "PROHIBITED", "İLAÇ", "DOZ", "TEŞHİS"]):
-        label = "MEDICAL_PROHIBITED"
-    elif any(word in label for word in ["HEALTH", "SAĞLIK", "VİTAMİN", "SUPPLEMENT"]):
-        label = "HEALTH"
-    elif any(word in label for word in ["NON", "HEALTH", "OLMAYAN", "DEĞİL"]):
-        label = "NON_HEALTH"
-    elif any(word in label for word in ["AMBIG", "BELİRSİZ", "KARMA"]):
-        label = "AMBIGUOUS"
+
+    if MODERATION_BATCH_ENABLED:
+        item = _batcher.submit(text)
+        item.dispatched.wait(deadline.timeout_for(MODERATION_BATCH_WINDOW_MS / 1000 + _DISPATCH_SLACK_S))
+        # The upstream budget starts at dispatch: one batch call, then at most one single call
+        label = item.future.result(timeout=deadline.timeout_for(2 * MODERATION_TIMEOUT_MS / 1000))
     else:
-        # Default fallback - be conservative
-        label = "AMBIGUOUS"
-    
+        label = _classify_single(text)
+
     _cache_set(key, label)
     return label
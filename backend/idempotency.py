@@ -0,0 +1,164 @@
+"""Idempotency-Key support for the expensive POST endpoints.
+
+A retry carrying the same key (per user and endpoint) attaches to the run still in progress or
+gets its stored result back, so it neither starts a second fan-out nor counts against
+FREE_ANALYZE_LIMIT / DAILY_CHAT_LIMIT again. Results, including 4xx errors, are kept for
+IDEMPOTENCY_TTL_S; 5xx failures release the key so a retry recomputes. Replayed responses
+carry `Idempotent-Replayed: true`. Requests without X-User-Id ignore the key: anonymous callers
+share no identity to scope it by, so one guest could replay another's result.
+"""
+import datetime
+import functools
+import hashlib
+import inspect
+import json
+import threading
+import time
+from typing import Dict, Any, Callable
+from fastapi import Header, HTTPException, Response
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy.exc import IntegrityError
+from .config import IDEMPOTENCY_TTL_S, IDEMPOTENCY_WAIT_S, IDEMPOTENCY_STALE_S
+from .db import SessionLocal, IdempotencyKey
+
+POLL_INTERVAL_S = 0.25
+MAX_KEY_LENGTH = 255
+
+# scope key -> set when the run in this worker finishes
+_inflight: Dict[str, threading.Event] = {}
+_inflight_lock = threading.Lock()
+
+def _request_hash(kwargs: Dict[str, Any]) -> str:
+    body = kwargs.get("body", kwargs.get("req"))
+    canonical = json.dumps(jsonable_encoder(body), sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+def _claim(scope: str, request_hash: str) -> IdempotencyKey | None:
+    """Insert an in-progress row; returns the existing live row instead if there is one"""
+    db = SessionLocal()
+    try:
+        row = db.query(IdempotencyKey).filter(IdempotencyKey.scope_key == scope).first()
+        if row is not None:
+            age = (datetime.datetime.utcnow() - row.created_at).total_seconds()
+            expired = age > IDEMPOTENCY_TTL_S or (row.status == "in_progress" and age > IDEMPOTENCY_STALE_S)
+            if not expired:
+                db.expunge(row)
+                return row
+            db.delete(row); db.commit()
+        db.add(IdempotencyKey(scope_key=scope, request_hash=request_hash, status="in_progress"))
+        try:
+            db.commit()
+        except IntegrityError:
+            # Another worker claimed it between our read and insert
+            db.rollback()
+            row = db.query(IdempotencyKey).filter(IdempotencyKey.scope_key == scope).first()
+            if row is not None:
+                db.expunge(row)
+                return row
+        return None
+    finally:
+        db.close()
+
+def _finish(scope: str, status_code: int | None, response: Any):
+    """Store the outcome, or release the key (status_code None) so a retry recomputes"""
+    db = SessionLocal()
+    try:
+        row = db.query(IdempotencyKey).filter(IdempotencyKey.scope_key == scope).first()
+        if row is not None:
+            if status_code is None:
+                db.delete(row)
+            else:
+                row.status, row.status_code, row.response = "done", status_code, response
+            db.commit()
+    finally:
+        db.close()
+        _release_local(scope)
+
+def _release_local(scope: str):
+    with _inflight_lock:
+        event = _inflight.pop(scope, None)
+    if event:
+        event.set()
+
+def _wait(scope: str) -> IdempotencyKey | None:
+    """Wait for the original run: on its event when it runs in this worker, else by polling the row"""
+    with _inflight_lock:
+        event = _inflight.get(scope)
+    deadline = time.time() + IDEMPOTENCY_WAIT_S
+    if event:
+        event.wait(IDEMPOTENCY_WAIT_S)
+    while True:
+        db = SessionLocal()
+        try:
+            row = db.query(IdempotencyKey).filter(IdempotencyKey.scope_key == scope).first()
+            if row is None or row.status == "done":
+                if row is not None:
+                    db.expunge(row)
+                return row
+        finally:
+            db.close()
+        if time.time() >= deadline:
+            raise HTTPException(409, "Aynı istek hâlâ işleniyor, lütfen biraz sonra tekrar deneyin.")
+        time.sleep(POLL_INTERVAL_S)
+
+def _replay(row: IdempotencyKey, response: Response):
+    response.headers["Idempotent-Replayed"] = "true"
+    if row.status_code >= 400:
+        raise HTTPException(row.status_code, row.response, headers={"Idempotent-Replayed": "true"})
+    return row.response
+
+def idempotent(endpoint: str) -> Callable:
+    """Decorator for sync route handlers; adds the Idempotency-Key header to their signature"""
+    def decorate(fn: Callable) -> Callable:
+        @functools.wraps(fn)
+        def wrapper(*args, idempotency_key: str | None = None, idempotency_response: Response = None, **kwargs):
+            if not idempotency_key or not kwargs.get("x_user_id"):
+                return fn(*args, **kwargs)
+            if len(idempotency_key) > MAX_KEY_LENGTH:
+                raise HTTPException(400, "Idempotency-Key çok uzun")
+            scope = f"{kwargs['x_user_id']}|{endpoint}|{idempotency_key}"
+            request_hash = _request_hash(kwargs)
+
+            for _ in range(2):
+                with _inflight_lock:
+                    local = scope in _inflight
+                    if not local:
+                        _inflight[scope] = threading.Event()
+                existing = _wait(scope) if local else _claim(scope, request_hash)
+                if existing is None and local:
+                    continue  # the original run failed and released the key: claim it ourselves
+                if existing is not None:
+                    if not local:
+                        _release_local(scope)
+                    if existing.request_hash != request_hash:
+                        raise HTTPException(422, "Idempotency-Key farklı bir istek için kullanılmış")
+                    if existing.status != "done":
+                        existing = _wait(scope)
+                        if existing is None:
+                            continue
+                    return _replay(existing, idempotency_response)
+                break
+            else:
+                raise HTTPException(409, "Aynı istek hâlâ işleniyor, lütfen biraz sonra tekrar deneyin.")
+
+            try:
+                result = fn(*args, **kwargs)
+            except HTTPException as e:
+                _finish(scope, e.status_code if e.status_code < 500 else None, e.detail)
+                raise
+            except BaseException:
+                _finish(scope, None, None)
+                raise
+            _finish(scope, 200, jsonable_encoder(result))
+            return result
+
+        sig = inspect.signature(fn)
+        extra = [
+            inspect.Parameter("idempotency_key", inspect.Parameter.KEYWORD_ONLY,
+                              default=Header(default=None), annotation=str | None),
+            inspect.Parameter("idempotency_response", inspect.Parameter.KEYWORD_ONLY, annotation=Response),
+        ]
+        params = [p.replace(kind=inspect.Parameter.KEYWORD_ONLY) for p in sig.parameters.values()]
+        wrapper.__signature__ = sig.replace(parameters=params + extra)
+        return wrapper
+    return decorate
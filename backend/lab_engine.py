@@ -0,0 +1,291 @@
+import re
+import hashlib
+from typing import Dict, Any, Optional, Tuple
+from .config import LAB_CACHE_TTL_S
+from .utils import normalize_text
+from .shared_state import get_state
+
+# Canonical test index. "unit" is the canonical unit, "conversions" maps other normalized
+# units to the factor that converts them into the canonical unit. "range" is a generic adult
+# default used only when the request has no reference_range (None for sex/age dependent tests).
+TEST_INDEX: Dict[str, Dict[str, Any]] = {
+    "vitamin_d": {
+        "name": "Vitamin D (25-OH)",
+        "synonyms": ["vitamin d", "vit d", "d vitamini", "25-oh vitamin d", "25 oh d", "25(oh)d", "25-hidroksi vitamin d", "vitamin d3", "d3"],
+        "unit": "ng/ml", "conversions": {"nmol/l": 0.4006}, "range": (30, 100),
+        "about": "D vitamini kemik sağlığı, kas fonksiyonu ve bağışıklık için önemlidir.",
+    },
+    "vitamin_b12": {
+        "name": "Vitamin B12",
+        "synonyms": ["b12", "vitamin b12", "vit b12", "b12 vitamini", "kobalamin", "cobalamin"],
+        "unit": "pg/ml", "conversions": {"pmol/l": 1.355, "ng/l": 1.0}, "range": (200, 900),
+        "about": "B12 vitamini sinir sistemi ve kan yapımı için gereklidir.",
+    },
+    "folate": {
+        "name": "Folat",
+        "synonyms": ["folat", "folate", "folik asit", "folic acid"],
+        "unit": "ng/ml", "conversions": {"nmol/l": 0.441, "ug/l": 1.0}, "range": (3, 17),
+        "about": "Folat hücre yenilenmesi ve kan yapımında rol oynar.",
+    },
+    "ferritin": {
+        "name": "Ferritin",
+        "synonyms": ["ferritin"],
+        "unit": "ng/ml", "conversions": {"ug/l": 1.0}, "range": None,
+        "about": "Ferritin vücuttaki demir depolarını yansıtır.",
+    },
+    "iron": {
+        "name": "Demir",
+        "synonyms": ["demir", "serum demir", "iron", "fe"],
+        "unit": "ug/dl", "conversions": {"umol/l": 5.585}, "range": (60, 170),
+        "about": "Serum demiri kandaki dolaşan demir miktarını gösterir.",
+    },
+    "magnesium": {
+        "name": "Magnezyum",
+        "synonyms": ["magnezyum", "magnesium", "mg"],
+        "unit": "mg/dl", "conversions": {"mmol/l": 2.431}, "range": (1.7, 2.2),
+        "about": "Magnezyum kas, sinir ve enerji metabolizması için gereklidir.",
+    },
+    "total_cholesterol": {
+        "name": "Total Kolesterol",
+        "synonyms": ["kolesterol", "total kolesterol", "cholesterol", "total cholesterol"],
+        "unit": "mg/dl", "conversions": {"mmol/l": 38.67}, "range": (None, 200),
+        "about": "Total kolesterol kalp-damar sağlığının genel göstergelerinden biridir.",
+    },
+    "ldl": {
+        "name": "LDL Kolesterol",
+        "synonyms": ["ldl", "ldl kolesterol", "ldl cholesterol", "ldl-c"],
+        "unit": "mg/dl", "conversions": {"mmol/l": 38.67}, "range": (None, 130),
+        "about": "LDL kolesterol damar sağlığı açısından takip edilen bir yağ türüdür.",
+    },
+    "hdl": {
+        "name": "HDL Kolesterol",
+        "synonyms": ["hdl", "hdl kolesterol", "hdl cholesterol", "hdl-c"],
+        "unit": "mg/dl", "conversions": {"mmol/l": 38.67}, "range": (40, None),
+        "about": "HDL kolesterol damarları koruyucu etkisi olan yağ türüdür.",
+    },
+    "triglycerides": {
+        "name": "Trigliserid",
+        "synonyms": ["trigliserid", "trigliserit", "triglyceride", "triglycerides", "tg"],
+        "unit": "mg/dl", "conversions": {"mmol/l": 88.57}, "range": (None, 150),
+        "about": "Trigliseridler kandaki yağların bir türüdür ve beslenmeyle yakından ilişkilidir.",
+    },
+    "glucose": {
+        "name": "Açlık Kan Şekeri",
+        "synonyms": ["glukoz", "glucose", "aclik kan sekeri", "aclik glukozu", "kan sekeri", "aks", "fasting glucose"],
+        "unit": "mg/dl", "conversions": {"mmol/l": 18.016}, "range": (70, 100),
+        "about": "Açlık kan şekeri karbonhidrat metabolizmasının temel göstergesidir.",
+    },
+    "hba1c": {
+        "name": "HbA1c",
+        "synonyms": ["hba1c", "hemoglobin a1c", "a1c", "glikozile hemoglobin"],
+        "unit": "%", "conversions": {}, "range": (None, 5.7),
+        "about": "HbA1c son 2-3 aylık ortalama kan şekerini yansıtır.",
+    },
+    "insulin": {
+        "name": "İnsülin",
+        "synonyms": ["insulin", "aclik insulini", "aclik insulin"],
+        "unit": "uiu/ml", "conversions": {"pmol/l": 0.144, "miu/l": 1.0}, "range": (2, 25),
+        "about": "İnsülin kan şekerini düzenleyen hormondur.",
+    },
+    "tsh": {
+        "name": "TSH",
+        "synonyms": ["tsh", "tiroid uyarici hormon", "thyroid stimulating hormone"],
+        "unit": "miu/l", "conversions": {"uiu/ml": 1.0}, "range": (0.4, 4.0),
+        "about": "TSH tiroid bezinin çalışmasını düzenleyen hormondur.",
+    },
+    "free_t4": {
+        "name": "Serbest T4",
+        "synonyms": ["serbest t4", "free t4", "ft4", "st4"],
+        "unit": "ng/dl", "conversions": {"pmol/l": 0.0777}, "range": (0.8, 1.8),
+        "about": "Serbest T4 tiroid bezinin ürettiği aktif hormon düzeyini gösterir.",
+    },
+    "hemoglobin": {
+        "name": "Hemoglobin",
+        "synonyms": ["hemoglobin", "hgb", "hb"],
+        "unit": "g/dl", "conversions": {"g/l": 0.1}, "range": None,
+        "about": "Hemoglobin kanda oksijen taşıyan proteindir.",
+    },
+    "creatinine": {
+        "name": "Kreatinin",
+        "synonyms": ["kreatinin", "creatinine"],
+        "unit": "mg/dl", "conversions": {"umol/l": 1 / 88.4}, "range": None,
+        "about": "Kreatinin böbrek fonksiyonlarının takibinde kullanılır.",
+    },
+    "alt": {
+        "name": "ALT",
+        "synonyms": ["alt", "sgpt", "alanin aminotransferaz"],
+        "unit": "u/l", "conversions": {}, "range": (None, 40),
+        "about": "ALT karaciğer sağlığının takibinde kullanılan bir enzimdir.",
+    },
+    "ast": {
+        "name": "AST",
+        "synonyms": ["ast", "sgot", "aspartat aminotransferaz"],
+        "unit": "u/l", "conversions": {}, "range": (None, 40),
+        "about": "AST karaciğer ve kas dokusunda bulunan bir enzimdir.",
+    },
+    "crp": {
+        "name": "CRP",
+        "synonyms": ["crp", "c reaktif protein", "c-reaktif protein"],
+        "unit": "mg/l", "conversions": {"mg/dl": 10.0}, "range": (None, 5),
+        "about": "CRP vücuttaki inflamasyonun genel bir göstergesidir.",
+    },
+    "testosterone": {
+        "name": "Testosteron",
+        "synonyms": ["testosteron", "testosterone", "total testosteron"],
+        "unit": "ng/dl", "conversions": {"nmol/l": 28.84}, "range": None,
+        "about": "Testosteron enerji, kas kütlesi ve üreme sağlığıyla ilişkili bir hormondur.",
+    },
+}
+
+_FILLER_TOKENS = {"serum", "plazma", "kan", "total", "test", "duzeyi", "seviyesi"}
+_UNIT_ALIASES = {"iu/l": "u/l", "mu/l": "miu/l", "uui/ml": "uiu/ml", "mui/ml": "uiu/ml", "miu/ml": "uiu/ml", "mcg/l": "ug/l"}
+
+def _name_key(name: str) -> str:
+    t = normalize_text(name)
+    t = re.sub(r"[^a-z0-9%]+", " ", t)
+    return " ".join(t.split())
+
+_SYNONYMS: Dict[str, str] = {}
+for _key, _entry in TEST_INDEX.items():
+    for _syn in _entry["synonyms"] + [_entry["name"]]:
+        _SYNONYMS[_name_key(_syn)] = _key
+
+def canonical_test(name: str) -> Optional[str]:
+    """Map a free-text test name ("Vit D", "25-OH Vitamin D") to its index key"""
+    key = _name_key(name)
+    if key in _SYNONYMS:
+        return _SYNONYMS[key]
+    stripped = " ".join(tok for tok in key.split() if tok not in _FILLER_TOKENS)
+    return _SYNONYMS.get(stripped)
+
+def normalize_unit(unit: str) -> str:
+    u = (unit or "").strip().lower().replace("µ", "u").replace("μ", "u").replace(" ", "")
+    u = u.replace("mcg", "ug").replace("ıu", "iu").replace("ı", "i")
+    return _UNIT_ALIASES.get(u, u)
+
+def parse_value(value: Any) -> Optional[float]:
+    m = re.search(r"[-+]?\d+(?:[.,]\d+)?", str(value if value is not None else ""))
+    if not m:
+        return None
+    return float(m.group(0).replace(",", "."))
+
+_RANGE_BETWEEN = re.compile(r"(\d+(?:[.,]\d+)?)\s*[-–—]\s*(\d+(?:[.,]\d+)?)")
+_RANGE_UPPER = re.compile(r"(?:<=|≤|<)\s*(\d+(?:[.,]\d+)?)")
+_RANGE_LOWER = re.compile(r"(?:>=|≥|>)\s*(\d+(?:[.,]\d+)?)")
+
+def parse_range(text: Optional[str]) -> Optional[Tuple[Optional[float], Optional[float]]]:
+    """Parse "3.5-5.0", "<200", ">40" style reference ranges into (low, high)"""
+    if not text:
+        return None
+    t = str(text)
+    m = _RANGE_BETWEEN.search(t)
+    if m:
+        return float(m.group(1).replace(",", ".")), float(m.group(2).replace(",", "."))
+    m = _RANGE_UPPER.search(t)
+    if m:
+        return None, float(m.group(1).replace(",", "."))
+    m = _RANGE_LOWER.search(t)
+    if m:
+        return float(m.group(1).replace(",", ".")), None
+    return None
+
+def convert(value: float, unit: str, key: str) -> Optional[float]:
+    """Convert a value into the canonical unit of the test; None if the unit is missing or unknown"""
+    entry = TEST_INDEX[key]
+    u = normalize_unit(unit)
+    if not u:
+        # Vitamin D is 30 in ng/ml but 75 in nmol/l; without a unit the value cannot be placed
+        return None
+    if u == entry["unit"]:
+        return value
+    factor = entry["conversions"].get(u)
+    return value * factor if factor is not None else None
+
+def _classify(value: float, low: Optional[float], high: Optional[float]) -> str:
+    if low is not None and value < low:
+        return "low"
+    if high is not None and value > high:
+        return "high"
+    return "normal"
+
+def evaluate_test(test: Dict[str, Any]) -> Dict[str, Any]:
+    """Deterministic assessment of one test: canonical name, canonical value/unit and
+    low/normal/high status. status is "unknown" when value or range cannot be resolved."""
+    key = canonical_test(test.get("name", ""))
+    value = parse_value(test.get("value"))
+    result: Dict[str, Any] = {
+        "test_key": key,
+        "name": TEST_INDEX[key]["name"] if key else test.get("name", ""),
+        "value": value,
+        "unit": test.get("unit", ""),
+        "status": "unknown",
+        "low": None,
+        "high": None,
+        "range_source": None,
+    }
+    if value is None:
+        return result
+
+    parsed = parse_range(test.get("reference_range"))
+    if parsed:
+        # Reference ranges come in the same unit as the value
+        result.update(low=parsed[0], high=parsed[1], range_source="reference",
+                      status=_classify(value, parsed[0], parsed[1]))
+    if key:
+        canonical = convert(value, test.get("unit", ""), key)
+        result["canonical_value"] = round(canonical, 3) if canonical is not None else None
+        result["canonical_unit"] = TEST_INDEX[key]["unit"]
+        default = TEST_INDEX[key]["range"]
+        if not parsed and default and canonical is not None:
+            result.update(low=default[0], high=default[1], range_source="default",
+                          status=_classify(canonical, default[0], default[1]))
+    return result
+
+_STATUS_TR = {"low": "düşük", "normal": "normal", "high": "yüksek", "unknown": "belirlenemedi"}
+
+def describe_assessment(assessment: Dict[str, Any]) -> str:
+    """One-line summary of the local assessment, used in prompts"""
+    low, high = assessment.get("low"), assessment.get("high")
+    if low is not None and high is not None:
+        rng = f"{low}-{high}"
+    elif high is not None:
+        rng = f"<{high}"
+    elif low is not None:
+        rng = f">{low}"
+    else:
+        rng = "yok"
+    unit = assessment.get("canonical_unit") if assessment.get("range_source") == "default" else assessment.get("unit")
+    return (f"Yerel değerlendirme: {assessment['name']} = {_STATUS_TR[assessment['status']]} "
+            f"(aralık: {rng} {unit or ''})").rstrip()
+
+def templated_interpretation(assessment: Dict[str, Any]) -> Dict[str, Any]:
+    """Single-lab response for a recognized, in-range result; same shape as the LLM schema"""
+    entry = TEST_INDEX[assessment["test_key"]]
+    value_text = f"{assessment['value']:g} {assessment.get('unit') or ''}".strip()
+    return {
+        "analysis": {
+            "summary": f"{entry['name']} sonucunuz ({value_text}) referans aralığında.",
+            "interpretation": f"{entry['about']} Sonucunuz beklenen aralıkta yer alıyor.",
+            "reference_comparison": describe_assessment(assessment).replace("Yerel değerlendirme: ", ""),
+            "clinical_significance": "Referans aralığındaki bu sonuç tek başına ek bir risk işareti taşımaz.",
+            "follow_up_suggestions": "Rutin kontrollerinize devam edin; belirtiniz varsa hekiminizle değerlendirin.",
+        },
+        "local_assessment": assessment["status"],
+    }
+
+# ---------- Single-lab result cache keyed on the structured assessment, shared between workers ----------
+
+def result_cache_key(assessment: Dict[str, Any], test: Dict[str, Any]) -> str:
+    if assessment.get("test_key") and assessment.get("canonical_value") is not None:
+        parts = [assessment["test_key"], f"{assessment['canonical_value']:.2f}", assessment["canonical_unit"],
+                 str(assessment.get("low")), str(assessment.get("high")), assessment["status"]]
+    else:
+        parts = [_name_key(test.get("name", "")), str(test.get("value", "")).strip(),
+                 normalize_unit(test.get("unit", "")), str(test.get("reference_range") or "")]
+    return hashlib.sha256("|".join(parts).encode("utf-8")).hexdigest()
+
+def cache_get(k: str) -> str | None:
+    return get_state().get("lab", k)
+
+def cache_set(k: str, content: str):
+    get_state().set("lab", k, content, LAB_CACHE_TTL_S)
@@ -0,0 +1,118 @@
+import re
+from typing import List, Dict, Any, Tuple, Optional
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+from .db import LabResult, Message
+from .utils import normalize_text, parse_json_safe
+from .lab_engine import canonical_test, normalize_unit, parse_value, convert
+
+TREND_STABLE_PCT = 5.0
+
+def test_key(name: str) -> str:
+    return canonical_test(name) or re.sub(r"[^a-z0-9]+", "", normalize_text(name))
+
+def _value_key(test: Dict[str, Any]) -> Tuple[str, str]:
+    return (str(test.get("value", "")).strip().replace(",", "."), normalize_unit(test.get("unit") or ""))
+
+def _comparable_value(name: str, value: Any, unit: Optional[str]) -> Optional[float]:
+    """Value in the canonical unit when the test is indexed, so mg/dL and mmol/L trend together"""
+    num = parse_value(value)
+    key = canonical_test(name)
+    if num is None or not key:
+        return num
+    return convert(num, unit or "", key)
+
+def load_latest(db: Session, user_id: int) -> Dict[str, LabResult]:
+    """Latest stored result per test for the user"""
+    newest = (db.query(func.max(LabResult.id))
+              .filter(LabResult.user_id == user_id)
+              .group_by(LabResult.test_key))
+    rows = db.query(LabResult).filter(LabResult.id.in_(newest.scalar_subquery())).all()
+    return {row.test_key: row for row in rows}
+
+def split_changed(tests: List[Dict[str, Any]], latest: Dict[str, LabResult]) -> Tuple[List[Dict[str, Any]], Dict[str, Dict[str, Any]]]:
+    """Return (tests needing analysis, cached per-test details keyed by the incoming test name)"""
+    changed, cached = [], {}
+    for test in tests:
+        prev = latest.get(test_key(test.get("name", "")))
+        if prev is not None and prev.interpretation and _value_key(test) == _value_key({"value": prev.value, "unit": prev.unit}):
+            cached[test["name"]] = dict(prev.interpretation)
+        else:
+            changed.append(test)
+    return changed, cached
+
+def reusable_summary(db: Session, user_id: int, tests: List[Dict[str, Any]]) -> Optional[str]:
+    """Latest stored multiple_lab summary if it covers exactly this test set"""
+    m = (db.query(Message)
+         .filter(Message.user_id == user_id, Message.role == "assistant", Message.model_name == "multiple_lab")
+         .order_by(Message.id.desc()).first())
+    if not m:
+        return None
+    data = parse_json_safe(m.content)
+    if not isinstance(data, dict) or data.get("overall_status") == "geçici_bakım":
+        return None
+    details = data.get("test_details")
+    if not isinstance(details, dict):
+        return None
+    if {test_key(n) for n in details} != {test_key(t.get("name", "")) for t in tests}:
+        return None
+    return m.content
+
+def compute_trends(db: Session, user_id: int, tests: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    """Trend per test from stored history plus the incoming value; no LLM involved"""
+    keys = {test_key(t.get("name", "")): t for t in tests}
+    rows = (db.query(LabResult.test_key, LabResult.name, LabResult.value, LabResult.unit, LabResult.created_at)
+            .filter(LabResult.user_id == user_id, LabResult.test_key.in_(list(keys)))
+            .order_by(LabResult.id.asc()).all())
+    series: Dict[str, List[Dict[str, Any]]] = {}
+    for key, name, value, unit, created_at in rows:
+        num = _comparable_value(name, value, unit)
+        if num is not None:
+            series.setdefault(key, []).append({"value": num, "date": created_at.date().isoformat()})
+
+    trends = {}
+    for key, test in keys.items():
+        points = series.get(key, [])
+        current = _comparable_value(test.get("name", ""), test.get("value"), test.get("unit"))
+        if not points or current is None:
+            continue
+        previous = points[-1]["value"]
+        change_pct = ((current - previous) / previous * 100) if previous else 0.0
+        if abs(change_pct) < TREND_STABLE_PCT:
+            direction = "stabil"
+        else:
+            direction = "artış" if change_pct > 0 else "azalış"
+        trends[test["name"]] = {
+            "direction": direction,
+            "change_pct": round(change_pct, 1),
+            "previous_value": round(previous, 3),
+            "previous_date": points[-1]["date"],
+            "history": [round(p["value"], 3) for p in points] + [round(current, 3)],
+        }
+    return trends
+
+def _match_detail(name: str, details: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    if name in details:
+        return details[name]
+    key = test_key(name)
+    for detail_name, detail in details.items():
+        if test_key(detail_name) == key:
+            return detail
+    return None
+
+def save_results(db: Session, user_id: int, tests: List[Dict[str, Any]], details: Dict[str, Any]):
+    """Store one row per test of this session together with its interpretation"""
+    for test in tests:
+        detail = _match_detail(test.get("name", ""), details or {})
+        if isinstance(detail, dict):
+            detail = {k: v for k, v in detail.items() if k != "trend"}
+        db.add(LabResult(
+            user_id=user_id,
+            test_key=test_key(test.get("name", "")),
+            name=test.get("name", ""),
+            value=str(test.get("value", "")),
+            unit=test.get("unit"),
+            reference_range=test.get("reference_range"),
+            interpretation=detail if isinstance(detail, dict) else None,
+        ))
+    db.commit()
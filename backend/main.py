@@ -1,20 +1,53 @@
-from fastapi import FastAPI, Depends, HTTPException, Header, Request
+from fastapi import FastAPI, Depends, HTTPException, Header, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
+from fastapi.responses import StreamingResponse, PlainTextResponse
+from starlette.concurrency import run_in_threadpool
+from sqlalchemy import func, text
 from sqlalchemy.orm import Session
 import json, time
 
-from .config import ALLOWED_ORIGINS, CHAT_HISTORY_MAX, FREE_ANALYZE_LIMIT, DAILY_CHAT_LIMIT
-from .db import Base, engine, SessionLocal, User, Conversation, Message, MessageMeta
-from .auth import get_db, get_or_create_user
+from . import warmup
+from .config import ALLOWED_ORIGINS, CHAT_HISTORY_MAX, CHAT_HISTORY_PAGE_MAX, FREE_ANALYZE_LIMIT, DAILY_CHAT_LIMIT, LOG_PROVIDER_RAW
+from .db import engine, init_db, pack_payload, SessionLocal, User, Conversation, Message, MessageMeta
+from .auth import get_db, get_or_create_user, require_admin
 from .schemas import AnalyzePayload, LabBatchPayload, ChatStartResponse, ChatMessageRequest, ChatResponse, AnalyzeResponse, QuizRequest, QuizResponse, SingleLabRequest, MultipleLabRequest, LabAnalysisResponse, GeneralLabSummaryResponse
-from .health_guard import guard_or_message
-from .orchestrator import parallel_chat, finalize_text, parallel_analyze, finalize_analyze, parallel_quiz_analyze, parallel_single_lab_analyze, parallel_multiple_lab_analyze
+from .health_guard import guard_or_message, moderation_stats
+from .payload_guard import guard_lab_tests, guard_lab_results
+from .orchestrator import parallel_chat, finalize_text, parallel_analyze, finalize_analyze, parallel_multiple_lab_analyze, incremental_multiple_lab_analyze
+from .pipelines import GuardRejected, run_quiz, run_single_lab
+from .routing import route_chat
+from .batch import BatchError, parse_items as parse_batch_items, stream_batch
+from .lab_history import load_latest, split_changed, reusable_summary, compute_trends, save_results
+from .conversation_cache import add_message, recent_turns
+from .idempotency import idempotent
+from .faq_cache import lookup as faq_lookup, remember as faq_remember
+from .maintenance import start_scheduler, stop_scheduler
+from .openrouter_client import usage_stats
+from .upstreams import get_pool, close_pool
+from . import token_budget
+from . import profiling
+from .profiling import ProfilerMiddleware
+from .deadline import DeadlineMiddleware, stats as deadline_stats, cancelled as request_cancelled
+from . import scheduler
 from .utils import parse_json_safe
 
 app = FastAPI(title="Longopass AI Gateway")
-Base.metadata.create_all(bind=engine)
 
+@app.on_event("startup")
+def _start_maintenance():
+    init_db()
+    start_scheduler()
+    warmup.start()
+
+@app.on_event("shutdown")
+def _stop_maintenance():
+    stop_scheduler()
+    close_pool()
+
+app.add_middleware(DeadlineMiddleware)
+app.add_middleware(warmup.FirstRequestTimer)
+app.add_middleware(ProfilerMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=ALLOWED_ORIGINS if ALLOWED_ORIGINS!=["*"] else ["*"],
@@ -26,10 +59,38 @@ app.add_middleware(
 # Serve widget js and static frontend (optional)
 app.mount("/static", StaticFiles(directory="frontend"), name="static")
 
+def admit(plan: str, endpoint: str):
+    """Put the request in its priority class; 503 while that class's upstream queue is full"""
+    try:
+        scheduler.enter(plan, endpoint)
+    except scheduler.QueueFull:
+        raise HTTPException(503, "Sistem şu anda yoğun, lütfen biraz sonra tekrar deneyin.", headers={"Retry-After": "5"})
+
 @app.get("/health")
 def health_check():
     return {"status": "ok", "service": "longopass-ai"}
 
+@app.get("/livez")
+async def livez():
+    """Process is up and its event loop answers; no I/O"""
+    return {"status": "ok"}
+
+@app.get("/readyz")
+def readyz(response: Response):
+    """Warmup done, database reachable and at least one healthy upstream"""
+    checks = {"warmup": warmup.ready(), "upstreams": get_pool().healthy()}
+    try:
+        with engine.connect() as conn:
+            conn.execute(text("SELECT 1"))
+        checks["db"] = True
+    except Exception as e:
+        print(f"Readiness: database check failed: {e}")
+        checks["db"] = False
+    ready = all(checks.values())
+    if not ready:
+        response.status_code = 503
+    return {"status": "ok" if ready else "unavailable", "checks": checks}
+
 @app.get("/widget.js")
 def widget_js():
     with open("frontend/widget.js", "r", encoding="utf-8") as f:
@@ -56,17 +117,41 @@ def chat_start(db: Session = Depends(get_db),
 
 @app.get("/ai/chat/{conversation_id}/history")
 def chat_history(conversation_id: int,
+                 request: Request,
+                 response: Response,
+                 before_id: int | None = Query(default=None, ge=1),
+                 limit: int = Query(default=CHAT_HISTORY_MAX, ge=1, le=CHAT_HISTORY_PAGE_MAX),
                  db: Session = Depends(get_db),
                  x_user_id: str | None = Header(default=None),
                  x_user_plan: str | None = Header(default=None)):
+    """Newest `limit` messages before `before_id`, oldest first. X-Next-Before-Id points to the
+    previous page when there is one."""
     user = get_or_create_user(db, x_user_id, x_user_plan)
     conv = db.query(Conversation).filter(Conversation.id==conversation_id, Conversation.user_id==user.id).first()
     if not conv:
         raise HTTPException(404, "Konuşma bulunamadı")
-    msgs = db.query(Message).filter(Message.conversation_id==conv.id).order_by(Message.created_at.asc()).all()
-    return [{"role": m.role, "content": m.content, "ts": m.created_at.isoformat()} for m in msgs][-CHAT_HISTORY_MAX:]
+
+    # Messages are append-only (retention only removes the oldest), so the id bounds
+    # identify the page content; widget refreshes without new messages become 304s
+    lo, hi = db.query(func.min(Message.id), func.max(Message.id)).filter(Message.conversation_id==conv.id).one()
+    etag = f'W/"{conv.id}-{lo or 0}-{hi or 0}-{before_id or 0}-{limit}"'
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+
+    q = db.query(Message.id, Message.role, Message.content, Message.created_at).filter(Message.conversation_id==conv.id)
+    if before_id:
+        q = q.filter(Message.id < before_id)
+    rows = q.order_by(Message.id.desc()).limit(limit + 1).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit][::-1]
+
+    response.headers["ETag"] = etag
+    if has_more:
+        response.headers["X-Next-Before-Id"] = str(rows[0].id)
+    return [{"id": r.id, "role": r.role, "content": r.content, "ts": r.created_at.isoformat()} for r in rows]
 
 @app.post("/ai/chat", response_model=ChatResponse)
+@idempotent("chat")
 def chat_message(req: ChatMessageRequest,
                  db: Session = Depends(get_db),
                  x_user_id: str | None = Header(default=None),
@@ -74,6 +159,7 @@ def chat_message(req: ChatMessageRequest,
     user = get_or_create_user(db, x_user_id, x_user_plan)
     if user.plan != "premium":
         raise HTTPException(403, "Chat için premium gereklidir.")
+    admit(user.plan, "chat")
 
     conv = db.query(Conversation).filter(Conversation.id==req.conversation_id, Conversation.user_id==user.id).first()
     if not conv:
@@ -94,36 +180,49 @@ def chat_message(req: ChatMessageRequest,
     ok, msg = guard_or_message(req.text)
     if not ok:
         # store user message
-        db.add(Message(conversation_id=conv.id, user_id=user.id, role="user", content=req.text)); db.commit()
+        add_message(db, conv.id, "user", req.text, user_id=user.id)
         # reply fixed message
         reply = msg
-        m = Message(conversation_id=conv.id, role="assistant", content=reply, model_name="guard", model_latency_ms=0)
-        db.add(m); db.commit()
+        add_message(db, conv.id, "assistant", reply, model_name="guard", model_latency_ms=0)
         return ChatResponse(conversation_id=conv.id, reply=reply, used_model="guard", latency_ms=0)
 
     # store user message FIRST
-    db.add(Message(conversation_id=conv.id, user_id=user.id, role="user", content=req.text)); db.commit()
+    add_message(db, conv.id, "user", req.text, user_id=user.id)
 
-    # build history (including the new user message)
-    rows = db.query(Message).filter(Message.conversation_id==conv.id).order_by(Message.created_at.asc()).all()
+    # build history (including the new user message); warm conversations are served from memory
     history = [{"role": "system", "content": "Sen Longopass AI'sın. SADECE sağlık/supplement/lab konularında yanıt ver. Off-topic'te kibarca reddet."}]
-    for r in rows[-(CHAT_HISTORY_MAX-1):]:
-        history.append({"role": r.role, "content": r.content})
+    turns = recent_turns(db, conv.id, CHAT_HISTORY_MAX-1)
+    history.extend(turns)
+    first_turn = len(turns) == 1
 
-    # parallel chat with synthesis
+    # Context-free first questions that were already answered are served from the FAQ cache
+    if first_turn:
+        cached = faq_lookup(req.text)
+        if cached is not None:
+            add_message(db, conv.id, "assistant", cached, model_name="faq", model_latency_ms=0, route_profile="faq")
+            return ChatResponse(conversation_id=conv.id, reply=cached, used_model="faq", latency_ms=0)
+
+    # parallel chat with synthesis, sized by the routed profile
+    route = route_chat(req.text, user.plan)
     start = time.time()
-    res = parallel_chat(history)
+    res = parallel_chat(history, route)
     candidate = res["content"]
     used_model = res.get("model_used","unknown")
     # finalize
-    final = finalize_text(candidate)
+    final = finalize_text(candidate, route["synthesis_model"]) if route["finalize"] else candidate
     latency_ms = int((time.time()-start)*1000)
+    if request_cancelled():
+        # Client is gone and sent no Idempotency-Key to retry with: don't keep a partial reply
+        return ChatResponse(conversation_id=conv.id, reply="", used_model="cancelled", latency_ms=latency_ms)
 
     # store assistant message + meta
-    m = Message(conversation_id=conv.id, role="assistant", content=final, model_name=used_model, model_latency_ms=latency_ms)
-    db.add(m); db.commit(); db.refresh(m)
-    db.add(MessageMeta(message_id=m.id, raw_provider_payload=res.get("raw"), raw_provider_name=used_model))
-    db.commit()
+    m = add_message(db, conv.id, "assistant", final, model_name=used_model, model_latency_ms=latency_ms,
+                    route_profile=route["label"])
+    if first_turn and not res.get("degraded"):
+        faq_remember(req.text, final)
+    if LOG_PROVIDER_RAW:
+        db.add(MessageMeta(message_id=m.id, raw_provider_blob=pack_payload(res.get("raw")), raw_provider_name=used_model))
+        db.commit()
 
     return ChatResponse(conversation_id=conv.id, reply=final, used_model=used_model, latency_ms=latency_ms)
 
@@ -134,6 +233,7 @@ def count_user_analyses(db: Session, user_id: int) -> int:
     return db.query(Message).filter(Message.user_id==user_id, Message.role=="assistant", Message.model_name=="analyze").count()
 
 @app.post("/ai/quiz", response_model=QuizResponse)
+@idempotent("quiz")
 def analyze_quiz(body: QuizRequest,
                  db: Session = Depends(get_db),
                  x_user_id: str | None = Header(default=None),
@@ -141,65 +241,70 @@ def analyze_quiz(body: QuizRequest,
     user = get_or_create_user(db, x_user_id, x_user_plan)
     if user.plan == "free" and count_user_analyses(db, user.id) >= FREE_ANALYZE_LIMIT:
         raise HTTPException(403, "Ücretsiz kullanıcılar yalnızca bir kez analiz yapabilir. Premium'a yükseltin.")
+    admit(user.plan, "quiz")
 
-    # Convert quiz answers to dict for health guard
-    quiz_dict = body.answers.model_dump()
-    ok, msg = guard_or_message(json.dumps(quiz_dict))
-    if not ok:
-        raise HTTPException(400, msg)
-
-    # Use parallel quiz analysis
-    res = parallel_quiz_analyze(quiz_dict)
-    final_json = res["content"]
-    data = parse_json_safe(final_json) or {}
-    
-    # Store quiz result
-    db.add(Message(user_id=user.id, conversation_id=None, role="assistant", content=final_json, model_name="quiz"))
-    db.commit()
-    return data
+    try:
+        return run_quiz(db, user.id, body.answers.model_dump(), user.plan)
+    except GuardRejected as e:
+        raise HTTPException(400, str(e))
 
 @app.post("/ai/lab/single", response_model=LabAnalysisResponse)
+@idempotent("lab_single")
 def analyze_single_lab(body: SingleLabRequest,
                        db: Session = Depends(get_db),
                        x_user_id: str | None = Header(default=None),
                        x_user_plan: str | None = Header(default=None)):
     """Analyze single lab test result (analysis only, no recommendations)"""
     user = get_or_create_user(db, x_user_id, x_user_plan)
+    admit(user.plan, "lab")
     
-    # Convert test to dict for health guard
-    test_dict = body.test.model_dump()
-    ok, msg = guard_or_message(json.dumps(test_dict))
-    if not ok:
-        raise HTTPException(400, msg)
-
-    # Use parallel single lab analysis
-    res = parallel_single_lab_analyze(test_dict)
-    final_json = res["content"]
-    data = parse_json_safe(final_json) or {}
-    
-    # Store single lab analysis
-    db.add(Message(user_id=user.id, conversation_id=None, role="assistant", content=final_json, model_name="single_lab"))
-    db.commit()
-    return data
+    try:
+        return run_single_lab(db, user.id, body.test.model_dump())
+    except GuardRejected as e:
+        raise HTTPException(400, str(e))
 
 @app.post("/ai/lab/summary", response_model=GeneralLabSummaryResponse)
+@idempotent("lab_summary")
 def analyze_multiple_lab_summary(body: MultipleLabRequest,
                                  db: Session = Depends(get_db),
                                  x_user_id: str | None = Header(default=None),
                                  x_user_plan: str | None = Header(default=None)):
     """Generate general summary of multiple lab tests"""
     user = get_or_create_user(db, x_user_id, x_user_plan)
+    admit(user.plan, "lab")
     
-    # Convert tests to dict for health guard
+    # Structured guard: only suspicious free text reaches the moderation model
     tests_dict = [test.model_dump() for test in body.tests]
-    ok, msg = guard_or_message(json.dumps(tests_dict))
+    ok, msg = guard_lab_tests(tests_dict)
     if not ok:
         raise HTTPException(400, msg)
 
-    # Use parallel multiple lab analysis
-    res = parallel_multiple_lab_analyze(tests_dict, body.total_test_sessions)
-    final_json = res["content"]
+    # Incremental analysis: unchanged tests reuse their stored per-test interpretation
+    latest = load_latest(db, user.id)
+    changed, cached = split_changed(tests_dict, latest)
+    previous = reusable_summary(db, user.id, tests_dict) if not changed else None
+    if previous:
+        # Same results as the stored summary: nothing new to save, and its trends still hold
+        return parse_json_safe(previous) or {}
+    if cached:
+        res = incremental_multiple_lab_analyze(changed, cached, tests_dict, body.total_test_sessions)
+        final_json = res["content"]
+    else:
+        res = parallel_multiple_lab_analyze(tests_dict, body.total_test_sessions)
+        final_json = res["content"]
     data = parse_json_safe(final_json) or {}
+    if request_cancelled():
+        return data
+
+    # Trends are computed locally from the stored history
+    trends = compute_trends(db, user.id, tests_dict)
+    details = data.setdefault("test_details", {})
+    if isinstance(details, dict):
+        save_results(db, user.id, tests_dict, details)
+        for name, trend in trends.items():
+            details.setdefault(name, {})
+            if isinstance(details[name], dict):
+                details[name]["trend"] = trend
     
     # Add metadata for response formatting
     if "test_count" not in data:
@@ -207,31 +312,168 @@ def analyze_multiple_lab_summary(body: MultipleLabRequest,
     if "overall_status" not in data:
         data["overall_status"] = "analiz_tamamlandı"
     
-    # Store multiple lab summary
-    db.add(Message(user_id=user.id, conversation_id=None, role="assistant", content=final_json, model_name="multiple_lab"))
+    # Store multiple lab summary with its trends, so a repeat of the same results can return it as is
+    db.add(Message(user_id=user.id, conversation_id=None, role="assistant",
+                   content=json.dumps(data, ensure_ascii=False), model_name="multiple_lab"))
     db.commit()
     return data
 
 # Legacy lab endpoint for backward compatibility
 @app.post("/ai/lab/analyze", response_model=AnalyzeResponse)
+@idempotent("lab_analyze")
 def analyze_lab_legacy(body: LabBatchPayload,
                        db: Session = Depends(get_db),
                        x_user_id: str | None = Header(default=None),
                        x_user_plan: str | None = Header(default=None)):
     """Legacy lab analysis endpoint (supplement recommendations)"""
     user = get_or_create_user(db, x_user_id, x_user_plan)
-    ok, msg = guard_or_message(json.dumps(body.results))
+    admit(user.plan, "lab")
+    ok, msg = guard_lab_results(body.results)
     if not ok:
         raise HTTPException(400, msg)
 
     res = parallel_analyze({"lab_results": body.results})
     final_json = res["content"]
     data = parse_json_safe(final_json) or {}
+    if request_cancelled():
+        return data
     
     db.add(Message(user_id=user.id, conversation_id=None, role="assistant", content=final_json, model_name="lab_legacy"))
     db.commit()
     return data
 
+# ---------- BATCH (B2B) ----------
+
+@app.post("/ai/batch")
+async def analyze_batch(request: Request,
+                        x_user_id: str | None = Header(default=None),
+                        x_user_plan: str | None = Header(default=None),
+                        x_batch_resume: str | None = Header(default=None)):
+    """Bulk quiz/lab analysis. Body is NDJSON (default) or CSV (Content-Type: text/csv);
+    results stream back as NDJSON in completion order. The first line carries batch_id,
+    send it back as X-Batch-Resume (or resend the same body) to skip finished items."""
+    def _user():
+        db = SessionLocal()
+        try:
+            user = get_or_create_user(db, x_user_id, x_user_plan)
+            return user.id, user.plan
+        finally:
+            db.close()
+    user_id, plan = await run_in_threadpool(_user)
+    if plan != "premium":
+        raise HTTPException(403, "Batch analiz için premium gereklidir.")
+    try:
+        items = parse_batch_items(await request.body(), request.headers.get("content-type", ""))
+    except BatchError as e:
+        raise HTTPException(400, str(e))
+    return StreamingResponse(stream_batch(user_id, items, x_batch_resume), media_type="application/x-ndjson")
+
+# ---------- ADMIN ----------
+
+@app.get("/admin/messages/{message_id}/raw", dependencies=[Depends(require_admin)])
+def admin_message_raw(message_id: int, db: Session = Depends(get_db)):
+    """Raw provider payloads of a message; decompressed only here"""
+    metas = db.query(MessageMeta).filter(MessageMeta.message_id==message_id).all()
+    if not metas:
+        raise HTTPException(404, "Kayıt bulunamadı")
+    return [{"provider": m.raw_provider_name, "ts": m.created_at.isoformat(), "payload": m.payload} for m in metas]
+
+@app.get("/admin/routing/latency", dependencies=[Depends(require_admin)])
+def admin_routing_latency(days: int = Query(default=7, ge=1), db: Session = Depends(get_db)):
+    """Latency distribution per routing profile over the last `days`"""
+    import datetime
+    since = datetime.datetime.utcnow() - datetime.timedelta(days=days)
+    rows = (db.query(Message.route_profile, Message.model_latency_ms)
+              .filter(Message.route_profile.isnot(None), Message.model_latency_ms.isnot(None), Message.created_at >= since)
+              .all())
+    by_profile: dict[str, list[int]] = {}
+    for profile, latency in rows:
+        by_profile.setdefault(profile, []).append(latency)
+    report = {}
+    for profile, values in sorted(by_profile.items()):
+        values.sort()
+        pct = lambda q: values[min(len(values) - 1, int(q * len(values)))]
+        report[profile] = {"count": len(values), "p50_ms": pct(0.5), "p95_ms": pct(0.95), "max_ms": values[-1]}
+    return report
+
+@app.get("/admin/prompt-cache", dependencies=[Depends(require_admin)])
+def admin_prompt_cache(reset: bool = False):
+    """Cached input tokens per model since start (or the last reset)"""
+    return usage_stats(reset)
+
+@app.get("/admin/moderation", dependencies=[Depends(require_admin)])
+def admin_moderation():
+    """Topic classifier batches, classified items and per-item fallbacks since start"""
+    return moderation_stats()
+
+@app.get("/admin/upstreams", dependencies=[Depends(require_admin)])
+def admin_upstreams():
+    """Upstream pool: outstanding requests, 429s and remaining cooldown per key/endpoint"""
+    return get_pool().stats()
+
+@app.get("/admin/scheduler", dependencies=[Depends(require_admin)])
+def admin_scheduler():
+    """Upstream slots, per-class running/queued calls, rejections and queue-wait histograms"""
+    return scheduler.scheduler.stats()
+
+@app.get("/admin/deadlines", dependencies=[Depends(require_admin)])
+def admin_deadlines():
+    """Optional stages skipped near the deadline, and disconnects / upstream calls saved by cancelling"""
+    return deadline_stats()
+
+@app.get("/admin/token-budgets", dependencies=[Depends(require_admin)])
+def admin_token_budgets():
+    """Learned max_tokens per stage/model and generation latency with the static vs learned budget"""
+    return token_budget.report()
+
+@app.get("/admin/startup", dependencies=[Depends(require_admin)])
+def admin_startup():
+    """Time to ready, warmup phase timings and the first request's latency per endpoint"""
+    return warmup.report()
+
+@app.get("/admin/profile", dependencies=[Depends(require_admin)])
+def admin_profile():
+    samples = profiling.sampler.snapshot()
+    return {"sample_rate": profiling.sample_rate,
+            "endpoints": {label: sum(c.values()) for label, c in samples.items()}}
+
+@app.post("/admin/profile/config", dependencies=[Depends(require_admin)])
+def admin_profile_config(sample_rate: float = Query(ge=0.0, le=1.0), reset: bool = False):
+    profiling.sample_rate = sample_rate
+    if reset:
+        profiling.sampler.reset()
+    return {"sample_rate": profiling.sample_rate}
+
+@app.get("/admin/profile/stacks", dependencies=[Depends(require_admin)], response_class=PlainTextResponse)
+def admin_profile_stacks(endpoint: str):
+    """Collapsed stacks for one endpoint label, e.g. 'POST /ai/chat' (or '_other')"""
+    return profiling.collapsed(endpoint)
+
+@app.post("/admin/profile/tracemalloc/start", dependencies=[Depends(require_admin)])
+def admin_tracemalloc_start(nframes: int = Query(default=10, ge=1, le=50)):
+    profiling.tracemalloc_start(nframes)
+    return {"tracing": True}
+
+@app.post("/admin/profile/tracemalloc/stop", dependencies=[Depends(require_admin)])
+def admin_tracemalloc_stop():
+    profiling.tracemalloc_stop()
+    return {"tracing": False}
+
+@app.get("/admin/profile/tracemalloc", dependencies=[Depends(require_admin)])
+def admin_tracemalloc_diff(limit: int = Query(default=25, ge=1, le=200), group_by: str = Query(default="lineno", pattern="^(lineno|filename|traceback)$")):
+    return profiling.tracemalloc_diff(limit, group_by)
+
+@app.get("/admin/profile/threads", dependencies=[Depends(require_admin)])
+async def admin_thread_dump():
+    return {"threads": profiling.thread_dump(), "tasks": profiling.task_dump()}
+
+@app.get("/debug/cassette", dependencies=[Depends(require_admin)])
+def debug_cassette(reset: bool = False):
+    """Upstream call/token counters of the record/replay cassette"""
+    from .cassette import stats
+    from .config import OPENROUTER_CASSETTE_MODE
+    return {"mode": OPENROUTER_CASSETTE_MODE, **stats(reset)}
+
 @app.get("/debug/analyze")
 def debug_analyze():
     """Debug endpoint to see raw LLM response"""
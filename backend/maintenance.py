@@ -0,0 +1,186 @@
+"""Retention and compaction.
+
+Purges (or archives, with MAINTENANCE_ARCHIVE_DIR) rows older than RETENTION_DAYS in small
+batches so the SQLite write lock is only held briefly, drops raw provider payloads when
+LOG_PROVIDER_RAW is off, then runs incremental vacuum and ANALYZE.
+
+Runs in a background thread of the API (MAINTENANCE_INTERVAL_S, 0 disables; with several
+workers only the one holding the shared "maintenance" lease runs a pass) or once via:
+    python -m backend.maintenance
+Databases created before incremental auto_vacuum was enabled need one offline full VACUUM:
+    python -m backend.maintenance --full-vacuum
+"""
+import argparse
+import datetime
+import gzip
+import json
+import os
+import threading
+import time
+from typing import Dict, Any
+from sqlalchemy import text
+from .config import (RETENTION_DAYS, LOG_PROVIDER_RAW, MAINTENANCE_INTERVAL_S, MAINTENANCE_BATCH_SIZE,
+                     MAINTENANCE_VACUUM_PAGES, MAINTENANCE_ARCHIVE_DIR, IDEMPOTENCY_TTL_S)
+from .db import engine, init_db, pack_payload
+from .shared_state import get_state
+
+# (table, timestamp column); message_meta goes before messages because it references them
+RETENTION_TABLES = [
+    ("message_meta", "created_at"),
+    ("messages", "created_at"),
+    ("lab_results", "created_at"),
+    ("batch_item_results", "created_at"),
+]
+BATCH_PAUSE_S = 0.05
+
+def _db_bytes(conn) -> int:
+    page_size = conn.execute(text("PRAGMA page_size")).scalar()
+    page_count = conn.execute(text("PRAGMA page_count")).scalar()
+    return page_size * page_count
+
+def _archive(conn, table: str, ids: list):
+    rows = conn.execute(text(f"SELECT * FROM {table} WHERE id IN ({','.join(str(i) for i in ids)})")).mappings().all()
+    os.makedirs(MAINTENANCE_ARCHIVE_DIR, exist_ok=True)
+    path = os.path.join(MAINTENANCE_ARCHIVE_DIR, f"{table}-{datetime.date.today().isoformat()}.jsonl.gz")
+    with gzip.open(path, "at", encoding="utf-8") as f:
+        for row in rows:
+            f.write(json.dumps(dict(row), ensure_ascii=False, default=str) + "\n")
+
+def purge_table(table: str, column: str, cutoff: datetime.datetime, archive: bool = True) -> int:
+    """Delete rows older than cutoff, one short transaction per batch"""
+    deleted = 0
+    while True:
+        with engine.begin() as conn:
+            ids = [r[0] for r in conn.execute(
+                text(f"SELECT id FROM {table} WHERE {column} < :cutoff ORDER BY id LIMIT :n"),
+                {"cutoff": cutoff, "n": MAINTENANCE_BATCH_SIZE})]
+            if not ids:
+                return deleted
+            if archive and MAINTENANCE_ARCHIVE_DIR:
+                _archive(conn, table, ids)
+            conn.execute(text(f"DELETE FROM {table} WHERE id IN ({','.join(str(i) for i in ids)})"))
+        deleted += len(ids)
+        time.sleep(BATCH_PAUSE_S)
+
+def purge_empty_conversations(cutoff: datetime.datetime) -> int:
+    with engine.begin() as conn:
+        res = conn.execute(text(
+            "DELETE FROM conversations WHERE started_at < :cutoff "
+            "AND NOT EXISTS (SELECT 1 FROM messages m WHERE m.conversation_id = conversations.id)"),
+            {"cutoff": cutoff})
+        return res.rowcount or 0
+
+def drop_raw_payloads() -> int:
+    """With LOG_PROVIDER_RAW off, clear payloads that were stored earlier"""
+    cleared = 0
+    while True:
+        with engine.begin() as conn:
+            res = conn.execute(text(
+                "UPDATE message_meta SET raw_provider_payload = NULL, raw_provider_blob = NULL WHERE id IN "
+                "(SELECT id FROM message_meta WHERE raw_provider_payload IS NOT NULL OR raw_provider_blob IS NOT NULL LIMIT :n)"),
+                {"n": MAINTENANCE_BATCH_SIZE})
+        if not res.rowcount:
+            return cleared
+        cleared += res.rowcount
+        time.sleep(BATCH_PAUSE_S)
+
+def compress_legacy_payloads() -> int:
+    """Move uncompressed JSON payloads into the compressed blob column"""
+    moved = 0
+    while True:
+        with engine.begin() as conn:
+            rows = conn.execute(text(
+                "SELECT id, raw_provider_payload FROM message_meta "
+                "WHERE raw_provider_payload IS NOT NULL AND raw_provider_blob IS NULL LIMIT :n"),
+                {"n": MAINTENANCE_BATCH_SIZE}).all()
+            if not rows:
+                return moved
+            for row_id, payload in rows:
+                conn.execute(text("UPDATE message_meta SET raw_provider_blob = :blob, raw_provider_payload = NULL WHERE id = :id"),
+                             {"blob": pack_payload(json.loads(payload)), "id": row_id})
+        moved += len(rows)
+        time.sleep(BATCH_PAUSE_S)
+
+def compact() -> None:
+    with engine.begin() as conn:
+        if conn.execute(text("PRAGMA auto_vacuum")).scalar() == 2:
+            conn.execute(text(f"PRAGMA incremental_vacuum({MAINTENANCE_VACUUM_PAGES})"))
+        else:
+            print("Maintenance: auto_vacuum is not INCREMENTAL, run 'python -m backend.maintenance --full-vacuum' once")
+        conn.execute(text("ANALYZE"))
+
+def full_vacuum():
+    """Rewrites the whole file (holds the lock for the duration); also switches on incremental auto_vacuum"""
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        before = _db_bytes(conn)
+        conn.execute(text("PRAGMA auto_vacuum=INCREMENTAL"))
+        conn.execute(text("VACUUM"))
+        print(f"Full vacuum: {before} -> {_db_bytes(conn)} bytes")
+
+def run_maintenance() -> Dict[str, Any]:
+    start = time.time()
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=RETENTION_DAYS)
+    with engine.connect() as conn:
+        bytes_before = _db_bytes(conn)
+
+    report: Dict[str, Any] = {"cutoff": cutoff.isoformat(), "deleted": {}}
+    for table, column in RETENTION_TABLES:
+        report["deleted"][table] = purge_table(table, column, cutoff)
+    report["deleted"]["conversations"] = purge_empty_conversations(cutoff)
+    idempotency_cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=IDEMPOTENCY_TTL_S)
+    report["deleted"]["idempotency_keys"] = purge_table("idempotency_keys", "created_at", idempotency_cutoff, archive=False)
+    report["raw_payloads_cleared"] = 0 if LOG_PROVIDER_RAW else drop_raw_payloads()
+    report["raw_payloads_compressed"] = compress_legacy_payloads() if LOG_PROVIDER_RAW else 0
+    compact()
+
+    with engine.connect() as conn:
+        bytes_after = _db_bytes(conn)
+        free_pages = conn.execute(text("PRAGMA freelist_count")).scalar()
+        page_size = conn.execute(text("PRAGMA page_size")).scalar()
+    report.update({
+        "bytes_before": bytes_before,
+        "bytes_after": bytes_after,
+        "bytes_reclaimed": bytes_before - bytes_after,
+        "free_bytes_remaining": free_pages * page_size,
+        "duration_ms": int((time.time() - start) * 1000),
+    })
+    print(f"Maintenance: {report}")
+    return report
+
+_thread: threading.Thread | None = None
+_stop = threading.Event()
+
+def _loop():
+    # Small initial delay so startup traffic isn't competing for the write lock
+    if _stop.wait(60):
+        return
+    while True:
+        try:
+            # The lease is left to expire, so the other workers skip this interval
+            if get_state().acquire("maintenance", MAINTENANCE_INTERVAL_S * 0.9):
+                run_maintenance()
+                get_state().purge()
+        except Exception as e:
+            print(f"Maintenance failed: {e}")
+        if _stop.wait(MAINTENANCE_INTERVAL_S):
+            return
+
+def start_scheduler():
+    global _thread
+    if MAINTENANCE_INTERVAL_S <= 0 or (_thread and _thread.is_alive()):
+        return
+    _stop.clear()
+    _thread = threading.Thread(target=_loop, name="maintenance", daemon=True)
+    _thread.start()
+
+def stop_scheduler():
+    _stop.set()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Retention and compaction")
+    parser.add_argument("--full-vacuum", action="store_true", help="run a full VACUUM after the purge")
+    args = parser.parse_args()
+    init_db()
+    run_maintenance()
+    if args.full_vacuum:
+        full_vacuum()
@@ -1,39 +1,131 @@
+import threading
 import time
 import httpx
+from collections import Counter
 from typing import List, Dict, Any, Optional
-from .config import OPENROUTER_API_KEY, OPENROUTER_BASE_URL, PARALLEL_TIMEOUT_MS
+from .config import PARALLEL_TIMEOUT_MS, OPENROUTER_CASSETTE_MODE, PROMPT_CACHE_ENABLED, PROMPT_CACHE_MODELS
+from . import cassette
+from . import deadline
+from .scheduler import upstream_slot
+from .upstreams import get_pool
 
-def _get_headers():
-    if not OPENROUTER_API_KEY:
-        raise ValueError("OPENROUTER_API_KEY environment variable is required")
-    return {
-        "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-        "Content-Type": "application/json",
-    }
+# Per-model prompt/cached token totals, see usage_stats()
+_usage: Dict[str, Counter] = {}
+_usage_lock = threading.Lock()
+
+def _with_cache_control(model: str, messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Mark the leading system message as a cache breakpoint for models that need one"""
+    if not (PROMPT_CACHE_ENABLED and messages and any(model.startswith(p) for p in PROMPT_CACHE_MODELS)):
+        return messages
+    first = messages[0]
+    if first.get("role") != "system" or not isinstance(first.get("content"), str):
+        return messages
+    marked = {"role": "system", "content": [{"type": "text", "text": first["content"], "cache_control": {"type": "ephemeral"}}]}
+    return [marked] + list(messages[1:])
 
 def _build_chat_payload(model: str, messages: List[Dict[str, str]], temperature: float = 0.5, max_tokens: int = 800):
     return {
         "model": model,
-        "messages": messages,
+        "messages": _with_cache_control(model, messages),
         "temperature": temperature,
         "max_tokens": max_tokens,
     }
 
-def call_chat_model(model: str, messages: List[Dict[str, str]], temperature: float = 0.5, max_tokens: int = 800) -> Dict[str, Any]:
-    url = f"{OPENROUTER_BASE_URL}/chat/completions"
-    payload = _build_chat_payload(model, messages, temperature, max_tokens)
-    start = time.time()
-    with httpx.Client(timeout=PARALLEL_TIMEOUT_MS/1000) as client:
-        r = client.post(url, headers=_get_headers(), json=payload)
-        latency_ms = int((time.time() - start) * 1000)
-        r.raise_for_status()
-        data = r.json()
+# OpenRouter usage accounting: adds prompt_tokens_details.cached_tokens and cost. Other
+# OpenAI-compatible servers may reject the unknown field, so it is only sent to OpenRouter.
+_OPENROUTER_FIELDS = {"usage": {"include": True}}
+
+def _record_usage(model: str, usage: Dict[str, Any], cached_tokens: int, latency_ms: int):
+    with _usage_lock:
+        c = _usage.setdefault(model, Counter())
+        c["calls"] += 1
+        c["prompt_tokens"] += usage.get("prompt_tokens") or 0
+        c["cached_tokens"] += cached_tokens
+        if cached_tokens:
+            c["cache_hit_calls"] += 1
+            c["cache_hit_latency_ms"] += latency_ms
+        else:
+            c["cache_miss_latency_ms"] += latency_ms
+
+def usage_stats(reset: bool = False) -> Dict[str, Dict[str, Any]]:
+    """Prompt caching effect per model: cached share of input tokens and latency with/without a hit"""
+    with _usage_lock:
+        report = {}
+        for model, c in _usage.items():
+            misses = c["calls"] - c["cache_hit_calls"]
+            report[model] = {
+                "calls": c["calls"],
+                "prompt_tokens": c["prompt_tokens"],
+                "cached_tokens": c["cached_tokens"],
+                "cached_ratio": round(c["cached_tokens"] / c["prompt_tokens"], 3) if c["prompt_tokens"] else 0.0,
+                "avg_latency_ms_cache_hit": int(c["cache_hit_latency_ms"] / c["cache_hit_calls"]) if c["cache_hit_calls"] else None,
+                "avg_latency_ms_cache_miss": int(c["cache_miss_latency_ms"] / misses) if misses else None,
+            }
+        if reset:
+            _usage.clear()
+        return report
+
+def _result(data: Dict[str, Any], latency_ms: int, model: str | None = None) -> Dict[str, Any]:
     # OpenAI-compatible structure
-    content = data["choices"][0]["message"]["content"]
+    choice = data["choices"][0]
+    content = choice["message"]["content"]
     usage = data.get("usage", {})
+    cached_tokens = (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
+    if model:
+        _record_usage(model, usage, cached_tokens, latency_ms)
     return {
         "content": content,
         "latency_ms": latency_ms,
         "usage": usage,
+        "cached_tokens": cached_tokens,
+        "finish_reason": choice.get("finish_reason"),
         "raw": data
     }
+
+def _post(model: str, payload: Dict[str, Any], timeout: float) -> Dict[str, Any]:
+    """POST to the least loaded upstream serving model; a 429 moves on to the next untried one"""
+    pool = get_pool()
+    tried = []
+    while True:
+        upstream = pool.acquire(model, exclude=tried)
+        status = retry_after = None
+        client_timeout = False
+        try:
+            body = {**payload, **_OPENROUTER_FIELDS} if upstream.openrouter else payload
+            r = upstream.client.post(f"{upstream.base_url}/chat/completions", headers=upstream.headers(),
+                                     json=body, timeout=timeout)
+            status, retry_after = r.status_code, r.headers.get("Retry-After")
+        except httpx.TimeoutException:
+            # Only a timeout at the full PARALLEL_TIMEOUT_MS counts against the upstream's health
+            client_timeout = timeout < PARALLEL_TIMEOUT_MS / 1000
+            raise
+        finally:
+            pool.release(upstream, status, retry_after, client_timeout)
+        tried.append(upstream)
+        if status == 429 and len(tried) < len(pool.candidates(model)):
+            continue
+        r.raise_for_status()
+        return r.json()
+
+def call_chat_model(model: str, messages: List[Dict[str, str]], temperature: float = 0.5, max_tokens: int = 800,
+                    timeout: float | None = None) -> Dict[str, Any]:
+    """timeout (seconds) defaults to PARALLEL_TIMEOUT_MS; either way it is capped by the request deadline"""
+    if OPENROUTER_CASSETTE_MODE == "replay":
+        entry = cassette.replay(model, messages, temperature, max_tokens)
+        return _result(entry["body"], entry["latency_ms"], model)
+
+    payload = _build_chat_payload(model, messages, temperature, max_tokens)
+    start = time.time()
+    try:
+        # Waiting for a slot spends the request's budget, so the timeout is taken after it
+        with upstream_slot():
+            call_start = time.time()
+            data = _post(model, payload, deadline.timeout_for(timeout if timeout is not None else PARALLEL_TIMEOUT_MS/1000))
+            latency_ms = int((time.time() - call_start) * 1000)
+    except Exception as e:
+        if OPENROUTER_CASSETTE_MODE == "record":
+            cassette.record(model, messages, temperature, max_tokens, int((time.time() - start) * 1000), None, error=str(e))
+        raise
+    if OPENROUTER_CASSETTE_MODE == "record":
+        cassette.record(model, messages, temperature, max_tokens, latency_ms, data)
+    return _result(data, latency_ms, model)
@@ -1,85 +1,158 @@
+import json
+import re
 from typing import List, Dict, Any
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from .config import PARALLEL_MODELS, SYNTHESIS_MODEL, CASCADE_MODELS, FINALIZER_MODEL
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from .config import (PARALLEL_MODELS, SYNTHESIS_MODEL, CASCADE_MODELS, FINALIZER_MODEL,
+                     LAB_CHUNK_MIN_TESTS, LAB_GROUP_MAX_TESTS, LAB_MAP_MODEL)
 from .openrouter_client import call_chat_model
-from .utils import is_valid_chat, is_valid_analyze, parse_json_safe
+from . import deadline, token_budget
+from .lab_engine import describe_assessment, evaluate_test
+from .utils import is_valid_chat, is_valid_analyze, normalize_text, parse_json_safe
 
 SYSTEM_HEALTH = ("Sen Longopass AI'sın. SADECE sağlık/supplement/laboratuvar konularında yanıt ver. "
                  "Off-topic'te kibarca reddet. Yanıtlar bilgilendirme amaçlıdır; tanı/tedavi için hekim gerekir.")
 
-def parallel_chat(messages: List[Dict[str, str]]) -> Dict[str, Any]:
-    """Run parallel chat with multiple models, then synthesize with GPT-5"""
+# Prompt layout: every builder puts its static instructions and JSON schema in the system
+# message (module constants, built once) and only the request data in the user message, so
+# the system message is a byte-identical prefix that providers can cache.
+
+def _non_empty(content: str) -> bool:
+    return bool(content.strip())
+
+CANCEL_POLL_S = 0.2
+
+def _completed(futures):
+    """as_completed() that stops once the client has disconnected; calls still in flight
+    finish in their worker threads but nobody waits for them"""
+    pending = set(futures)
+    while pending:
+        done, pending = wait(pending, timeout=CANCEL_POLL_S, return_when=FIRST_COMPLETED)
+        yield from done
+        if pending and deadline.cancelled():
+            deadline.record_saved("in_flight_abandoned", len(pending))
+            return
+
+def _call(stage: str, model: str, messages: List[Dict[str, str]], temperature: float, max_tokens: int,
+          units: int = 1) -> Dict[str, Any]:
+    """call_chat_model() with the learned token budget of this stage/model; max_tokens is the static one"""
+    budget = token_budget.max_tokens_for(stage, model, max_tokens, units)
+    hint = token_budget.length_hint(stage, model)
+    if hint:
+        messages = messages[:-1] + [{**messages[-1], "content": f"{messages[-1]['content']}\n\n{hint}"}]
+    res = call_chat_model(model, messages, temperature=temperature, max_tokens=budget or max_tokens)
+    token_budget.observe(stage, model, res, adaptive=budget is not None, units=units, hinted=bool(hint))
+    if budget is not None and res.get("finish_reason") == "length":
+        # The learned budget was too small; observe() has widened it, retry once
+        wider = token_budget.max_tokens_for(stage, model, max_tokens, units)
+        if wider and wider > budget:
+            token_budget.record_retry(stage)
+            try:
+                retry = call_chat_model(model, messages, temperature=temperature, max_tokens=wider)
+            except Exception as e:
+                print(f"Retry of truncated {stage} call to {model} failed: {e}")
+                return res
+            token_budget.observe(stage, model, retry, adaptive=True, units=units, hinted=bool(hint))
+            return retry
+    return res
+
+def _fan_out(stage: str, models: List[str], messages: List[Dict[str, str]], temperature: float, max_tokens: int,
+             accept=_non_empty, label: str = "Parallel") -> List[Dict[str, str]]:
+    """Call models in parallel; keep the responses whose content passes accept()"""
+    responses = []
+    executor = ThreadPoolExecutor(max_workers=len(models))
     try:
-        # Step 1: Call multiple models in parallel
-        responses = []
-        with ThreadPoolExecutor(max_workers=len(PARALLEL_MODELS)) as executor:
-            future_to_model = {
-                executor.submit(call_chat_model, model, messages, 0.6, 600): model 
-                for model in PARALLEL_MODELS
-            }
-            
-            for future in as_completed(future_to_model):
-                model = future_to_model[future]
-                try:
-                    result = future.result()
-                    if is_valid_chat(result["content"]):
-                        responses.append({
-                            "model": model,
-                            "response": result["content"]
-                        })
-                except Exception as e:
-                    print(f"Chat model {model} failed: {e}")
-                    continue
+        future_to_model = {
+            deadline.submit(executor, _call, stage, model, messages, temperature, max_tokens): model
+            for model in models
+        }
+        for future in _completed(future_to_model):
+            model = future_to_model[future]
+            try:
+                result = future.result()
+                if accept(result["content"]):
+                    responses.append({"model": model, "response": result["content"]})
+            except Exception as e:
+                print(f"{label} model {model} failed: {e}")
+    finally:
+        executor.shutdown(wait=False)
+    return responses
+
+def _first_response(responses: List[Dict[str, str]]) -> Dict[str, Any]:
+    """Fastest accepted response as the result, used when synthesis no longer fits the deadline"""
+    return {"content": responses[0]["response"], "model_used": responses[0]["model"], "degraded": True}
+
+def parallel_chat(messages: List[Dict[str, str]], route: Dict[str, Any] | None = None) -> Dict[str, Any]:
+    """Run parallel chat with the routed models, then synthesize with GPT-5"""
+    models = route["models"] if route else PARALLEL_MODELS
+    synthesis_model = route["synthesis_model"] if route else SYNTHESIS_MODEL
+    accept = _chat_accept(route)
+    try:
+        # Step 1: Call the models in parallel
+        responses = _fan_out("chat", models, messages, 0.6, 600, accept=accept, label="Chat")
         
         # Step 2: If no valid responses, fallback
         if not responses:
             print("All chat models failed, fallback to single model")
-            return cascade_chat_fallback(messages)
+            return cascade_chat_fallback(messages, route)
         
-        # Step 3: If only one response, return it directly
-        if len(responses) == 1:
+        # Step 3: If only one response (or a single-model route), return it directly
+        if len(responses) == 1 or (route and not route["synthesis"]):
             return {
                 "content": responses[0]["response"],
                 "model_used": responses[0]["model"]
             }
+        if not deadline.can_afford("chat_synthesis"):
+            return _first_response(responses)
         
         # Step 4: Synthesize multiple responses with GPT-5
         synthesis_prompt = build_chat_synthesis_prompt(responses, messages[-1]["content"])
-        final_result = call_chat_model(SYNTHESIS_MODEL, synthesis_prompt, temperature=0.3, max_tokens=800)
+        final_result = _call("chat_synthesis", synthesis_model, synthesis_prompt, 0.3, 800)
         
         final_result["models_used"] = [r["model"] for r in responses]
-        final_result["synthesis_model"] = SYNTHESIS_MODEL
+        final_result["synthesis_model"] = synthesis_model
         return final_result
         
     except Exception as e:
         print(f"Parallel chat failed: {e}, fallback to sequential")
-        return cascade_chat_fallback(messages)
+        return cascade_chat_fallback(messages, route)
 
-def cascade_chat_fallback(messages: List[Dict[str, str]]) -> Dict[str, Any]:
-    """Fallback to sequential cascade for chat"""
-    for model in PARALLEL_MODELS:
-        res = call_chat_model(model, messages, temperature=0.6, max_tokens=600)
-        if is_valid_chat(res["content"]):
+def _chat_accept(route: Dict[str, Any] | None):
+    """Small-talk routes (validate: false) take any non-empty reply; a "Rica ederim" is short and off-topic"""
+    return is_valid_chat if route is None or route["validate"] else _non_empty
+
+def cascade_chat_fallback(messages: List[Dict[str, str]], route: Dict[str, Any] | None = None) -> Dict[str, Any]:
+    """Fallback to sequential cascade for chat over the routed models (with the route's web search setting)"""
+    models = route["models"] if route else PARALLEL_MODELS
+    accept = _chat_accept(route)
+    for model in models:
+        try:
+            res = _call("chat", model, messages, 0.6, 600)
+        except deadline.DeadlineExceeded:
+            break
+        except Exception as e:
+            print(f"Chat fallback model {model} failed: {e}")
+            continue
+        if accept(res["content"]):
             res["model_used"] = model
             return res
     # if none acceptable, return last model name with empty content
-    return {"content": "", "model_used": PARALLEL_MODELS[-1]}
+    return {"content": "", "model_used": models[-1]}
+
+_CHAT_SYNTHESIS_SYSTEM = (
+    SYSTEM_HEALTH + " Sen bir chat synthesis uzmanısın. "
+    "Birden fazla AI modelin verdiği yanıtları inceleyip, "
+    "en doğru, yararlı ve tutarlı yanıtı oluştur. "
+    "\n\nKurallar:"
+    "\n1. Kullanıcının sorusuna doğrudan yanıt ver"
+    "\n2. Sağlık/supplement konularında en güvenli bilgiyi ver"
+    "\n3. Çelişkili bilgilerde en muhafazakar yaklaşımı seç"
+    "\n4. Anlaşılır ve samimi Türkçe kullan"
+    "\n5. Off-topic sorularda kibarca reddet"
+    "\n6. Sadece nihai yanıtı döndür, 'Model 1' gibi atıflar yapma"
+)
 
 def build_chat_synthesis_prompt(responses: List[Dict[str, str]], user_question: str) -> List[Dict[str, str]]:
     """Build synthesis prompt for chat responses"""
-    system_prompt = (
-        SYSTEM_HEALTH + " Sen bir chat synthesis uzmanısın. "
-        "Birden fazla AI modelin verdiği yanıtları inceleyip, "
-        "en doğru, yararlı ve tutarlı yanıtı oluştur. "
-        "\n\nKurallar:"
-        "\n1. Kullanıcının sorusuna doğrudan yanıt ver"
-        "\n2. Sağlık/supplement konularında en güvenli bilgiyi ver"
-        "\n3. Çelişkili bilgilerde en muhafazakar yaklaşımı seç"
-        "\n4. Anlaşılır ve samimi Türkçe kullan"
-        "\n5. Off-topic sorularda kibarca reddet"
-        "\n6. Sadece nihai yanıtı döndür, 'Model 1' gibi atıflar yapma"
-    )
-    
     responses_text = f"Kullanıcı sorusu: {user_question}\n\n=== MODEL RESPONSES ===\n"
     for i, resp in enumerate(responses, 1):
         responses_text += f"\nMODEL {i} ({resp['model']}):\n{resp['response']}\n"
@@ -88,7 +161,7 @@ def build_chat_synthesis_prompt(responses: List[Dict[str, str]], user_question:
     responses_text += f"Yukarıdaki yanıtları analiz et ve kullanıcının sorusuna en iyi yanıtı oluştur."
     
     return [
-        {"role": "system", "content": system_prompt},
+        {"role": "system", "content": _CHAT_SYNTHESIS_SYSTEM},
         {"role": "user", "content": responses_text}
     ]
 
@@ -96,62 +169,70 @@ def build_chat_synthesis_prompt(responses: List[Dict[str, str]], user_question:
 def cascade_chat(messages: List[Dict[str, str]]) -> Dict[str, Any]:
     return parallel_chat(messages)
 
-def finalize_text(text: str) -> str:
+_FINALIZE_SYSTEM = (
+    SYSTEM_HEALTH +
+    " Sen Longopass AI'sın. Görevin: Aşağıdaki yanıtı son kontrol et ve gerekirse düzelt."
+    " SADECE KULLANICIYA DOĞRUDAN CEVAP VER. Meta yorumlar (\"yanıt doğru\", \"yeniden düzenlenmiş\" vb.) YAZMA."
+    " Eğer yanıt doğru ve yeterli ise, aynen gönder. Eğer hatalı/eksik ise, düzelt ve temiz yanıt ver."
+    " Off-topic sorularda kibarca reddet. Net, samimi Türkçe kullan."
+)
+
+def finalize_text(text: str, model: str = SYNTHESIS_MODEL) -> str:
+    """Final review pass; returns text unchanged when it no longer fits the deadline or fails"""
+    if not deadline.can_afford("chat_finalize"):
+        return text
     final_messages = [
-        {
-            "role": "system",
-            "content": (
-                SYSTEM_HEALTH +
-                " Sen Longopass AI'sın. Görevin: Aşağıdaki yanıtı son kontrol et ve gerekirse düzelt."
-                " SADECE KULLANICIYA DOĞRUDAN CEVAP VER. Meta yorumlar (\"yanıt doğru\", \"yeniden düzenlenmiş\" vb.) YAZMA."
-                " Eğer yanıt doğru ve yeterli ise, aynen gönder. Eğer hatalı/eksik ise, düzelt ve temiz yanıt ver."
-                " Off-topic sorularda kibarca reddet. Net, samimi Türkçe kullan."
-            ),
-        },
+        {"role": "system", "content": _FINALIZE_SYSTEM},
         {"role": "user", "content": f"Bu yanıtı kontrol et ve kullanıcıya temiz şekilde sun:\n\n{text}"},
     ]
-    final = call_chat_model(SYNTHESIS_MODEL, final_messages, temperature=0.2, max_tokens=800)
-    return final["content"]
+    try:
+        final = _call("chat_finalize", model, final_messages, 0.2, 800)
+    except Exception as e:
+        print(f"Finalize failed: {e}, returning the unreviewed reply")
+        return text
+    return final["content"] or text
+
+_ANALYZE_SCHEMA = (
+    "STRICT JSON ŞEMASI ve ÖRNEK:\n"
+    "{\n"
+    '  "recommendations": [\n'
+    '    {"name": "D Vitamini", "reason": "Eksiklik belirtileri mevcut", "source": "consensus"},\n'
+    '    {"name": "Magnezyum", "reason": "Yorgunluk ve kas krampları için", "source": "consensus"}\n'
+    "  ],\n"
+    '  "analysis": {\n'
+    '    "summary": "D vitamini eksikliği olası, takviye önerilir",\n'
+    '    "key_findings": ["Yorgunluk", "Saç dökülmesi"],\n'
+    '    "risk_level": "düşük"\n'
+    "  }\n"
+    "}\n"
+    "SADECE VE SADECE bu JSON formatında yanıt ver. Hiçbir açıklama, metin ekleme. "
+    "recommendations dizi boş olabilir ama analysis dolu olmalı."
+)
+_ANALYZE_SYSTEM = (SYSTEM_HEALTH + " Sen bir sağlık supplement uzmanısın. Kullanıcı verilerini analiz et ve supplement önerileri yap. SADECE JSON döndür."
+                   "\n\n" + _ANALYZE_SCHEMA)
 
 def build_analyze_prompt(payload: Dict[str, Any]) -> List[Dict[str, str]]:
-    schema = (
-        "STRICT JSON ŞEMASI ve ÖRNEK:\n"
-        "{\n"
-        '  "recommendations": [\n'
-        '    {"name": "D Vitamini", "reason": "Eksiklik belirtileri mevcut", "source": "consensus"},\n'
-        '    {"name": "Magnezyum", "reason": "Yorgunluk ve kas krampları için", "source": "consensus"}\n'
-        "  ],\n"
-        '  "analysis": {\n'
-        '    "summary": "D vitamini eksikliği olası, takviye önerilir",\n'
-        '    "key_findings": ["Yorgunluk", "Saç dökülmesi"],\n'
-        '    "risk_level": "düşük"\n'
-        "  }\n"
-        "}\n"
-        "SADECE VE SADECE bu JSON formatında yanıt ver. Hiçbir açıklama, metin ekleme. "
-        "recommendations dizi boş olabilir ama analysis dolu olmalı."
-    )
-    user = f"Kullanıcı verisi: {payload}"
     return [
-        {"role": "system", "content": SYSTEM_HEALTH + " Sen bir sağlık supplement uzmanısın. Kullanıcı verilerini analiz et ve supplement önerileri yap. SADECE JSON döndür."},
-        {"role": "user", "content": user + "\n\n" + schema}
+        {"role": "system", "content": _ANALYZE_SYSTEM},
+        {"role": "user", "content": f"Kullanıcı verisi: {payload}"}
     ]
 
+_ANALYZE_SYNTHESIS_SYSTEM = (
+    SYSTEM_HEALTH + " Sen bir synthesis uzmanısın. "
+    "Birden fazla AI modelin verdiği analiz sonuçlarını inceleyip, "
+    "en doğru, tutarlı ve faydalı bir FINAL sonuç üret. "
+    "\n\nKurallar:"
+    "\n1. SADECE JSON formatında yanıt ver"
+    "\n2. En tutarlı önerileri birleştir"
+    "\n3. Çelişkili önerilerde en mantıklı olanı seç"
+    "\n4. Analysis kısmını en kapsamlı şekilde yaz"
+    "\n5. Risk level'ı en doğru şekilde değerlendir"
+    "\n6. Tekrarlayan önerileri birleştir"
+    "\n7. ÖNEMLI: Her öneri için 'source' alanı MUTLAKA 'consensus' olmalı"
+)
+
 def build_synthesis_prompt(responses: List[Dict[str, str]]) -> List[Dict[str, str]]:
     """Build prompt for GPT-5 to synthesize multiple model responses"""
-    system_prompt = (
-        SYSTEM_HEALTH + " Sen bir synthesis uzmanısın. "
-        "Birden fazla AI modelin verdiği analiz sonuçlarını inceleyip, "
-        "en doğru, tutarlı ve faydalı bir FINAL sonuç üret. "
-        "\n\nKurallar:"
-        "\n1. SADECE JSON formatında yanıt ver"
-        "\n2. En tutarlı önerileri birleştir"
-        "\n3. Çelişkili önerilerde en mantıklı olanı seç"
-        "\n4. Analysis kısmını en kapsamlı şekilde yaz"
-        "\n5. Risk level'ı en doğru şekilde değerlendir"
-        "\n6. Tekrarlayan önerileri birleştir"
-        "\n7. ÖNEMLI: Her öneri için 'source' alanı MUTLAKA 'consensus' olmalı"
-    )
-    
     # Format all responses for comparison
     responses_text = "\n\n=== MODEL RESPONSES ===\n"
     for i, resp in enumerate(responses, 1):
@@ -164,7 +245,7 @@ def build_synthesis_prompt(responses: List[Dict[str, str]]) -> List[Dict[str, st
     )
     
     return [
-        {"role": "system", "content": system_prompt},
+        {"role": "system", "content": _ANALYZE_SYNTHESIS_SYSTEM},
         {"role": "user", "content": responses_text}
     ]
 
@@ -174,37 +255,19 @@ def parallel_analyze(payload: Dict[str, Any]) -> Dict[str, Any]:
         messages = build_analyze_prompt(payload)
         
         # Step 1: Call multiple models in parallel
-        responses = []
-        with ThreadPoolExecutor(max_workers=len(PARALLEL_MODELS)) as executor:
-            # Submit all model calls simultaneously
-            future_to_model = {
-                executor.submit(call_chat_model, model, messages, 0.3, 1200): model 
-                for model in PARALLEL_MODELS
-            }
-            
-            # Collect valid responses
-            for future in as_completed(future_to_model):
-                model = future_to_model[future]
-                try:
-                    result = future.result()
-                    ok, _ = is_valid_analyze(result["content"])
-                    if ok:
-                        responses.append({
-                            "model": model,
-                            "response": result["content"]
-                        })
-                except Exception as e:
-                    print(f"Model {model} failed: {e}")
-                    continue
+        responses = _fan_out("analyze", PARALLEL_MODELS, messages, 0.3, 1200,
+                             accept=lambda content: is_valid_analyze(content)[0], label="Analyze")
         
         # Step 2: If no valid responses, fallback to single model
         if not responses:
             print("All parallel models failed, falling back to single model")
             return cascade_analyze_fallback(payload)
+        if not deadline.can_afford("analyze_synthesis"):
+            return _first_response(responses)
         
         # Step 3: Synthesize with GPT-5
         synthesis_prompt = build_synthesis_prompt(responses)
-        final_result = call_chat_model(SYNTHESIS_MODEL, synthesis_prompt, temperature=0.1, max_tokens=1500)
+        final_result = _call("analyze_synthesis", SYNTHESIS_MODEL, synthesis_prompt, 0.1, 1500)
         
         final_result["models_used"] = [r["model"] for r in responses]
         final_result["synthesis_model"] = SYNTHESIS_MODEL
@@ -219,12 +282,20 @@ def cascade_analyze_fallback(payload: Dict[str, Any]) -> Dict[str, Any]:
     messages = build_analyze_prompt(payload)
     last = None
     for model in PARALLEL_MODELS:
-        res = call_chat_model(model, messages, temperature=0.3, max_tokens=1200)
+        try:
+            res = _call("analyze", model, messages, 0.3, 1200)
+        except deadline.DeadlineExceeded:
+            break
+        except Exception as e:
+            print(f"Analyze fallback model {model} failed: {e}")
+            continue
         last = res
         ok, _ = is_valid_analyze(res["content"])
         if ok:
             res["model_used"] = model
             return res
+    if last is None:
+        return {"content": "{}", "model_used": "fallback"}
     last["model_used"] = PARALLEL_MODELS[-1]
     return last
 
@@ -232,15 +303,52 @@ def cascade_analyze_fallback(payload: Dict[str, Any]) -> Dict[str, Any]:
 def cascade_analyze(payload: Dict[str, Any]) -> Dict[str, Any]:
     return parallel_analyze(payload)
 
+_FINALIZE_ANALYZE_SYSTEM = SYSTEM_HEALTH + " Bu JSON'u yalnızca tekilleştir, önem sırasına koy ve geçerli JSON olarak geri ver. Yeni öğe ekleme."
+
 def finalize_analyze(json_text: str) -> str:
     # Keep JSON shape; dedupe/order; no new items
     messages = [
-        {"role": "system", "content": SYSTEM_HEALTH + " Bu JSON'u yalnızca tekilleştir, önem sırasına koy ve geçerli JSON olarak geri ver. Yeni öğe ekleme."},
+        {"role": "system", "content": _FINALIZE_ANALYZE_SYSTEM},
         {"role": "user", "content": json_text}
     ]
-    final = call_chat_model(SYNTHESIS_MODEL, messages, temperature=0.0, max_tokens=900)
+    final = _call("analyze_finalize", SYNTHESIS_MODEL, messages, 0.0, 900)
     return final["content"]
 
+_QUIZ_SCHEMA = (
+    "STRICT JSON ŞEMASI - SUPPLEMENT ÖNERİLERİ:\n"
+    "{\n"
+    '  "nutrition_advice": {\n'
+    '    "title": "Beslenme Önerileri",\n'
+    '    "recommendations": ["Öneri 1", "Öneri 2", "Öneri 3"]\n'
+    "  },\n"
+    '  "lifestyle_advice": {\n'
+    '    "title": "Yaşam Tarzı Önerileri",\n'
+    '    "recommendations": ["Öneri 1", "Öneri 2", "Öneri 3"]\n'
+    "  },\n"
+    '  "general_warnings": {\n'
+    '    "title": "Genel Uyarılar",\n'
+    '    "warnings": ["Uyarı 1", "Uyarı 2", "Uyarı 3"]\n'
+    "  },\n"
+    '  "supplement_recommendations": [\n'
+    "    {\n"
+    '      "name": "Vitamin D",\n'
+    '      "description": "Kemik sağlığı, bağışıklık sistemi için önemli",\n'
+    '      "daily_dose": "600-800 IU (doktorunuza danışın)",\n'
+    '      "benefits": ["Kalsiyum emilimini artırır", "Bağışıklık güçlendirir"],\n'
+    '      "warnings": ["Yüksek dozlarda toksik olabilir"],\n'
+    '      "priority": "high"\n'
+    "    }\n"
+    "  ]\n"
+    "}\n\n"
+    "SADECE VE SADECE bu JSON formatında yanıt ver. Hiçbir açıklama, metin ekleme."
+)
+_QUIZ_SYSTEM = (
+    SYSTEM_HEALTH + " Sen bir supplement uzmanısın. "
+    "Kullanıcının quiz cevaplarına göre beslenme önerileri, yaşam tarzı önerileri ve "
+    "uygun supplement önerileri yap. E-ticaret sitesi için ürün önerileri hazırlıyorsun."
+    "\n\n" + _QUIZ_SCHEMA
+)
+
 def build_quiz_prompt(quiz_answers: Dict[str, Any]) -> List[Dict[str, str]]:
     """Build prompt for quiz analysis and supplement recommendations"""
     
@@ -268,108 +376,63 @@ def build_quiz_prompt(quiz_answers: Dict[str, Any]) -> List[Dict[str, str]]:
         profile.append(f"Kullandığı takviyeler: {', '.join(quiz_answers['existing_supplements'])}")
     
     user_profile = "\n".join(profile)
-    
-    schema = (
-        "STRICT JSON ŞEMASI - SUPPLEMENT ÖNERİLERİ:\n"
-        "{\n"
-        '  "nutrition_advice": {\n'
-        '    "title": "Beslenme Önerileri",\n'
-        '    "recommendations": ["Öneri 1", "Öneri 2", "Öneri 3"]\n'
-        "  },\n"
-        '  "lifestyle_advice": {\n'
-        '    "title": "Yaşam Tarzı Önerileri",\n'
-        '    "recommendations": ["Öneri 1", "Öneri 2", "Öneri 3"]\n'
-        "  },\n"
-        '  "general_warnings": {\n'
-        '    "title": "Genel Uyarılar",\n'
-        '    "warnings": ["Uyarı 1", "Uyarı 2", "Uyarı 3"]\n'
-        "  },\n"
-        '  "supplement_recommendations": [\n'
-        "    {\n"
-        '      "name": "Vitamin D",\n'
-        '      "description": "Kemik sağlığı, bağışıklık sistemi için önemli",\n'
-        '      "daily_dose": "600-800 IU (doktorunuza danışın)",\n'
-        '      "benefits": ["Kalsiyum emilimini artırır", "Bağışıklık güçlendirir"],\n'
-        '      "warnings": ["Yüksek dozlarda toksik olabilir"],\n'
-        '      "priority": "high"\n'
-        "    }\n"
-        "  ]\n"
-        "}\n\n"
-        "SADECE VE SADECE bu JSON formatında yanıt ver. Hiçbir açıklama, metin ekleme."
-    )
-    
-    system_prompt = (
-        SYSTEM_HEALTH + " Sen bir supplement uzmanısın. "
-        "Kullanıcının quiz cevaplarına göre beslenme önerileri, yaşam tarzı önerileri ve "
-        "uygun supplement önerileri yap. E-ticaret sitesi için ürün önerileri hazırlıyorsun."
-    )
-    
-    user_prompt = f"Kullanıcı profili:\n{user_profile}\n\n{schema}"
-    
+
     return [
-        {"role": "system", "content": system_prompt},
-        {"role": "user", "content": user_prompt}
+        {"role": "system", "content": _QUIZ_SYSTEM},
+        {"role": "user", "content": f"Kullanıcı profili:\n{user_profile}"}
     ]
 
-def parallel_quiz_analyze(quiz_answers: Dict[str, Any]) -> Dict[str, Any]:
-    """Run quiz analysis with parallel LLMs and synthesis"""
+def parallel_quiz_analyze(quiz_answers: Dict[str, Any], route: Dict[str, Any] | None = None) -> Dict[str, Any]:
+    """Run quiz analysis with the routed LLMs and synthesis"""
+    models = route["models"] if route else PARALLEL_MODELS
+    synthesis_model = route["synthesis_model"] if route else SYNTHESIS_MODEL
     try:
         messages = build_quiz_prompt(quiz_answers)
         
-        # Step 1: Call multiple models in parallel
-        responses = []
-        with ThreadPoolExecutor(max_workers=len(PARALLEL_MODELS)) as executor:
-            future_to_model = {
-                executor.submit(call_chat_model, model, messages, 0.2, 1500): model 
-                for model in PARALLEL_MODELS
-            }
-            
-            for future in as_completed(future_to_model):
-                model = future_to_model[future]
-                try:
-                    result = future.result()
-                    # For quiz, we want any valid JSON response
-                    if result["content"].strip():
-                        responses.append({
-                            "model": model,
-                            "response": result["content"]
-                        })
-                except Exception as e:
-                    print(f"Quiz model {model} failed: {e}")
-                    continue
+        # Step 1: Call the models in parallel; for quiz, we want any valid JSON response
+        responses = _fan_out("quiz", models, messages, 0.2, 1500, label="Quiz")
         
         # Step 2: If no responses, fallback
         if not responses:
             print("All quiz models failed, fallback to single model")
             return quiz_fallback(quiz_answers)
         
-        # Step 3: Synthesize with GPT-5 for quiz
+        # Step 3: If only one response (or a route without synthesis), return it directly
+        if len(responses) == 1 or (route and not route["synthesis"]):
+            return {
+                "content": responses[0]["response"],
+                "model_used": responses[0]["model"]
+            }
+        if not deadline.can_afford("quiz_synthesis"):
+            return _first_response(responses)
+        
+        # Step 4: Synthesize with GPT-5 for quiz
         synthesis_prompt = build_quiz_synthesis_prompt(responses)
-        final_result = call_chat_model(SYNTHESIS_MODEL, synthesis_prompt, temperature=0.1, max_tokens=2000)
+        final_result = _call("quiz_synthesis", synthesis_model, synthesis_prompt, 0.1, 2000)
         
         final_result["models_used"] = [r["model"] for r in responses]
-        final_result["synthesis_model"] = SYNTHESIS_MODEL
+        final_result["synthesis_model"] = synthesis_model
         return final_result
         
     except Exception as e:
         print(f"Quiz parallel analyze failed: {e}")
         return quiz_fallback(quiz_answers)
 
+_QUIZ_SYNTHESIS_SYSTEM = (
+    SYSTEM_HEALTH + " Sen bir synthesis uzmanısın. "
+    "Birden fazla AI modelin verdiği supplement önerilerini inceleyip, "
+    "en doğru, tutarlı ve kullanışlı bir FINAL quiz sonucu üret. "
+    "\n\nKurallar:"
+    "\n1. SADECE JSON formatında yanıt ver"
+    "\n2. En uygun supplement önerilerini birleştir"
+    "\n3. Çelişkili önerilerde en güvenli olanı seç"
+    "\n4. Beslenme ve yaşam tarzı önerilerini de kapsamlı yap"
+    "\n5. Dozaj önerilerinde 'doktorunuza danışın' ekle"
+    "\n6. Priority: high/medium/low olarak belirle"
+)
+
 def build_quiz_synthesis_prompt(responses: List[Dict[str, str]]) -> List[Dict[str, str]]:
     """Build synthesis prompt for quiz recommendations"""
-    system_prompt = (
-        SYSTEM_HEALTH + " Sen bir synthesis uzmanısın. "
-        "Birden fazla AI modelin verdiği supplement önerilerini inceleyip, "
-        "en doğru, tutarlı ve kullanışlı bir FINAL quiz sonucu üret. "
-        "\n\nKurallar:"
-        "\n1. SADECE JSON formatında yanıt ver"
-        "\n2. En uygun supplement önerilerini birleştir"
-        "\n3. Çelişkili önerilerde en güvenli olanı seç"
-        "\n4. Beslenme ve yaşam tarzı önerilerini de kapsamlı yap"
-        "\n5. Dozaj önerilerinde 'doktorunuza danışın' ekle"
-        "\n6. Priority: high/medium/low olarak belirle"
-    )
-    
     responses_text = "\n\n=== MODEL RESPONSES ===\n"
     for i, resp in enumerate(responses, 1):
         responses_text += f"\nMODEL {i} ({resp['model']}):\n{resp['response']}\n"
@@ -381,7 +444,7 @@ def build_quiz_synthesis_prompt(responses: List[Dict[str, str]]) -> List[Dict[st
     )
     
     return [
-        {"role": "system", "content": system_prompt},
+        {"role": "system", "content": _QUIZ_SYNTHESIS_SYSTEM},
         {"role": "user", "content": responses_text}
     ]
 
@@ -390,10 +453,12 @@ def quiz_fallback(quiz_answers: Dict[str, Any]) -> Dict[str, Any]:
     messages = build_quiz_prompt(quiz_answers)
     for model in PARALLEL_MODELS:
         try:
-            res = call_chat_model(model, messages, temperature=0.2, max_tokens=1500)
+            res = _call("quiz", model, messages, 0.2, 1500)
             if res["content"].strip():
                 res["model_used"] = model
                 return res
+        except deadline.DeadlineExceeded:
+            break
         except Exception as e:
             print(f"Quiz fallback model {model} failed: {e}")
             continue
@@ -404,41 +469,89 @@ def quiz_fallback(quiz_answers: Dict[str, Any]) -> Dict[str, Any]:
         "model_used": "fallback"
     }
 
-def build_single_lab_prompt(test_data: Dict[str, Any]) -> List[Dict[str, str]]:
+_SINGLE_LAB_SCHEMA = (
+    "STRICT JSON ŞEMASI - LAB ANALİZİ (SADECE ANALİZ):\n"
+    "{\n"
+    '  "analysis": {\n'
+    '    "summary": "Test sonucunun kısa yorumu",\n'
+    '    "interpretation": "Sonucun anlamı ve önemi",\n'
+    '    "reference_comparison": "Referans aralığı ile karşılaştırma",\n'
+    '    "clinical_significance": "Klinik önemi",\n'
+    '    "follow_up_suggestions": "Takip önerileri (sadece genel tıbbi öneri)"\n'
+    "  }\n"
+    "}\n\n"
+    "SADECE ANALİZ YAP, SUPPLEMENт ÖNERİSİ VERME!"
+)
+_SINGLE_LAB_SYSTEM = (
+    SYSTEM_HEALTH + " Sen bir laboratuvar sonuçları analiz uzmanısın. "
+    "SADECE ANALİZ yap, supplement ya da ilaç önerisi verme. "
+    "Sonuçları yorumla, klinik anlamını açıkla, genel tıbbi takip önerileri ver."
+    "\n\n" + _SINGLE_LAB_SCHEMA
+)
+
+def build_single_lab_prompt(test_data: Dict[str, Any], assessment: Dict[str, Any] | None = None) -> List[Dict[str, str]]:
     """Build prompt for single lab test analysis (analysis only, no recommendations)"""
     
     test_info = f"Test Adı: {test_data.get('name', 'Bilinmiyor')}\n"
     test_info += f"Sonuç: {test_data.get('value', 'Yok')} {test_data.get('unit', '')}\n"
     if test_data.get('reference_range'):
         test_info += f"Referans Aralığı: {test_data['reference_range']}\n"
-    
-    schema = (
-        "STRICT JSON ŞEMASI - LAB ANALİZİ (SADECE ANALİZ):\n"
-        "{\n"
-        '  "analysis": {\n'
-        '    "summary": "Test sonucunun kısa yorumu",\n'
-        '    "interpretation": "Sonucun anlamı ve önemi",\n'
-        '    "reference_comparison": "Referans aralığı ile karşılaştırma",\n'
-        '    "clinical_significance": "Klinik önemi",\n'
-        '    "follow_up_suggestions": "Takip önerileri (sadece genel tıbbi öneri)"\n'
-        "  }\n"
-        "}\n\n"
-        "SADECE ANALİZ YAP, SUPPLEMENт ÖNERİSİ VERME!"
-    )
-    
-    system_prompt = (
-        SYSTEM_HEALTH + " Sen bir laboratuvar sonuçları analiz uzmanısın. "
-        "SADECE ANALİZ yap, supplement ya da ilaç önerisi verme. "
-        "Sonuçları yorumla, klinik anlamını açıkla, genel tıbbi takip önerileri ver."
-    )
-    
-    user_prompt = f"Laboratuvar test sonucu:\n{test_info}\n\n{schema}"
-    
+    if assessment and assessment.get("status") != "unknown":
+        test_info += describe_assessment(assessment) + "\n"
+
     return [
-        {"role": "system", "content": system_prompt},
-        {"role": "user", "content": user_prompt}
+        {"role": "system", "content": _SINGLE_LAB_SYSTEM},
+        {"role": "user", "content": f"Laboratuvar test sonucu:\n{test_info}"}
     ]
 
+_MULTIPLE_LAB_SCHEMA = (
+    "STRICT JSON ŞEMASI - KAPSAMLI LAB ANALİZİ:\n"
+    "{\n"
+    '  "general_assessment": {\n'
+    '    "overall_summary": "Tüm test sonuçlarının genel yorumu",\n'
+    '    "patterns_identified": "Tespit edilen paternler ve eğilimler",\n'
+    '    "areas_of_concern": "Dikkat edilmesi gereken alanlar",\n'
+    '    "positive_aspects": "Olumlu sonuçlar",\n'
+    '    "metabolic_status": "Metabolik durum değerlendirmesi",\n'
+    '    "nutritional_status": "Beslenme durumu"\n'
+    "  },\n"
+    '  "overall_status": "normal/dikkat_edilmeli/kritik",\n'
+    '  "lifestyle_recommendations": {\n'
+    '    "exercise": ["Egzersiz önerileri"],\n'
+    '    "nutrition": ["Beslenme önerileri"],\n'
+    '    "sleep": ["Uyku önerileri"],\n'
+    '    "stress_management": ["Stres yönetimi önerileri"]\n'
+    "  },\n"
+    '  "supplement_recommendations": [\n'
+    '    {\n'
+    '    "name": "Supplement adı",\n'
+    '    "description": "Neden önerildiği",\n'
+    '    "daily_dose": "Günlük doz",\n'
+    '    "benefits": ["Faydaları"],\n'
+    '    "warnings": ["Uyarılar"],\n'
+    '    "priority": "high/medium/low"\n'
+    '    }\n'
+    "  ],\n"
+    '  "test_details": {\n'
+    '    "test_name": {\n'
+    '    "interpretation": "Test yorumu",\n'
+    '    "significance": "Önemi",\n'
+    '    "suggestions": "Öneriler"\n'
+    '    }\n'
+    "  }\n"
+    "}\n\n"
+    "ÖNEMLİ: Lab sonuçlarına göre günlük hayat önerileri ve supplement önerileri ver!"
+)
+_MULTIPLE_LAB_SYSTEM = (
+    SYSTEM_HEALTH + " Sen bir laboratuvar sonuçları ve sağlık danışmanlığı uzmanısın. "
+    "Birden fazla test sonucunu analiz et, genel sağlık durumunu değerlendir. "
+    "Günlük hayat için pratik öneriler ver (egzersiz, beslenme, uyku, stres yönetimi). "
+    "Eksik değerler için uygun supplement önerileri yap. "
+    "Her test için detaylı yorum ekle. "
+    "Tıbbi tanı koyma, sadece bilgilendirme amaçlı öneriler ver."
+    "\n\n" + _MULTIPLE_LAB_SCHEMA
+)
+
 def build_multiple_lab_prompt(tests_data: List[Dict[str, Any]], session_count: int) -> List[Dict[str, str]]:
     """Build prompt for multiple lab tests general summary"""
     
@@ -449,94 +562,28 @@ def build_multiple_lab_prompt(tests_data: List[Dict[str, Any]], session_count: i
         if test.get('reference_range'):
             tests_info += f" (Referans: {test['reference_range']})"
         tests_info += "\n"
-    
-    schema = (
-        "STRICT JSON ŞEMASI - KAPSAMLI LAB ANALİZİ:\n"
-        "{\n"
-        '  "general_assessment": {\n'
-        '    "overall_summary": "Tüm test sonuçlarının genel yorumu",\n'
-        '    "patterns_identified": "Tespit edilen paternler ve eğilimler",\n'
-        '    "areas_of_concern": "Dikkat edilmesi gereken alanlar",\n'
-        '    "positive_aspects": "Olumlu sonuçlar",\n'
-        '    "metabolic_status": "Metabolik durum değerlendirmesi",\n'
-        '    "nutritional_status": "Beslenme durumu"\n'
-        "  },\n"
-        '  "overall_status": "normal/dikkat_edilmeli/kritik",\n'
-        '  "lifestyle_recommendations": {\n'
-        '    "exercise": ["Egzersiz önerileri"],\n'
-        '    "nutrition": ["Beslenme önerileri"],\n'
-        '    "sleep": ["Uyku önerileri"],\n'
-        '    "stress_management": ["Stres yönetimi önerileri"]\n'
-        "  },\n"
-        '  "supplement_recommendations": [\n'
-        '    {\n'
-        '    "name": "Supplement adı",\n'
-        '    "description": "Neden önerildiği",\n'
- '    "daily_dose": "Günlük doz",\n'
-        '    "benefits": ["Faydaları"],\n'
-        '    "warnings": ["Uyarılar"],\n'
-        '    "priority": "high/medium/low"\n'
-        '    }\n'
-        "  ],\n"
-        '  "test_details": {\n'
-        '    "test_name": {\n'
-        '    "interpretation": "Test yorumu",\n'
-        '    "significance": "Önemi",\n'
-        '    "suggestions": "Öneriler"\n'
-        '    }\n'
-        "  }\n"
-        "}\n\n"
-        "ÖNEMLİ: Lab sonuçlarına göre günlük hayat önerileri ve supplement önerileri ver!"
-    )
-    
-    system_prompt = (
-        SYSTEM_HEALTH + " Sen bir laboratuvar sonuçları ve sağlık danışmanlığı uzmanısın. "
-        "Birden fazla test sonucunu analiz et, genel sağlık durumunu değerlendir. "
-        "Günlük hayat için pratik öneriler ver (egzersiz, beslenme, uyku, stres yönetimi). "
-        "Eksik değerler için uygun supplement önerileri yap. "
-        "Her test için detaylı yorum ekle. "
-        "Tıbbi tanı koyma, sadece bilgilendirme amaçlı öneriler ver."
-    )
-    
-    user_prompt = f"Laboratuvar test sonuçları:\n{tests_info}\n\n{schema}"
-    
+
     return [
-        {"role": "system", "content": system_prompt},
-        {"role": "user", "content": user_prompt}
+        {"role": "system", "content": _MULTIPLE_LAB_SYSTEM},
+        {"role": "user", "content": f"Laboratuvar test sonuçları:\n{tests_info}"}
     ]
 
-def parallel_single_lab_analyze(test_data: Dict[str, Any]) -> Dict[str, Any]:
+def parallel_single_lab_analyze(test_data: Dict[str, Any], assessment: Dict[str, Any] | None = None) -> Dict[str, Any]:
     """Analyze single lab test with parallel LLMs"""
     try:
-        messages = build_single_lab_prompt(test_data)
+        messages = build_single_lab_prompt(test_data, assessment)
         
         # Parallel analysis
-        responses = []
-        with ThreadPoolExecutor(max_workers=len(PARALLEL_MODELS)) as executor:
-            future_to_model = {
-                executor.submit(call_chat_model, model, messages, 0.3, 1200): model 
-                for model in PARALLEL_MODELS
-            }
-            
-            for future in as_completed(future_to_model):
-                model = future_to_model[future]
-                try:
-                    result = future.result()
-                    if result["content"].strip():
-                        responses.append({
-                            "model": model,
-                            "response": result["content"]
-                        })
-                except Exception as e:
-                    print(f"Single lab model {model} failed: {e}")
-                    continue
+        responses = _fan_out("single_lab", PARALLEL_MODELS, messages, 0.3, 1200, label="Single lab")
         
         if not responses:
             return single_lab_fallback(test_data)
+        if not deadline.can_afford("single_lab_synthesis"):
+            return _first_response(responses)
         
         # Synthesis
         synthesis_prompt = build_lab_synthesis_prompt(responses, "single")
-        final_result = call_chat_model(SYNTHESIS_MODEL, synthesis_prompt, temperature=0.1, max_tokens=1500)
+        final_result = _call("single_lab_synthesis", SYNTHESIS_MODEL, synthesis_prompt, 0.1, 1500)
         
         final_result["models_used"] = [r["model"] for r in responses]
         return final_result
@@ -547,36 +594,22 @@ def parallel_single_lab_analyze(test_data: Dict[str, Any]) -> Dict[str, Any]:
 
 def parallel_multiple_lab_analyze(tests_data: List[Dict[str, Any]], session_count: int) -> Dict[str, Any]:
     """Analyze multiple lab tests for general summary"""
+    if len(tests_data) >= LAB_CHUNK_MIN_TESTS:
+        return chunked_multiple_lab_analyze(tests_data, session_count)
     try:
         messages = build_multiple_lab_prompt(tests_data, session_count)
         
         # Parallel analysis
-        responses = []
-        with ThreadPoolExecutor(max_workers=len(PARALLEL_MODELS)) as executor:
-            future_to_model = {
-                executor.submit(call_chat_model, model, messages, 0.3, 1500): model 
-                for model in PARALLEL_MODELS
-            }
-            
-            for future in as_completed(future_to_model):
-                model = future_to_model[future]
-                try:
-                    result = future.result()
-                    if result["content"].strip():
-                        responses.append({
-                            "model": model,
-                            "response": result["content"]
-                        })
-                except Exception as e:
-                    print(f"Multiple lab model {model} failed: {e}")
-                    continue
+        responses = _fan_out("multiple_lab", PARALLEL_MODELS, messages, 0.3, 1500, label="Multiple lab")
         
         if not responses:
             return multiple_lab_fallback(tests_data, session_count)
+        if not deadline.can_afford("multiple_lab_synthesis"):
+            return _first_response(responses)
         
         # Synthesis
         synthesis_prompt = build_lab_synthesis_prompt(responses, "multiple")
-        final_result = call_chat_model(SYNTHESIS_MODEL, synthesis_prompt, temperature=0.1, max_tokens=2500)
+        final_result = _call("multiple_lab_synthesis", SYNTHESIS_MODEL, synthesis_prompt, 0.1, 2500)
         
         final_result["models_used"] = [r["model"] for r in responses]
         return final_result
@@ -585,35 +618,294 @@ def parallel_multiple_lab_analyze(tests_data: List[Dict[str, Any]], session_coun
         print(f"Multiple lab analyze failed: {e}")
         return multiple_lab_fallback(tests_data, session_count)
 
+# ---------- Map-reduce lab summaries for large panels ----------
+
+# Keywords are matched against test names folded by normalize_text(); short codes must match a whole token
+LAB_PANELS = {
+    "lipid": ["kolesterol", "cholesterol", "ldl", "hdl", "vldl", "trigliserid", "triglyceride", "lipoprotein", "apo"],
+    "thyroid": ["tsh", "t3", "t4", "ft3", "ft4", "tiroid", "thyroid", "tpo", "tiroglobulin"],
+    "glucose": ["glukoz", "glucose", "hba1c", "insulin", "homa", "seker"],
+    "hemogram": ["hemoglobin", "hgb", "hematokrit", "hct", "wbc", "rbc", "lokosit", "eritrosit", "trombosit",
+                 "plt", "mcv", "mch", "mchc", "rdw", "mpv", "notrofil", "lenfosit", "monosit", "eozinofil", "bazofil"],
+    "vitamins_minerals": ["vitamin", "vit", "b12", "d3", "folat", "folik", "ferritin", "demir", "iron", "tibc",
+                          "magnezyum", "magnesium", "cinko", "zinc", "kalsiyum", "calcium", "fosfor", "selenyum"],
+    "liver": ["alt", "ast", "ggt", "alp", "bilirubin", "albumin", "sgot", "sgpt", "karaciger"],
+    "kidney": ["kreatinin", "creatinine", "ure", "bun", "urik", "egfr", "sodyum", "potasyum", "klor", "bobrek"],
+    "inflammation": ["crp", "sedimantasyon", "esr", "homosistein", "fibrinojen"],
+    "hormones": ["testosteron", "testosterone", "estradiol", "kortizol", "cortisol", "prolaktin", "fsh", "lh",
+                 "dhea", "progesteron", "amh"],
+}
+_STATUS_RANK = {"normal": 0, "dikkat_edilmeli": 1, "kritik": 2}
+# lab_engine's deterministic status, for stored details that carry none
+_LOCAL_STATUS = {"normal": "normal", "low": "dikkat_edilmeli", "high": "dikkat_edilmeli"}
+
+def _lab_panel_of(test_name: str) -> str:
+    name = normalize_text(test_name)
+    tokens = set(re.findall(r"[a-z0-9]+", name))
+    for panel, keywords in LAB_PANELS.items():
+        for kw in keywords:
+            if kw in tokens or (len(kw) > 4 and kw in name):
+                return panel
+    return "other"
+
+def group_lab_tests(tests_data: List[Dict[str, Any]]) -> Dict[str, List[Dict[str, Any]]]:
+    """Group tests by panel; oversized panels are split so every map prompt stays small"""
+    panels: Dict[str, List[Dict[str, Any]]] = {}
+    for test in tests_data:
+        panels.setdefault(_lab_panel_of(test.get("name", "")), []).append(test)
+    groups = {}
+    for panel, tests in panels.items():
+        if len(tests) <= LAB_GROUP_MAX_TESTS:
+            groups[panel] = tests
+            continue
+        for i in range(0, len(tests), LAB_GROUP_MAX_TESTS):
+            groups[f"{panel}_{i // LAB_GROUP_MAX_TESTS + 1}"] = tests[i:i + LAB_GROUP_MAX_TESTS]
+    return groups
+
+def _format_lab_line(test: Dict[str, Any]) -> str:
+    line = f"{test.get('name', 'Test')}: {test.get('value', 'Yok')} {test.get('unit', '')}".rstrip()
+    if test.get('reference_range'):
+        line += f" (Referans: {test['reference_range']})"
+    return line
+
+_LAB_GROUP_SCHEMA = (
+    "STRICT JSON ŞEMASI - PANEL ANALİZİ:\n"
+    "{\n"
+    '  "test_details": {\n'
+    '    "test_name": {\n'
+    '      "interpretation": "Test yorumu (1-2 cümle)",\n'
+    '      "significance": "Önemi (1 cümle)",\n'
+    '      "suggestions": "Öneriler (1 cümle)",\n'
+    '      "status": "normal/dikkat_edilmeli/kritik"\n'
+    "    }\n"
+    "  },\n"
+    '  "group_summary": "Bu panelin 1-2 cümlelik özeti",\n'
+    '  "group_status": "normal/dikkat_edilmeli/kritik",\n'
+    '  "concerns": ["Dikkat gerektiren bulgular"]\n'
+    "}\n\n"
+    "test_details anahtarları test adlarıyla birebir aynı olmalı. SADECE JSON döndür, kısa ve öz yaz."
+)
+_LAB_GROUP_SYSTEM = (
+    SYSTEM_HEALTH + " Sen bir laboratuvar sonuçları analiz uzmanısın. "
+    "Sana yalnızca tek bir test paneli veriliyor; sadece bu testleri yorumla. "
+    "Tıbbi tanı koyma, sadece bilgilendirme amaçlı yorum yap."
+    "\n\n" + _LAB_GROUP_SCHEMA
+)
+
+def build_lab_group_prompt(panel: str, tests: List[Dict[str, Any]]) -> List[Dict[str, str]]:
+    """Map step: interpret one panel group only"""
+    tests_info = "\n".join(f"- {_format_lab_line(t)}" for t in tests)
+    return [
+        {"role": "system", "content": _LAB_GROUP_SYSTEM},
+        {"role": "user", "content": f"Panel: {panel}\nTest Sonuçları:\n{tests_info}"}
+    ]
+
+_LAB_REDUCE_SCHEMA = (
+    "STRICT JSON ŞEMASI - GENEL DEĞERLENDİRME:\n"
+    "{\n"
+    '  "general_assessment": {\n'
+    '    "overall_summary": "Tüm test sonuçlarının genel yorumu",\n'
+    '    "patterns_identified": "Tespit edilen paternler ve eğilimler",\n'
+    '    "areas_of_concern": "Dikkat edilmesi gereken alanlar",\n'
+    '    "positive_aspects": "Olumlu sonuçlar",\n'
+    '    "metabolic_status": "Metabolik durum değerlendirmesi",\n'
+    '    "nutritional_status": "Beslenme durumu"\n'
+    "  },\n"
+    '  "overall_status": "normal/dikkat_edilmeli/kritik",\n'
+    '  "lifestyle_recommendations": {\n'
+    '    "exercise": ["Egzersiz önerileri"],\n'
+    '    "nutrition": ["Beslenme önerileri"],\n'
+    '    "sleep": ["Uyku önerileri"],\n'
+    '    "stress_management": ["Stres yönetimi önerileri"]\n'
+    "  },\n"
+    '  "supplement_recommendations": [\n'
+    "    {\n"
+    '      "name": "Supplement adı",\n'
+    '      "description": "Neden önerildiği",\n'
+    '      "daily_dose": "Günlük doz",\n'
+    '      "benefits": ["Faydaları"],\n'
+    '      "warnings": ["Uyarılar"],\n'
+    '      "priority": "high/medium/low"\n'
+    "    }\n"
+    "  ]\n"
+    "}\n\n"
+    "test_details ÜRETME, sadece bu JSON'u döndür."
+)
+_LAB_REDUCE_SYSTEM = (
+    SYSTEM_HEALTH + " Sen bir laboratuvar sonuçları ve sağlık danışmanlığı uzmanısın. "
+    "Panel bazında hazırlanmış özetleri birleştirip genel sağlık durumunu değerlendir. "
+    "Günlük hayat için pratik öneriler ve eksik değerler için supplement önerileri ver. "
+    "Tıbbi tanı koyma, sadece bilgilendirme amaçlı öneriler ver."
+    "\n\n" + _LAB_REDUCE_SCHEMA
+)
+
+def build_lab_reduce_prompt(group_results: Dict[str, Dict[str, Any]], tests_data: List[Dict[str, Any]],
+                            session_count: int) -> List[Dict[str, str]]:
+    """Reduce step: only panel summaries go in, so the prompt stays small for large panels"""
+    summary_text = f"Toplam Test Seansı: {session_count}\nToplam Test: {len(tests_data)}\n\n=== PANEL ÖZETLERİ ===\n"
+    for panel, result in group_results.items():
+        summary_text += f"\n[{panel}] durum: {result.get('group_status', 'bilinmiyor')}\n"
+        summary_text += f"Özet: {result.get('group_summary', '')}\n"
+        concerns = result.get("concerns") or []
+        if concerns:
+            summary_text += "Dikkat: " + "; ".join(str(c) for c in concerns) + "\n"
+    return [
+        {"role": "system", "content": _LAB_REDUCE_SYSTEM},
+        {"role": "user", "content": summary_text}
+    ]
+
+def _analyze_lab_group(panel: str, tests: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Map step for one group; tries LAB_MAP_MODEL first, then the parallel models"""
+    messages = build_lab_group_prompt(panel, tests)
+    max_tokens = min(300 + 160 * len(tests), 2000)
+    for model in [LAB_MAP_MODEL] + PARALLEL_MODELS:
+        try:
+            res = _call("lab_group", model, messages, 0.2, max_tokens, units=len(tests))
+            data = parse_json_safe(res["content"])
+            if isinstance(data, dict) and isinstance(data.get("test_details"), dict):
+                data["model"] = model
+                return data
+        except deadline.DeadlineExceeded:
+            break
+        except Exception as e:
+            print(f"Lab group {panel} model {model} failed: {e}")
+            continue
+    return {}
+
+def _map_lab_groups(tests_data: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    groups = group_lab_tests(tests_data)
+    group_results: Dict[str, Dict[str, Any]] = {}
+    if not groups:
+        return group_results
+    executor = ThreadPoolExecutor(max_workers=len(groups))
+    try:
+        future_to_panel = {
+            deadline.submit(executor, _analyze_lab_group, panel, tests): panel
+            for panel, tests in groups.items()
+        }
+        for future in _completed(future_to_panel):
+            panel = future_to_panel[future]
+            result = future.result()
+            if result:
+                group_results[panel] = result
+    finally:
+        executor.shutdown(wait=False)
+    return group_results
+
+def _reduce_lab_groups(group_results: Dict[str, Dict[str, Any]], tests_data: List[Dict[str, Any]],
+                       session_count: int, test_details: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
+    worst = max((r.get("group_status", "normal") for r in group_results.values()),
+                key=lambda s: _STATUS_RANK.get(s, 0))
+    data: Dict[str, Any] = {}
+    if deadline.can_afford("lab_reduce"):
+        try:
+            reduce_prompt = build_lab_reduce_prompt(group_results, tests_data, session_count)
+            reduced = _call("lab_reduce", SYNTHESIS_MODEL, reduce_prompt, 0.1, 1200)
+            data = parse_json_safe(reduced["content"]) or {}
+        except Exception as e:
+            print(f"Lab reduce step failed: {e}")
+
+    if not data:
+        # Degrade to the map output alone rather than failing the whole summary
+        data = {
+            "general_assessment": {
+                "overall_summary": " ".join(r.get("group_summary", "") for r in group_results.values()).strip(),
+                "areas_of_concern": [c for r in group_results.values() for c in (r.get("concerns") or [])],
+            },
+            "overall_status": worst,
+        }
+    data["test_details"] = test_details
+    return {
+        "content": json.dumps(data, ensure_ascii=False),
+        "model_used": SYNTHESIS_MODEL,
+        "models_used": sorted({r["model"] for r in group_results.values() if r.get("model")}),
+        "lab_groups": list(group_results.keys()),
+    }
+
+def _collect_test_details(group_results: Dict[str, Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    test_details: Dict[str, Dict[str, Any]] = {}
+    for result in group_results.values():
+        for name, detail in result.get("test_details", {}).items():
+            if isinstance(detail, dict):
+                test_details[name] = detail
+    return test_details
+
+def chunked_multiple_lab_analyze(tests_data: List[Dict[str, Any]], session_count: int) -> Dict[str, Any]:
+    """Map-reduce summary: panel groups are analyzed concurrently, then one small reduce call
+    produces general_assessment/overall_status. Latency follows the largest group."""
+    group_results = _map_lab_groups(tests_data)
+    if not group_results:
+        print("All lab groups failed, fallback to multiple lab fallback")
+        return multiple_lab_fallback(tests_data, session_count)
+    return _reduce_lab_groups(group_results, tests_data, session_count, _collect_test_details(group_results))
+
+def _cached_group(cached_details: Dict[str, Dict[str, Any]], tests_data: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Pre-summarized group for the unchanged tests. Its status is the worst of their stored
+    statuses (or lab_engine's, for details stored without one), so a cached critical result
+    still counts in overall_status."""
+    tests_by_name = {t.get("name"): t for t in tests_data}
+    statuses, concerns = [], []
+    for name, detail in cached_details.items():
+        status = detail.get("status")
+        if status not in _STATUS_RANK and name in tests_by_name:
+            status = _LOCAL_STATUS.get(evaluate_test(tests_by_name[name])["status"])
+        if status is None:
+            continue
+        statuses.append(status)
+        if status != "normal":
+            concerns.append(f"{name}: {str(detail.get('significance') or detail.get('interpretation', ''))[:160]}")
+    group = {
+        "group_summary": " ".join(
+            f"{name}: {str(detail.get('interpretation', ''))[:160]}" for name, detail in cached_details.items()
+        ),
+        "concerns": concerns,
+    }
+    if statuses:
+        group["group_status"] = max(statuses, key=_STATUS_RANK.get)
+    return group
+
+def incremental_multiple_lab_analyze(changed_tests: List[Dict[str, Any]], cached_details: Dict[str, Dict[str, Any]],
+                                     tests_data: List[Dict[str, Any]], session_count: int) -> Dict[str, Any]:
+    """Only new/changed tests go through the map step; unchanged tests reuse their stored
+    interpretation and enter the reduce step as one pre-summarized group."""
+    group_results = _map_lab_groups(changed_tests)
+    if changed_tests and not group_results:
+        print("All lab groups failed for changed tests, fallback to multiple lab fallback")
+        return multiple_lab_fallback(tests_data, session_count)
+    if cached_details:
+        group_results["onceki_sonuclar"] = _cached_group(cached_details, tests_data)
+    test_details = dict(cached_details)
+    test_details.update(_collect_test_details(group_results))
+    return _reduce_lab_groups(group_results, tests_data, session_count, test_details)
+
+_LAB_SYNTHESIS_SYSTEM = {
+    "single": (
+        SYSTEM_HEALTH + " Sen bir laboratuvar analizi synthesis uzmanısın. "
+        "Birden fazla AI modelin verdiği tek test analizlerini inceleyip, "
+        "en doğru ve kapsamlı analizi üret. "
+        "\n\nKurallar:"
+        "\n1. SADECE JSON formatında yanıt ver"
+        "\n2. SADECE ANALİZ yap, supplement/ilaç önerisi verme"
+        "\n3. En doğru ve tutarlı yorumu birleştir"
+        "\n4. Klinik anlamı net açıkla"
+        "\n5. Genel tıbbi takip önerileri ver"
+    ),
+    "multiple": (
+        SYSTEM_HEALTH + " Sen bir laboratuvar analizi ve sağlık danışmanlığı synthesis uzmanısın. "
+        "Birden fazla AI modelin verdiği genel lab analizlerini inceleyip, "
+        "en doğru ve kapsamlı analizi üret. "
+        "\n\nKurallar:"
+        "\n1. SADECE JSON formatında yanıt ver"
+        "\n2. Genel sağlık durumu değerlendirmesi yap"
+        "\n3. Günlük hayat önerileri ver (egzersiz, beslenme, uyku, stres)"
+        "\n4. Eksik değerler için supplement önerileri yap"
+        "\n5. Her test için detaylı yorum ekle"
+        "\n6. Tıbbi tanı koyma, sadece bilgilendirme amaçlı öneriler ver"
+    ),
+}
+
 def build_lab_synthesis_prompt(responses: List[Dict[str, str]], analysis_type: str) -> List[Dict[str, str]]:
     """Build synthesis prompt for lab analysis"""
-    
-    if analysis_type == "single":
-        system_prompt = (
-            SYSTEM_HEALTH + " Sen bir laboratuvar analizi synthesis uzmanısın. "
-            "Birden fazla AI modelin verdiği tek test analizlerini inceleyip, "
-            "en doğru ve kapsamlı analizi üret. "
-            "\n\nKurallar:"
-            "\n1. SADECE JSON formatında yanıt ver"
-            "\n2. SADECE ANALİZ yap, supplement/ilaç önerisi verme"
-            "\n3. En doğru ve tutarlı yorumu birleştir"
-            "\n4. Klinik anlamı net açıkla"
-            "\n5. Genel tıbbi takip önerileri ver"
-        )
-    else:  # multiple
-        system_prompt = (
-            SYSTEM_HEALTH + " Sen bir laboratuvar analizi ve sağlık danışmanlığı synthesis uzmanısın. "
-            "Birden fazla AI modelin verdiği genel lab analizlerini inceleyip, "
-            "en doğru ve kapsamlı analizi üret. "
-            "\n\nKurallar:"
-            "\n1. SADECE JSON formatında yanıt ver"
-            "\n2. Genel sağlık durumu değerlendirmesi yap"
-            "\n3. Günlük hayat önerileri ver (egzersiz, beslenme, uyku, stres)"
-            "\n4. Eksik değerler için supplement önerileri yap"
-            "\n5. Her test için detaylı yorum ekle"
-            "\n6. Tıbbi tanı koyma, sadece bilgilendirme amaçlı öneriler ver"
-        )
-    
     responses_text = "\n\n=== MODEL RESPONSES ===\n"
     for i, resp in enumerate(responses, 1):
         responses_text += f"\nMODEL {i} ({resp['model']}):\n{resp['response']}\n"
@@ -623,7 +915,7 @@ def build_lab_synthesis_prompt(responses: List[Dict[str, str]], analysis_type: s
     responses_text += f"Yukarıdaki {task_desc} sonuçlarını analiz et ve en iyi laboratuvar yorumu oluştur."
     
     return [
-        {"role": "system", "content": system_prompt},
+        {"role": "system", "content": _LAB_SYNTHESIS_SYSTEM["single" if analysis_type == "single" else "multiple"]},
         {"role": "user", "content": responses_text}
     ]
 
@@ -0,0 +1,73 @@
+"""Structured guard for quiz and lab payloads.
+
+guard_or_message() on a serialized payload sends the whole JSON to the moderation model in
+topic mode, although most fields are enumerations or numbers. Here enumerated quiz fields are
+checked against QUIZ_ENUMS, lab values and ranges are parsed, known test names are resolved
+through the lab index, and only the remaining free text is scanned with local rules. The
+regular guard (and with it the LLM classifier) runs only on items that look suspicious.
+"""
+import re
+from typing import Dict, Any, List, Tuple
+from .health_guard import DENY_KEYWORDS, guard_or_message
+from .utils import normalize_text
+from .lab_engine import canonical_test, parse_value, parse_range
+from .quiz_cache import QUIZ_ENUMS, QUIZ_LIST_FIELDS
+
+# Free-text items are short labels ("laktoz", "kas_kazanma", "Omega 3"); sentences, links,
+# markup or instructions to the model are not
+MAX_PLAIN_CHARS = 60
+MAX_PLAIN_WORDS = 6
+_INJECTION = re.compile(r"https?://|www\.|```|<\s*/?[a-z]|[{}]|ignore|instruction|prompt|talimat|yoksay|gorevin")
+
+def is_suspicious(text: str) -> bool:
+    t = normalize_text(text).strip()
+    if any(k in t for k in DENY_KEYWORDS) or _INJECTION.search(t):
+        return True
+    return len(t) > MAX_PLAIN_CHARS or len(t.split()) > MAX_PLAIN_WORDS
+
+def _guard_free_text(items: List[str]) -> Tuple[bool, str]:
+    flagged = [item for item in items if item and is_suspicious(item)]
+    if not flagged:
+        return True, ""
+    return guard_or_message("\n".join(flagged))
+
+def guard_quiz(answers: Dict[str, Any]) -> Tuple[bool, str]:
+    free_text = []
+    for field, allowed in QUIZ_ENUMS.items():
+        value = answers.get(field)
+        if value not in allowed:
+            free_text.append(str(value or ""))
+    for field in QUIZ_LIST_FIELDS:
+        free_text.extend(str(v) for v in answers.get(field) or [])
+    return _guard_free_text(free_text)
+
+def _lab_free_text(test: Dict[str, Any]) -> List[str]:
+    free_text = [str(test.get("unit") or "")]
+    name = str(test.get("name") or "")
+    if canonical_test(name) is None:
+        free_text.append(name)
+    if parse_value(test.get("value")) is None:
+        free_text.append(str(test.get("value") or ""))
+    reference_range = test.get("reference_range")
+    if reference_range and parse_range(str(reference_range)) is None:
+        free_text.append(str(reference_range))
+    return free_text
+
+def guard_lab_tests(tests: List[Dict[str, Any]]) -> Tuple[bool, str]:
+    free_text = []
+    for test in tests:
+        free_text.extend(_lab_free_text(test))
+    return _guard_free_text(free_text)
+
+def guard_lab_results(results: List[Any]) -> Tuple[bool, str]:
+    """Legacy /ai/lab/analyze payload: dicts of arbitrary shape"""
+    free_text = []
+    for item in results:
+        if not isinstance(item, dict):
+            free_text.append(str(item))
+            continue
+        if "name" in item:
+            free_text.extend(_lab_free_text(item))
+        free_text.extend(str(v) for k, v in item.items()
+                         if k not in ("name", "value", "unit", "reference_range") and isinstance(v, str))
+    return _guard_free_text(free_text)
@@ -0,0 +1,84 @@
+import json
+import time
+from typing import Dict, Any
+from sqlalchemy.orm import Session
+from .config import LAB_TEMPLATE_NORMAL
+from .db import Message
+from .payload_guard import guard_quiz, guard_lab_tests
+from .orchestrator import parallel_quiz_analyze, parallel_single_lab_analyze
+from .routing import route_quiz
+from .quiz_cache import profile_key as quiz_profile_key, lookup as quiz_cache_lookup, store as quiz_cache_store, record_profile as record_quiz_profile, is_cacheable_result
+from .lab_engine import evaluate_test, templated_interpretation, result_cache_key as lab_cache_key, cache_get as lab_cache_get, cache_set as lab_cache_set
+from .utils import parse_json_safe
+from .deadline import cancelled as request_cancelled
+
+class GuardRejected(Exception):
+    """Raised when the health guard refuses the input; args[0] is the user-facing message"""
+
+def run_quiz(db: Session, user_id: int, quiz_dict: Dict[str, Any], plan: str = "premium") -> Dict[str, Any]:
+    """Quiz pipeline shared by /ai/quiz and the batch API"""
+    key = quiz_profile_key(quiz_dict)
+    start = time.time()
+
+    # Precomputed index first: common answer profiles are answered without any LLM call
+    final_json = quiz_cache_lookup(db, key) if key else None
+    route_label = "cache"
+    if final_json is None:
+        # Enum fields are validated locally; only suspicious free text reaches the moderation model
+        ok, msg = guard_quiz(quiz_dict)
+        if not ok:
+            raise GuardRejected(msg)
+
+        # Use parallel quiz analysis with the routed profile
+        route = route_quiz(quiz_dict, plan)
+        route_label = route["label"]
+        res = parallel_quiz_analyze(quiz_dict, route)
+        final_json = res["content"]
+        if request_cancelled():
+            return parse_json_safe(final_json) or {}
+        # Only full-ensemble results go into the shared index
+        if key and route["name"] == "full" and not res.get("degraded") and is_cacheable_result(final_json):
+            quiz_cache_store(db, key, quiz_dict, final_json)
+    if key:
+        record_quiz_profile(db, key, quiz_dict)
+    data = parse_json_safe(final_json) or {}
+
+    # Store quiz result
+    db.add(Message(user_id=user_id, conversation_id=None, role="assistant", content=final_json, model_name="quiz",
+                   model_latency_ms=int((time.time() - start) * 1000), route_profile=route_label))
+    db.commit()
+    return data
+
+def run_single_lab(db: Session, user_id: int, test_dict: Dict[str, Any]) -> Dict[str, Any]:
+    """Single lab pipeline shared by /ai/lab/single and the batch API"""
+    assessment = evaluate_test(test_dict)
+
+    # Recognized, in-range results are served from a template without any LLM round trip
+    if LAB_TEMPLATE_NORMAL and assessment["test_key"] and assessment["status"] == "normal":
+        data = templated_interpretation(assessment)
+        db.add(Message(user_id=user_id, conversation_id=None, role="assistant",
+                       content=json.dumps(data, ensure_ascii=False), model_name="single_lab"))
+        db.commit()
+        return data
+
+    cache_key = lab_cache_key(assessment, test_dict)
+    final_json = lab_cache_get(cache_key)
+    if final_json is None:
+        # Structured guard: only suspicious free text reaches the moderation model
+        ok, msg = guard_lab_tests([test_dict])
+        if not ok:
+            raise GuardRejected(msg)
+
+        # Use parallel single lab analysis
+        res = parallel_single_lab_analyze(test_dict, assessment)
+        final_json = res["content"]
+        if request_cancelled():
+            return parse_json_safe(final_json) or {}
+        if res.get("model_used") != "fallback" and not res.get("degraded"):
+            lab_cache_set(cache_key, final_json)
+    data = parse_json_safe(final_json) or {}
+
+    # Store single lab analysis
+    db.add(Message(user_id=user_id, conversation_id=None, role="assistant", content=final_json, model_name="single_lab"))
+    db.commit()
+    return data
@@ -0,0 +1,194 @@
+"""Opt-in profiling: sampled request stacks, tracemalloc diffs and thread/task dumps.
+
+A fraction (PROFILE_SAMPLE_RATE, changeable at runtime via /admin/profile/config) of HTTP
+requests is profiled by a statistical sampler thread that reads sys._current_frames() every
+PROFILE_INTERVAL_MS. Stacks running the request's endpoint are aggregated per endpoint and
+written as collapsed stacks ("frame;frame;frame count", usable with flamegraph.pl or
+speedscope) to PROFILE_DIR. Other busy threads (model fan-out workers) are recorded under
+"_other". With the rate at 0 the middleware costs one comparison per request and no thread runs.
+"""
+import asyncio
+import inspect
+import os
+import random
+import re
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from typing import Dict, Any, List, Optional, Tuple
+from starlette.routing import Match
+from .config import PROFILE_SAMPLE_RATE, PROFILE_INTERVAL_MS, PROFILE_DIR
+
+OTHER = "_other"
+MAX_DEPTH = 64
+# A thread whose innermost Python frame is in one of these is idle
+_IDLE_FILES = ("threading.py", "selectors.py", "queue.py", os.path.join("concurrent", "futures", "thread.py"))
+
+sample_rate = PROFILE_SAMPLE_RATE
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+class Sampler:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.active: Dict[int, Tuple[str, Any]] = {}  # request token -> (endpoint label, endpoint code)
+        self.stacks: Dict[str, Counter] = {}
+        self.thread: Optional[threading.Thread] = None
+        self.next_token = 0
+
+    def begin(self, label: str, code) -> int:
+        with self.lock:
+            token = self.next_token
+            self.next_token += 1
+            self.active[token] = (label, code)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="profile-sampler", daemon=True)
+                self.thread.start()
+        return token
+
+    def end(self, token: int):
+        with self.lock:
+            label, _ = self.active.pop(token)
+            counts = dict(self.stacks.get(label, {}))
+        if counts:
+            _write_collapsed(label, counts)
+
+    def _run(self):
+        me = threading.get_ident()
+        interval = PROFILE_INTERVAL_MS / 1000
+        while True:
+            with self.lock:
+                if not self.active:
+                    self.thread = None
+                    return
+                codes = {code: label for label, code in self.active.values()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                self._sample(frame, codes)
+            time.sleep(interval)
+
+    def _sample(self, frame, codes: Dict[Any, str]):
+        leaf_file = frame.f_code.co_filename
+        if any(leaf_file.endswith(f) for f in _IDLE_FILES):
+            return
+        labels, owner = [], None
+        while frame is not None and len(labels) < MAX_DEPTH:
+            labels.append(_frame_label(frame))
+            if owner is None:
+                owner = codes.get(frame.f_code)
+            frame = frame.f_back
+        stack = ";".join(reversed(labels))
+        with self.lock:
+            self.stacks.setdefault(owner or OTHER, Counter())[stack] += 1
+
+    def snapshot(self) -> Dict[str, Dict[str, int]]:
+        with self.lock:
+            return {label: dict(c) for label, c in self.stacks.items()}
+
+    def reset(self):
+        with self.lock:
+            self.stacks.clear()
+
+sampler = Sampler()
+
+def _file_name(label: str) -> str:
+    return re.sub(r"[^A-Za-z0-9_.-]+", "_", label).strip("_") + ".collapsed"
+
+def _write_collapsed(label: str, counts: Dict[str, int]):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = os.path.join(PROFILE_DIR, _file_name(label))
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        for stack, n in sorted(counts.items(), key=lambda kv: -kv[1]):
+            f.write(f"{stack} {n}\n")
+    os.replace(tmp, path)
+
+def collapsed(label: str) -> str:
+    counts = sampler.snapshot().get(label, {})
+    return "".join(f"{stack} {n}\n" for stack, n in sorted(counts.items(), key=lambda kv: -kv[1]))
+
+def _endpoint_of(scope) -> Tuple[Optional[str], Any]:
+    for route in scope["app"].routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL and hasattr(route, "endpoint"):
+            return f"{scope['method']} {route.path}", inspect.unwrap(route.endpoint).__code__
+    return None, None
+
+class ProfilerMiddleware:
+    """Pure ASGI middleware: only sampled requests pay for route lookup and the sampler thread"""
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not sample_rate or random.random() >= sample_rate:
+            return await self.app(scope, receive, send)
+        label, code = _endpoint_of(scope)
+        if label is None or label.split(" ", 1)[1].startswith("/admin"):
+            return await self.app(scope, receive, send)
+        token = sampler.begin(label, code)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            sampler.end(token)
+
+# ---------- tracemalloc ----------
+
+_baseline: Optional[tracemalloc.Snapshot] = None
+
+def tracemalloc_start(nframes: int = 10):
+    global _baseline
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(nframes)
+    _baseline = tracemalloc.take_snapshot()
+
+def tracemalloc_stop():
+    global _baseline
+    tracemalloc.stop()
+    _baseline = None
+
+def tracemalloc_diff(limit: int = 25, group_by: str = "lineno") -> Dict[str, Any]:
+    """Top allocation growth since the previous snapshot; the new snapshot becomes the baseline"""
+    global _baseline
+    if not tracemalloc.is_tracing():
+        return {"tracing": False}
+    snapshot = tracemalloc.take_snapshot().filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    ])
+    stats = snapshot.compare_to(_baseline, group_by) if _baseline else snapshot.statistics(group_by)
+    _baseline = snapshot
+    current, peak = tracemalloc.get_traced_memory()
+    return {
+        "tracing": True,
+        "current_bytes": current,
+        "peak_bytes": peak,
+        "top": [{"where": str(s.traceback), "size_bytes": s.size, "size_diff_bytes": getattr(s, "size_diff", s.size),
+                 "count": s.count, "count_diff": getattr(s, "count_diff", s.count)} for s in stats[:limit]],
+    }
+
+# ---------- thread / task dumps ----------
+
+def thread_dump() -> List[Dict[str, Any]]:
+    frames = sys._current_frames()
+    dump = []
+    for t in threading.enumerate():
+        frame = frames.get(t.ident)
+        stack = []
+        while frame is not None and len(stack) < MAX_DEPTH:
+            stack.append(f"{frame.f_code.co_filename}:{frame.f_lineno} {frame.f_code.co_name}")
+            frame = frame.f_back
+        dump.append({"name": t.name, "ident": t.ident, "daemon": t.daemon, "stack": list(reversed(stack))})
+    return dump
+
+def task_dump() -> List[Dict[str, Any]]:
+    """asyncio tasks of the running loop; call from the event loop"""
+    dump = []
+    for task in asyncio.all_tasks():
+        stack = [f"{f.f_code.co_filename}:{f.f_lineno} {f.f_code.co_name}" for f in task.get_stack(limit=MAX_DEPTH)]
+        dump.append({"name": task.get_name(), "done": task.done(), "coro": repr(task.get_coro()), "stack": stack})
+    return dump
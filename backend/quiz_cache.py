@@ -0,0 +1,119 @@
+import datetime
+import hashlib
+import heapq
+import math
+from typing import Dict, Any, List, Optional
+from sqlalchemy import func, or_
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import Session
+from .config import QUIZ_CACHE_TTL_DAYS
+from .db import QuizProfile
+from .utils import normalize_text, parse_json_safe
+
+# Documented values of the enumerated QuizAnswers fields (see schemas.QuizAnswers)
+QUIZ_ENUMS: Dict[str, List[str]] = {
+    "age_range": ["18-25", "26-35", "36-45", "46-55", "56-65", "65+"],
+    "gender": ["erkek", "kadın", "belirtmek_istemiyorum"],
+    "sleep_pattern": ["düzenli", "düzensiz", "uyku_sorunu_var"],
+    "sleep_hours": ["4_saatten_az", "4-6_saat", "6-8_saat", "8_saatten_fazla"],
+    "nutrition_type": ["vejetaryen", "vegan", "karışık", "glutensiz", "özel_diyet"],
+    "exercise_frequency": ["hiç", "haftada_1-2", "haftada_3-4", "günlük"],
+    "stress_level": ["düşük", "orta", "yüksek", "çok_yüksek"],
+}
+QUIZ_LIST_FIELDS = ["allergies", "health_goals", "existing_supplements"]
+
+def profile_key(answers: Dict[str, Any]) -> Optional[str]:
+    """Stable key for an answer profile; None if an enum field is outside its documented values"""
+    parts = []
+    for field, allowed in QUIZ_ENUMS.items():
+        value = answers.get(field)
+        if value not in allowed:
+            return None
+        parts.append(f"{field}={value}")
+    for field in QUIZ_LIST_FIELDS:
+        items = sorted({normalize_text(str(i)).strip() for i in answers.get(field) or [] if str(i).strip()})
+        parts.append(f"{field}={','.join(items)}")
+    return hashlib.sha256("|".join(parts).encode("utf-8")).hexdigest()
+
+def _is_fresh(row: QuizProfile) -> bool:
+    if not row.content or not row.generated_at:
+        return False
+    return datetime.datetime.utcnow() - row.generated_at < datetime.timedelta(days=QUIZ_CACHE_TTL_DAYS)
+
+def lookup(db: Session, key: str) -> Optional[str]:
+    row = db.query(QuizProfile).filter(QuizProfile.profile_key == key).first()
+    if row and _is_fresh(row):
+        return row.content
+    return None
+
+# Upserts on the unique profile_key, so concurrent requests (and workers) never race on the insert
+
+def record_profile(db: Session, key: str, answers: Dict[str, Any]):
+    """Count a submission so the precompute job can mine the most frequent profiles"""
+    now = datetime.datetime.utcnow()
+    db.execute(insert(QuizProfile)
+               .values(profile_key=key, answers=answers, hits=1, last_seen_at=now)
+               .on_conflict_do_update(index_elements=["profile_key"],
+                                      set_={"hits": func.coalesce(QuizProfile.hits, 0) + 1, "last_seen_at": now}))
+    db.commit()
+
+def store(db: Session, key: str, answers: Dict[str, Any], content: str):
+    now = datetime.datetime.utcnow()
+    db.execute(insert(QuizProfile)
+               .values(profile_key=key, answers=answers, hits=0, content=content, generated_at=now)
+               .on_conflict_do_update(index_elements=["profile_key"], set_={"content": content, "generated_at": now}))
+    db.commit()
+
+def top_profiles(db: Session, limit: int) -> List[Dict[str, Any]]:
+    """Most frequent submitted profiles whose precomputed result is missing or stale"""
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=QUIZ_CACHE_TTL_DAYS)
+    rows = (db.query(QuizProfile.answers)
+            .filter(QuizProfile.hits > 0,
+                    or_(QuizProfile.content.is_(None), QuizProfile.content == "",
+                        QuizProfile.generated_at.is_(None), QuizProfile.generated_at <= cutoff))
+            .order_by(QuizProfile.hits.desc())
+            .limit(limit).all())
+    return [answers for (answers,) in rows]
+
+def _value_weights(db: Session) -> Dict[str, List[tuple]]:
+    """Per enum field, (log share of submissions, value) sorted from most to least common.
+    Add-one smoothing keeps values nobody has submitted yet in the ranking."""
+    weights = {}
+    for field, allowed in QUIZ_ENUMS.items():
+        value = func.json_extract(QuizProfile.answers, f"$.{field}")
+        counts = dict(db.query(value, func.sum(QuizProfile.hits)).group_by(value).all())
+        total = sum(counts.get(v) or 0 for v in allowed) + len(allowed)
+        weights[field] = sorted(((math.log(((counts.get(v) or 0) + 1) / total), v) for v in allowed),
+                                key=lambda w: -w[0])
+    return weights
+
+def enumerate_profiles(db: Session, limit: int) -> List[Dict[str, Any]]:
+    """The limit most likely enum combinations, with empty free-text lists.
+
+    Each field's values are weighted by how often they were submitted and combinations are
+    ranked by the product of those shares (best-first over the sorted value lists), so rare
+    combinations come last. With no submissions every combination ranks the same.
+    """
+    weights = _value_weights(db)
+    fields = list(QUIZ_ENUMS)
+
+    def score(idx):
+        return sum(weights[f][i][0] for f, i in zip(fields, idx))
+
+    start = (0,) * len(fields)
+    heap, seen, profiles = [(-score(start), start)], {start}, []
+    while heap and len(profiles) < limit:
+        _, idx = heapq.heappop(heap)
+        answers = {f: weights[f][i][1] for f, i in zip(fields, idx)}
+        answers.update({f: [] for f in QUIZ_LIST_FIELDS})
+        profiles.append(answers)
+        for pos in range(len(fields)):
+            nxt = idx[:pos] + (idx[pos] + 1,) + idx[pos + 1:]
+            if nxt[pos] < len(weights[fields[pos]]) and nxt not in seen:
+                seen.add(nxt)
+                heapq.heappush(heap, (-score(nxt), nxt))
+    return profiles
+
+def is_cacheable_result(content: str) -> bool:
+    data = parse_json_safe(content or "")
+    return isinstance(data, dict) and "error" not in data and "supplement_recommendations" in data
@@ -0,0 +1,88 @@
+"""Warm the quiz cache offline.
+
+Usage:
+    python -m backend.quiz_precompute --limit 200
+    python -m backend.quiz_precompute --enumerate --limit 500 --workers 2 --rps 0.5
+"""
+import argparse
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, Any
+from .config import QUIZ_PRECOMPUTE_WORKERS, QUIZ_PRECOMPUTE_RPS
+from .db import init_db, SessionLocal
+from .orchestrator import parallel_quiz_analyze
+from .quiz_cache import profile_key, top_profiles, enumerate_profiles, store, lookup, is_cacheable_result
+
+class RateLimiter:
+    """Spaces job starts at least 1/rps seconds apart across all workers"""
+    def __init__(self, rps: float):
+        self.interval = 1.0 / rps if rps > 0 else 0.0
+        self.lock = threading.Lock()
+        self.next_at = 0.0
+
+    def wait(self):
+        with self.lock:
+            now = time.time()
+            start = max(now, self.next_at)
+            self.next_at = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+def _generate(answers: Dict[str, Any], limiter: RateLimiter) -> bool:
+    key = profile_key(answers)
+    if not key:
+        return False
+    db = SessionLocal()
+    try:
+        if lookup(db, key):
+            return False
+        limiter.wait()
+        res = parallel_quiz_analyze(answers)
+        if not is_cacheable_result(res["content"]):
+            return False
+        store(db, key, answers, res["content"])
+        return True
+    finally:
+        db.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Precompute quiz recommendations for common answer profiles")
+    parser.add_argument("--limit", type=int, default=100, help="number of profiles to generate")
+    parser.add_argument("--enumerate", action="store_true",
+                        help="also fill with the enum combinations most likely given the submitted answers")
+    parser.add_argument("--workers", type=int, default=QUIZ_PRECOMPUTE_WORKERS)
+    parser.add_argument("--rps", type=float, default=QUIZ_PRECOMPUTE_RPS, help="max profile generations started per second")
+    args = parser.parse_args()
+
+    init_db()
+    db = SessionLocal()
+    try:
+        profiles = top_profiles(db, args.limit)
+        if args.enumerate and len(profiles) < args.limit:
+            seen = {profile_key(p) for p in profiles}
+            for p in enumerate_profiles(db, args.limit * 4):
+                if len(profiles) >= args.limit:
+                    break
+                if profile_key(p) not in seen:
+                    profiles.append(p)
+    finally:
+        db.close()
+
+    print(f"Precomputing {len(profiles)} quiz profiles with {args.workers} workers at {args.rps} rps")
+    limiter = RateLimiter(args.rps)
+    done = failed = 0
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=max(1, args.workers)) as executor:
+        futures = [executor.submit(_generate, p, limiter) for p in profiles]
+        for future in as_completed(futures):
+            try:
+                if future.result():
+                    done += 1
+            except Exception as e:
+                failed += 1
+                print(f"Quiz precompute failed: {e}")
+    print(f"Generated {done} profiles, {failed} failed in {time.time() - start:.1f}s")
+
+if __name__ == "__main__":
+    main()
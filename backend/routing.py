@@ -0,0 +1,72 @@
+"""Choose a pipeline profile for a request before any model is called.
+
+Messages that are nothing but greetings, thanks or acknowledgements go to a single fast model; ordinary questions to two models plus
+synthesis; long, multi-part or risky questions (interactions, dosage, pregnancy, chronic
+conditions) from premium users to the full ensemble. `:online` web search is kept only when
+the message asks for current information.
+"""
+import re
+from typing import Dict, Any
+from .config import ROUTING_ENABLED, ROUTE_PROFILES, ROUTE_SHORT_CHARS, ROUTE_LONG_CHARS, SYNTHESIS_MODEL
+from .health_guard import has_health_signal
+from .utils import normalize_text
+
+# Keywords are matched against text folded by normalize_text(); SMALL_TALK as whole words
+SMALL_TALK = ["merhaba", "merhabalar", "selam", "selamlar", "gunaydin", "iyi gunler", "iyi aksamlar", "iyi geceler",
+              "tesekkur", "tesekkurler", "tesekkur ederim", "tesekkur ederiz", "sagol", "sagolun", "sagolasin",
+              "eyvallah", "tamam", "tamamdir", "peki", "anladim", "gorusuruz", "hosca kal", "hoscakal",
+              "hello", "hi", "thanks", "thank you", "ok", "okey"]
+# Words that may accompany small talk without making it a question
+SMALL_TALK_FILLER = {"cok", "size", "sana", "siz", "sen", "hocam", "evet", "hayir", "oldu", "super",
+                     "harika", "o", "zaman", "de", "da", "her", "sey", "icin", "nasilsin", "nasilsiniz"}
+_SMALL_TALK = re.compile(r"\b(?:" + "|".join(re.escape(k) for k in sorted(SMALL_TALK, key=len, reverse=True)) + r")\b")
+COMPLEX_INTENTS = ["etkilesim", "birlikte kullan", "beraber kullan", "doz", "hamile", "gebe", "emzir", "bebek",
+                   "cocug", "ilac", "kronik", "yan etki", "tahlil", "sonuc", "referans", "bobrek", "karaciger",
+                   "kalp", "tansiyon", "diyabet", "seker hastal", "tiroid", "kanser", "ameliyat"]
+SEARCH_INTENTS = ["guncel", "son arastirma", "yeni arastirma", "son calisma", "yeni calisma", "arastirmalar",
+                  "kaynak", "haber", "fda", "onay", "piyasa", "fiyat", "2024", "2025", "2026"]
+ONLINE_SUFFIX = ":online"
+
+def strip_online(model: str) -> str:
+    return model[:-len(ONLINE_SUFFIX)] if model.endswith(ONLINE_SUFFIX) else model
+
+def profile(name: str, online: bool) -> Dict[str, Any]:
+    """Resolved profile: models and synthesis model with or without web search"""
+    spec = ROUTE_PROFILES[name]
+    adjust = (lambda m: m) if online else strip_online
+    return {
+        "name": name,
+        "label": f"{name}{ONLINE_SUFFIX}" if online else name,
+        "models": [adjust(m) for m in spec["models"]],
+        "synthesis_model": adjust(spec.get("synthesis_model", SYNTHESIS_MODEL)),
+        "synthesis": spec.get("synthesis", True),
+        "finalize": spec.get("finalize", True),
+        "validate": spec.get("validate", True),
+    }
+
+def is_small_talk(t: str) -> bool:
+    """Only greetings, thanks and filler words, with no health keyword, symptom or dose in the folded text t"""
+    if not _SMALL_TALK.search(t):
+        return False
+    rest = re.findall(r"[a-z0-9]+", _SMALL_TALK.sub(" ", t))
+    return all(tok in SMALL_TALK_FILLER for tok in rest) and not has_health_signal(t)
+
+def route_chat(text: str, plan: str) -> Dict[str, Any]:
+    if not ROUTING_ENABLED:
+        return profile("full", online=True)
+    t = normalize_text(text).strip()
+    online = any(k in t for k in SEARCH_INTENTS)
+    complex_intent = any(k in t for k in COMPLEX_INTENTS)
+    if len(t) <= ROUTE_SHORT_CHARS and "?" not in t and not complex_intent and is_small_talk(t):
+        return profile("fast", online=False)
+    multi_part = t.count("?") > 1 or len(re.findall(r"\b(?:ve|ayrica|bir de)\b", t)) > 2
+    if plan == "premium" and (complex_intent or multi_part or len(t) >= ROUTE_LONG_CHARS):
+        return profile("full", online)
+    return profile("dual", online)
+
+def route_quiz(answers: Dict[str, Any], plan: str) -> Dict[str, Any]:
+    """Quiz prompts need no web search; existing supplements or allergies raise interaction risk"""
+    if not ROUTING_ENABLED:
+        return profile("full", online=True)
+    risky = bool(answers.get("existing_supplements") or answers.get("allergies"))
+    return profile("full" if plan == "premium" or risky else "dual", online=False)
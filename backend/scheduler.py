@@ -0,0 +1,194 @@
+"""Priority classes and weighted fair queuing for upstream call slots.
+
+Each request is put in a class when it enters an endpoint (classify(): plan, endpoint and origin,
+see SCHED_CLASSES). The class lives in a contextvar, so fan-out workers started through
+deadline.submit() inherit it. Upstream calls without a class (moderation batches, debug
+endpoints) use SCHED_DEFAULT_CLASS.
+
+At most SCHED_UPSTREAM_SLOTS upstream calls run at once. When all slots are taken, callers
+queue and free slots go to the waiter with the smallest virtual finish tag: a class with
+weight w advances its tag by 1/w per call, so under contention classes get slots in proportion
+to their weights and a burst in one class cannot starve the others. A class with queue_limit
+calls already waiting rejects new requests at the endpoint (503) and new calls with QueueFull.
+Queue waits are recorded per class as histograms, see stats().
+"""
+import contextvars
+import heapq
+import itertools
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import Dict, Any, Optional
+from .config import SCHED_UPSTREAM_SLOTS, SCHED_CLASSES, SCHED_DEFAULT_CLASS, SCHED_MAX_WAIT_S
+from . import deadline
+
+CANCEL_POLL_S = 0.2
+# Upper bounds (ms) of the queue-wait histogram buckets; the last bucket is open-ended
+WAIT_BUCKETS_MS = [1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+
+class QueueFull(RuntimeError):
+    """The class already has queue_limit upstream calls waiting"""
+
+class QueueTimeout(TimeoutError):
+    """No upstream slot became free within the request's remaining time"""
+
+_current: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("priority_class", default=None)
+
+def classify(plan: Optional[str], endpoint: str, origin: str = "api") -> str:
+    if origin == "batch" or endpoint == "batch":
+        return "batch"
+    if plan == "premium":
+        return "premium_chat" if endpoint == "chat" else "premium"
+    return "free"
+
+def current_class() -> str:
+    return _current.get() or SCHED_DEFAULT_CLASS
+
+def set_class(cls: str) -> contextvars.Token:
+    return _current.set(cls)
+
+def reset_class(token: contextvars.Token):
+    _current.reset(token)
+
+class _Waiter:
+    __slots__ = ("cls", "event", "granted", "cancelled")
+
+    def __init__(self, cls: str):
+        self.cls = cls
+        self.event = threading.Event()
+        self.granted = False
+        self.cancelled = False
+
+class Scheduler:
+    def __init__(self, slots: int, classes: Dict[str, Dict[str, Any]]):
+        self.slots = slots
+        self.classes = classes
+        self.free = slots
+        self.lock = threading.Lock()
+        self.heap: list = []  # (finish tag, seq, waiter)
+        self.seq = itertools.count()
+        self.virtual = 0.0
+        self.last_finish: Dict[str, float] = {}
+        self.queued: Counter = Counter()
+        self.running: Counter = Counter()
+        self.rejected: Counter = Counter()
+        self.timeouts: Counter = Counter()
+        self.waits: Dict[str, list] = {}
+        self.wait_ms: Counter = Counter()
+
+    def _config(self, cls: str) -> Dict[str, Any]:
+        return self.classes.get(cls) or self.classes.get(SCHED_DEFAULT_CLASS) or {"weight": 1, "queue_limit": 0}
+
+    def is_full(self, cls: str) -> bool:
+        limit = self._config(cls).get("queue_limit", 0)
+        with self.lock:
+            return bool(limit) and self.queued[cls] >= limit
+
+    def _record_wait(self, cls: str, ms: float):
+        hist = self.waits.setdefault(cls, [0] * (len(WAIT_BUCKETS_MS) + 1))
+        i = next((i for i, bound in enumerate(WAIT_BUCKETS_MS) if ms <= bound), len(WAIT_BUCKETS_MS))
+        hist[i] += 1
+        self.wait_ms[cls] += ms
+
+    def acquire(self, cls: str, timeout: float, cancelled: Optional[threading.Event] = None):
+        start = time.monotonic()
+        with self.lock:
+            if self.free > 0:
+                # Slots are only left free when no live waiter is queued
+                self.heap.clear()
+                self.free -= 1
+                self.running[cls] += 1
+                self._record_wait(cls, 0.0)
+                return
+            config = self._config(cls)
+            if config.get("queue_limit") and self.queued[cls] >= config["queue_limit"]:
+                self.rejected[cls] += 1
+                raise QueueFull(f"{cls} queue is full ({self.queued[cls]} waiting)")
+            tag = max(self.virtual, self.last_finish.get(cls, 0.0)) + 1.0 / max(config.get("weight", 1), 0.001)
+            self.last_finish[cls] = tag
+            waiter = _Waiter(cls)
+            heapq.heappush(self.heap, (tag, next(self.seq), waiter))
+            self.queued[cls] += 1
+        end = start + timeout
+        # Wake up periodically so a disconnected client's call leaves the queue early
+        while not waiter.event.wait(min(CANCEL_POLL_S, max(end - time.monotonic(), 0.0))):
+            if time.monotonic() >= end or (cancelled is not None and cancelled.is_set()):
+                break
+        with self.lock:
+            if not waiter.granted:
+                # Left in the heap; release() skips cancelled waiters
+                waiter.cancelled = True
+                self.queued[cls] -= 1
+                self.timeouts[cls] += 1
+                raise QueueTimeout(f"no upstream slot for {cls} within {timeout:.1f}s")
+            self._record_wait(cls, (time.monotonic() - start) * 1000)
+
+    def release(self, cls: str):
+        with self.lock:
+            self.running[cls] -= 1
+            while self.heap:
+                tag, _, waiter = heapq.heappop(self.heap)
+                if waiter.cancelled:
+                    continue
+                self.virtual = tag
+                waiter.granted = True
+                self.queued[waiter.cls] -= 1
+                self.running[waiter.cls] += 1
+                waiter.event.set()
+                return
+            self.free += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            classes = {}
+            for cls in sorted(set(self.classes) | set(self.waits)):
+                hist = self.waits.get(cls, [0] * (len(WAIT_BUCKETS_MS) + 1))
+                n = sum(hist)
+                classes[cls] = {
+                    **self._config(cls),
+                    "running": self.running[cls],
+                    "queued": self.queued[cls],
+                    "rejected": self.rejected[cls],
+                    "timeouts": self.timeouts[cls],
+                    "calls": n,
+                    "avg_wait_ms": round(self.wait_ms[cls] / n, 1) if n else None,
+                    "wait_histogram_ms": {f"<={b}": c for b, c in zip(WAIT_BUCKETS_MS, hist)} | {f">{WAIT_BUCKETS_MS[-1]}": hist[-1]},
+                }
+            return {"slots": self.slots, "free": self.free, "classes": classes}
+
+scheduler = Scheduler(SCHED_UPSTREAM_SLOTS, SCHED_CLASSES)
+
+def enter(plan: Optional[str], endpoint: str, origin: str = "api") -> str:
+    """Set the request's class; raises QueueFull when that class is already backed up"""
+    cls = classify(plan, endpoint, origin)
+    _current.set(cls)
+    if SCHED_UPSTREAM_SLOTS and scheduler.is_full(cls):
+        with scheduler.lock:
+            scheduler.rejected[cls] += 1
+        raise QueueFull(f"{cls} queue is full")
+    return cls
+
+@contextmanager
+def upstream_slot():
+    """Hold one upstream call slot for the current class; waits at most the remaining deadline"""
+    if not SCHED_UPSTREAM_SLOTS:
+        yield
+        return
+    cls = current_class()
+    d = deadline.current()
+    if d is not None and d.cancelled.is_set():
+        deadline.record_saved("upstream_calls_saved")
+        raise deadline.RequestCancelled("client disconnected")
+    timeout = max(d.remaining_s(), 0.0) if d else SCHED_MAX_WAIT_S
+    try:
+        scheduler.acquire(cls, timeout, d.cancelled if d else None)
+    except QueueTimeout:
+        if d is not None and d.cancelled.is_set():
+            deadline.record_saved("upstream_calls_saved")
+            raise deadline.RequestCancelled("client disconnected")
+        raise
+    try:
+        yield
+    finally:
+        scheduler.release(cls)
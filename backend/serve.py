@@ -0,0 +1,179 @@
+"""Pre-fork supervisor: several uvicorn workers behind one listening socket.
+
+    python -m backend.serve [--workers N] [--host 0.0.0.0] [--port 8000]
+
+The socket is bound here and handed to every worker; the kernel spreads connections between
+them. Workers are started with "spawn" and import the app themselves, so upstream connections,
+thread pools and in-process caches are per worker. State the workers must agree on goes through
+shared_state (SHARED_STATE_BACKEND=auto switches to SQLite with more than one worker). The
+scheduler's SCHED_UPSTREAM_SLOTS applies per worker. Recording a cassette
+(OPENROUTER_CASSETTE_MODE=record) is refused with more than one worker.
+
+The first worker of a generation starts alone, so only it runs the schema migration in the
+startup hook; the others follow once it is serving.
+
+Signals:
+    HUP        graceful reload: start a new generation with freshly imported code, wait until
+               it serves, then stop the old workers, which finish in-flight requests (up to
+               WEB_GRACEFUL_TIMEOUT_S). If the new generation fails to start, the old one stays.
+    TERM, INT  graceful shutdown
+A worker that exits unexpectedly is replaced.
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import signal
+import socket
+import time
+from typing import List, Tuple
+from .config import WEB_WORKERS, WEB_GRACEFUL_TIMEOUT_S, OPENROUTER_CASSETTE_MODE
+
+READY_TIMEOUT_S = 60
+POLL_S = 0.5
+
+def cpu_count() -> int:
+    """CPUs this process may use: affinity mask, capped by a cgroup v2 CPU quota (containers)"""
+    n = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+    try:
+        with open("/sys/fs/cgroup/cpu.max", encoding="utf-8") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            n = min(n, max(1, int(int(quota) / int(period))))
+    except (OSError, ValueError):
+        pass
+    return n
+
+def _run_worker(sock: socket.socket, ready, log_level: str):
+    import uvicorn
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    config = uvicorn.Config("backend.main:app", log_level=log_level,
+                            timeout_graceful_shutdown=WEB_GRACEFUL_TIMEOUT_S)
+    server = uvicorn.Server(config)
+
+    async def serve():
+        task = asyncio.create_task(server.serve(sockets=[sock]))
+        while not server.started and not task.done():
+            await asyncio.sleep(0.05)
+        if server.started:
+            ready.set()
+        await task
+
+    asyncio.run(serve())
+
+class Supervisor:
+    def __init__(self, sock: socket.socket, workers: int, log_level: str):
+        self.sock = sock
+        self.count = workers
+        self.log_level = log_level
+        self.ctx = multiprocessing.get_context("spawn")
+        self.workers: List[Tuple[multiprocessing.Process, object]] = []
+        self.reload_requested = False
+        self.stopping = False
+
+    def _spawn(self):
+        ready = self.ctx.Event()
+        p = self.ctx.Process(target=_run_worker, args=(self.sock, ready, self.log_level), name="web-worker")
+        p.start()
+        return p, ready
+
+    def _wait_ready(self, worker, until: float) -> bool:
+        p, ready = worker
+        while time.time() < until and not self.stopping:
+            if ready.wait(POLL_S):
+                return True
+            if p.exitcode is not None:
+                return False
+        return False
+
+    def _generation(self) -> List[Tuple[multiprocessing.Process, object]]:
+        """Start count workers, the first one alone; returns [] if they do not all come up"""
+        until = time.time() + READY_TIMEOUT_S
+        first = self._spawn()
+        workers = [first]
+        if self._wait_ready(first, until):
+            workers += [self._spawn() for _ in range(self.count - 1)]
+            if all(self._wait_ready(w, until) for w in workers[1:]):
+                return workers
+        self._stop(workers)
+        return []
+
+    def _stop(self, workers):
+        for p, _ in workers:
+            if p.exitcode is None:
+                p.terminate()  # SIGTERM: uvicorn stops accepting and drains in-flight requests
+        until = time.time() + WEB_GRACEFUL_TIMEOUT_S + 5
+        for p, _ in workers:
+            p.join(max(until - time.time(), 0.1))
+            if p.exitcode is None:
+                p.kill()
+                p.join()
+
+    def reload(self):
+        started = time.time()
+        new = self._generation()
+        if not new:
+            print("Supervisor: new workers failed to start, keeping the running ones")
+            return
+        old, self.workers = self.workers, new
+        print(f"Supervisor: {len(new)} new workers serving after {int((time.time() - started) * 1000)} ms, "
+              f"stopping {len(old)} old ones")
+        self._stop(old)
+
+    def run(self):
+        self.workers = self._generation()
+        if not self.workers:
+            raise SystemExit("Supervisor: workers failed to start")
+        print(f"Supervisor: {self.count} workers serving (pid {os.getpid()})")
+        while not self.stopping:
+            time.sleep(POLL_S)
+            if self.reload_requested:
+                self.reload_requested = False
+                self.reload()
+                continue
+            for i, (p, _) in enumerate(self.workers):
+                if p.exitcode is not None and not self.stopping:
+                    print(f"Supervisor: worker {p.pid} exited with {p.exitcode}, replacing it")
+                    self.workers[i] = self._spawn()
+        self._stop(self.workers)
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the gateway with several worker processes")
+    parser.add_argument("--workers", type=int, default=WEB_WORKERS, help="0 = one per available CPU")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--backlog", type=int, default=2048)
+    parser.add_argument("--log-level", default="info")
+    args = parser.parse_args()
+
+    workers = args.workers or cpu_count()
+    if OPENROUTER_CASSETTE_MODE == "record" and workers > 1:
+        # The cassette is appended under a per-process lock; several writers would interleave gzip members
+        raise SystemExit("Supervisor: OPENROUTER_CASSETTE_MODE=record needs --workers 1")
+    # Read by the workers' config: selects the shared state backend
+    os.environ["WEB_WORKERS"] = str(workers)
+
+    sock = socket.socket(socket.AF_INET6 if ":" in args.host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((args.host, args.port))
+    sock.listen(args.backlog)
+    sock.set_inheritable(True)
+
+    supervisor = Supervisor(sock, workers, args.log_level)
+
+    def request_reload(*_):
+        supervisor.reload_requested = True
+
+    def request_stop(*_):
+        supervisor.stopping = True
+
+    signal.signal(signal.SIGHUP, request_reload)
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+    try:
+        supervisor.run()
+    finally:
+        sock.close()
+
+if __name__ == "__main__":
+    main()
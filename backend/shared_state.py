@@ -0,0 +1,167 @@
+"""State shared between the worker processes of one deployment.
+
+Small key/value entries with a TTL, counters and leases, grouped in namespaces:
+    topic         moderation labels (health_guard)
+    lab           single-lab interpretations (lab_engine)
+    cooldown      upstream 429 cooldowns, so one worker's rate limit cools the key everywhere
+    conversation  per-conversation version, which keeps the per-worker turn caches coherent
+    lease         maintenance runs in one worker at a time
+
+LocalState keeps everything in this process (one worker, the default). SqliteState uses a
+separate SQLite file in WAL mode, so readers never wait for the writer and the application
+database sees no extra lock traffic. SHARED_STATE_BACKEND=auto picks it when the supervisor
+(backend.serve) runs more than one worker. The backend is built on first use in each process.
+"""
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Dict, Optional, Tuple
+from .config import SHARED_STATE_BACKEND, SHARED_STATE_PATH, WEB_WORKERS
+from .db import DB_PATH
+
+# Expired rows are dropped after this many writes per process (and by the maintenance job)
+PURGE_EVERY = 1000
+
+class LocalState:
+    local = True
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries: Dict[Tuple[str, str], Tuple[str, float]] = {}
+        self.leases: Dict[str, Tuple[str, float]] = {}
+
+    def get(self, ns: str, key: str) -> Optional[str]:
+        with self.lock:
+            item = self.entries.get((ns, key))
+            if not item:
+                return None
+            if time.time() > item[1]:
+                self.entries.pop((ns, key), None)
+                return None
+            return item[0]
+
+    def set(self, ns: str, key: str, value: str, ttl_s: float):
+        with self.lock:
+            self.entries[(ns, key)] = (value, time.time() + ttl_s)
+
+    def incr(self, ns: str, key: str, ttl_s: float) -> int:
+        """Add one to a counter; an expired counter starts again at 1 with a fresh TTL"""
+        now = time.time()
+        with self.lock:
+            item = self.entries.get((ns, key))
+            if item and now <= item[1]:
+                value, expires_at = int(item[0]) + 1, item[1]
+            else:
+                value, expires_at = 1, now + ttl_s
+            self.entries[(ns, key)] = (str(value), expires_at)
+            return value
+
+    def acquire(self, name: str, ttl_s: float) -> Optional[str]:
+        """Take the lease unless another holder's is still live; returns its token"""
+        now = time.time()
+        with self.lock:
+            held = self.leases.get(name)
+            if held and now < held[1]:
+                return None
+            token = uuid.uuid4().hex
+            self.leases[name] = (token, now + ttl_s)
+            return token
+
+    def release(self, name: str, token: str):
+        with self.lock:
+            if self.leases.get(name, ("",))[0] == token:
+                del self.leases[name]
+
+    def purge(self) -> int:
+        now = time.time()
+        with self.lock:
+            expired = [k for k, (_, exp) in self.entries.items() if now > exp]
+            for k in expired:
+                del self.entries[k]
+            return len(expired)
+
+class SqliteState:
+    local = False
+
+    def __init__(self, path: str):
+        self.path = path
+        self.conns = threading.local()
+        self.writes = 0
+        self._conn()  # create the schema up front
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self.conns, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS kv (ns TEXT, key TEXT, value TEXT, expires_at REAL,"
+                         " PRIMARY KEY (ns, key)) WITHOUT ROWID")
+            conn.execute("CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, token TEXT, expires_at REAL)")
+            self.conns.conn = conn
+        return conn
+
+    def _wrote(self):
+        self.writes += 1
+        if self.writes % PURGE_EVERY == 0:
+            self.purge()
+
+    def get(self, ns: str, key: str) -> Optional[str]:
+        row = self._conn().execute("SELECT value FROM kv WHERE ns = ? AND key = ? AND expires_at > ?",
+                                   (ns, key, time.time())).fetchone()
+        return row[0] if row else None
+
+    def set(self, ns: str, key: str, value: str, ttl_s: float):
+        self._conn().execute("INSERT OR REPLACE INTO kv VALUES (?, ?, ?, ?)", (ns, key, value, time.time() + ttl_s))
+        self._wrote()
+
+    def incr(self, ns: str, key: str, ttl_s: float) -> int:
+        now = time.time()
+        row = self._conn().execute(
+            "INSERT INTO kv VALUES (?, ?, '1', ?) ON CONFLICT (ns, key) DO UPDATE SET"
+            " value = CASE WHEN expires_at > ? THEN CAST(value AS INTEGER) + 1 ELSE 1 END,"
+            " expires_at = CASE WHEN expires_at > ? THEN expires_at ELSE excluded.expires_at END"
+            " RETURNING value", (ns, key, now + ttl_s, now, now)).fetchone()
+        self._wrote()
+        return int(row[0])
+
+    def acquire(self, name: str, ttl_s: float) -> Optional[str]:
+        now = time.time()
+        token = uuid.uuid4().hex
+        cur = self._conn().execute(
+            "INSERT INTO leases VALUES (?, ?, ?) ON CONFLICT (name) DO UPDATE SET"
+            " token = excluded.token, expires_at = excluded.expires_at WHERE leases.expires_at <= ?",
+            (name, token, now + ttl_s, now))
+        return token if cur.rowcount == 1 else None
+
+    def release(self, name: str, token: str):
+        self._conn().execute("DELETE FROM leases WHERE name = ? AND token = ?", (name, token))
+
+    def purge(self) -> int:
+        return self._conn().execute("DELETE FROM kv WHERE expires_at <= ?", (time.time(),)).rowcount
+
+def _default_path() -> str:
+    root, _ = os.path.splitext(DB_PATH)
+    return f"{root}-state.db"
+
+def _from_config():
+    backend = SHARED_STATE_BACKEND
+    if backend == "auto":
+        backend = "sqlite" if WEB_WORKERS > 1 else "local"
+    if backend == "sqlite":
+        return SqliteState(SHARED_STATE_PATH or _default_path())
+    if backend != "local":
+        raise ValueError(f"Unknown SHARED_STATE_BACKEND {backend!r}")
+    return LocalState()
+
+_state = None
+_state_lock = threading.Lock()
+
+def get_state():
+    global _state
+    with _state_lock:
+        if _state is None:
+            _state = _from_config()
+        return _state
@@ -0,0 +1,121 @@
+"""Adaptive max_tokens per call site (stage) and model.
+
+Every orchestrator call reports its usage.completion_tokens and finish_reason here. Once a
+(stage, model) pair has TOKEN_BUDGET_MIN_SAMPLES completions, its max_tokens becomes the
+TOKEN_BUDGET_PERCENTILE of the recent completions times TOKEN_BUDGET_HEADROOM, capped at
+TOKEN_BUDGET_MAX_FACTOR times the call site's static value. JSON stages never go below
+their static value, since a reply cut short is invalid JSON; for them learning can only
+widen. A truncated completion (finish_reason == "length") widens that pair's budget by
+WIDEN_STEP, and the orchestrator retries it once with the wider budget; the widening decays
+again over untruncated completions. Stages whose output grows with the input (lab groups)
+pass units=len(tests) and are learned per unit.
+
+Free-text stages additionally get a length hint at the target percentile (times the
+widening) in the last user message, which keeps the cached system prefix unchanged.
+Replies written under a hint are shorter because of it, so only unhinted replies are
+sampled; TOKEN_BUDGET_EXPLORE_RATE of the calls stay unhinted to keep the samples current.
+
+report() compares generation latency of calls made with the static budget ("before") and
+with the learned one ("after") per stage.
+"""
+import random
+import threading
+from collections import deque, Counter
+from typing import Dict, Any, List, Tuple
+from .config import (TOKEN_BUDGET_ENABLED, TOKEN_BUDGET_PERCENTILE, TOKEN_BUDGET_HEADROOM, TOKEN_BUDGET_MIN_SAMPLES,
+                     TOKEN_BUDGET_WINDOW, TOKEN_BUDGET_MAX_FACTOR, TOKEN_BUDGET_EXPLORE_RATE)
+
+MIN_TOKENS = 64
+WIDEN_STEP = 1.25
+WIDEN_DECAY = 0.98
+# Stages whose reply is free text; all others return JSON and are never cut below their static budget
+TEXT_STAGES = {"chat", "chat_synthesis", "chat_finalize"}
+# Free-text stages that get a length hint; JSON stages only get a budget, their schema fixes the shape
+HINT_STAGES = {"chat", "chat_synthesis"}
+WORDS_PER_TOKEN = 0.5  # Turkish text is roughly two tokens per word
+
+_lock = threading.Lock()
+_samples: Dict[Tuple[str, str], deque] = {}
+_widen: Dict[Tuple[str, str], float] = {}
+_stats: Dict[str, Counter] = {}
+
+def _percentile(values: List[float], pct: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+def _learned(stage: str, model: str) -> float | None:
+    """Target completion length per unit, or None while there are too few samples"""
+    samples = _samples.get((stage, model))
+    if not samples or len(samples) < TOKEN_BUDGET_MIN_SAMPLES:
+        return None
+    return _percentile(list(samples), TOKEN_BUDGET_PERCENTILE)
+
+def max_tokens_for(stage: str, model: str, default: int, units: int = 1) -> int | None:
+    """Learned budget, or None to keep the call site's static default"""
+    if not TOKEN_BUDGET_ENABLED:
+        return None
+    with _lock:
+        target = _learned(stage, model)
+        widen = _widen.get((stage, model), 1.0)
+    if target is None:
+        return None
+    budget = int(target * units * TOKEN_BUDGET_HEADROOM * widen)
+    if stage not in TEXT_STAGES:
+        budget = max(budget, default)
+    return max(MIN_TOKENS, min(budget, int(default * TOKEN_BUDGET_MAX_FACTOR)))
+
+def length_hint(stage: str, model: str) -> str | None:
+    if not TOKEN_BUDGET_ENABLED or stage not in HINT_STAGES or random.random() < TOKEN_BUDGET_EXPLORE_RATE:
+        return None
+    with _lock:
+        target = _learned(stage, model)
+        widen = _widen.get((stage, model), 1.0)
+    if target is None:
+        return None
+    return f"Yanıtını en fazla yaklaşık {max(20, int(target * widen * WORDS_PER_TOKEN))} kelimeyle sınırla."
+
+def observe(stage: str, model: str, result: Dict[str, Any], adaptive: bool, units: int = 1, hinted: bool = False):
+    completion = (result.get("usage") or {}).get("completion_tokens")
+    if not completion:
+        return
+    truncated = result.get("finish_reason") == "length"
+    key = (stage, model)
+    with _lock:
+        if not hinted:
+            _samples.setdefault(key, deque(maxlen=TOKEN_BUDGET_WINDOW)).append(completion / max(units, 1))
+        if truncated:
+            _widen[key] = min(_widen.get(key, 1.0) * WIDEN_STEP, TOKEN_BUDGET_MAX_FACTOR)
+        elif key in _widen:
+            _widen[key] = max(1.0, _widen[key] * WIDEN_DECAY)
+        c = _stats.setdefault(stage, Counter())
+        phase = "adaptive" if adaptive else "static"
+        c[f"{phase}_calls"] += 1
+        c[f"{phase}_latency_ms"] += result.get("latency_ms") or 0
+        c[f"{phase}_completion_tokens"] += completion
+        c[f"{phase}_truncated"] += truncated
+
+def record_retry(stage: str):
+    with _lock:
+        _stats.setdefault(stage, Counter())["truncation_retries"] += 1
+
+def report() -> Dict[str, Any]:
+    with _lock:
+        out = {}
+        for stage, c in _stats.items():
+            entry: Dict[str, Any] = {}
+            for phase, name in (("static", "before"), ("adaptive", "after")):
+                n = c[f"{phase}_calls"]
+                entry[name] = {
+                    "calls": n,
+                    "avg_latency_ms": int(c[f"{phase}_latency_ms"] / n) if n else None,
+                    "avg_completion_tokens": int(c[f"{phase}_completion_tokens"] / n) if n else None,
+                    "truncated": c[f"{phase}_truncated"],
+                }
+            entry["truncation_retries"] = c["truncation_retries"]
+            entry["budgets"] = {
+                model: {"p": int(_percentile(list(s), TOKEN_BUDGET_PERCENTILE)), "samples": len(s),
+                        "widen": round(_widen.get((st, model), 1.0), 2)}
+                for (st, model), s in _samples.items() if st == stage
+            }
+            out[stage] = entry
+        return out
@@ -0,0 +1,201 @@
+"""Pool of OpenAI-compatible upstreams (API keys and/or base URLs) for chat completions.
+
+Entries come from OPENROUTER_UPSTREAMS, a JSON list of
+    {"name": "key-a", "base_url": "...", "api_key": "...", "weight": 2, "models": ["meta-llama/"],
+     "openrouter": true}
+or, by default, one entry per key in OPENROUTER_API_KEYS (else OPENROUTER_API_KEY) on
+OPENROUTER_BASE_URL. "models" limits an entry (e.g. a self-hosted gateway) to models with those
+prefixes; an entry without "api_key" sends no Authorization header. "openrouter" enables
+OpenRouter-only request fields (usage accounting); it defaults to true for openrouter.ai base
+URLs and for the default pool.
+
+acquire() picks the upstream with the fewest outstanding requests relative to its weight. A 429
+puts the upstream in cooldown for its Retry-After (UPSTREAM_COOLDOWN_S if absent), during which
+its weight is multiplied by COOLDOWN_WEIGHT, so it only gets traffic when the others are far
+busier. With several workers the cooldown is also written to the shared state and picked up
+by the other workers' pools within COOLDOWN_SYNC_S. Each upstream keeps one httpx.Client; the pool is built on first use so every worker
+process opens its own connections, and warm() pre-opens them at startup.
+
+An upstream is unhealthy after UPSTREAM_UNHEALTHY_AFTER consecutive failed calls (network error or
+5xx) until its next success; healthy() backs the readiness probe. A timeout the caller shortened
+(request deadline, moderation timeout) is counted as client_timeouts instead, since it says
+nothing about the upstream.
+"""
+import email.utils
+import random
+import threading
+import time
+from collections import Counter
+from typing import Dict, Any, List, Optional
+import httpx
+from .shared_state import get_state
+from .config import (OPENROUTER_API_KEY, OPENROUTER_API_KEYS, OPENROUTER_BASE_URL, OPENROUTER_UPSTREAMS,
+                     UPSTREAM_COOLDOWN_S, UPSTREAM_MAX_CONNECTIONS, UPSTREAM_UNHEALTHY_AFTER, WARMUP_TIMEOUT_S)
+
+COOLDOWN_WEIGHT = 0.05
+MAX_RETRY_AFTER_S = 120
+COOLDOWN_SYNC_S = 0.5
+
+class NoUpstream(RuntimeError):
+    """No configured upstream serves the requested model"""
+
+class Upstream:
+    def __init__(self, name: str, base_url: str, api_key: Optional[str], weight: float = 1.0,
+                 models: Optional[List[str]] = None, require_key: bool = False, openrouter: bool = True):
+        self.name = name
+        self.base_url = base_url.rstrip("/")
+        self.api_key = api_key
+        self.weight = float(weight)
+        self.models = models or []
+        self.require_key = require_key
+        self.openrouter = openrouter
+        self.outstanding = 0
+        self.cooldown_until = 0.0
+        self.consecutive_errors = 0
+        self.stats: Counter = Counter()
+        self.client = httpx.Client(limits=httpx.Limits(max_connections=UPSTREAM_MAX_CONNECTIONS,
+                                                       max_keepalive_connections=UPSTREAM_MAX_CONNECTIONS))
+
+    def serves(self, model: str) -> bool:
+        return not self.models or any(model.startswith(p) for p in self.models)
+
+    def headers(self) -> Dict[str, str]:
+        if self.require_key and not self.api_key:
+            raise ValueError("OPENROUTER_API_KEY environment variable is required")
+        headers = {"Content-Type": "application/json"}
+        if self.api_key:
+            headers["Authorization"] = f"Bearer {self.api_key}"
+        return headers
+
+    def score(self, now: float) -> float:
+        weight = self.weight * (COOLDOWN_WEIGHT if now < self.cooldown_until else 1.0)
+        return (self.outstanding + 1) / weight
+
+    def healthy(self) -> bool:
+        return not UPSTREAM_UNHEALTHY_AFTER or self.consecutive_errors < UPSTREAM_UNHEALTHY_AFTER
+
+def _retry_after_s(value: Optional[str]) -> float:
+    """Retry-After as seconds (delta-seconds or HTTP date)"""
+    if not value:
+        return UPSTREAM_COOLDOWN_S
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = email.utils.parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return UPSTREAM_COOLDOWN_S
+    return min(max(seconds, 0.0), MAX_RETRY_AFTER_S)
+
+class UpstreamPool:
+    def __init__(self, upstreams: List[Upstream]):
+        self.upstreams = upstreams
+        self.lock = threading.Lock()
+        self.next_sync = 0.0
+
+    def candidates(self, model: str) -> List[Upstream]:
+        return [u for u in self.upstreams if u.serves(model)]
+
+    def _sync_cooldowns(self):
+        """Adopt cooldowns other workers recorded after a 429"""
+        now = time.time()
+        state = get_state()
+        if state.local or now < self.next_sync:
+            return
+        self.next_sync = now + COOLDOWN_SYNC_S
+        for u in self.upstreams:
+            until = state.get("cooldown", u.name)
+            if until is not None:
+                u.cooldown_until = max(u.cooldown_until, float(until))
+
+    def acquire(self, model: str, exclude: List[Upstream] = ()) -> Upstream:
+        self._sync_cooldowns()
+        with self.lock:
+            now = time.time()
+            eligible = [u for u in self.candidates(model) if u not in exclude]
+            if not eligible:
+                raise NoUpstream(f"No upstream configured for {model}")
+            best = min(u.score(now) for u in eligible)
+            upstream = random.choice([u for u in eligible if u.score(now) == best])
+            upstream.outstanding += 1
+            upstream.stats["requests"] += 1
+            return upstream
+
+    def release(self, upstream: Upstream, status: Optional[int] = None, retry_after: Optional[str] = None,
+                client_timeout: bool = False):
+        with self.lock:
+            upstream.outstanding -= 1
+            if client_timeout:
+                upstream.stats["client_timeouts"] += 1
+            elif status is None or status >= 500:
+                upstream.stats["errors"] += 1
+                upstream.consecutive_errors += 1
+            elif status == 429:
+                upstream.stats["rate_limited"] += 1
+                upstream.cooldown_until = max(upstream.cooldown_until, time.time() + _retry_after_s(retry_after))
+            else:
+                upstream.consecutive_errors = 0
+        if status == 429:
+            state = get_state()
+            if not state.local:
+                state.set("cooldown", upstream.name, str(upstream.cooldown_until), upstream.cooldown_until - time.time())
+
+    def healthy(self) -> bool:
+        """At least one upstream is not failing every call"""
+        with self.lock:
+            return any(u.healthy() for u in self.upstreams)
+
+    def warm(self) -> Dict[str, Any]:
+        """Open one connection per upstream (DNS, TCP, TLS) with a cheap GET of its model list"""
+        out = {}
+        for u in self.upstreams:
+            start = time.perf_counter()
+            try:
+                r = u.client.get(f"{u.base_url}/models", headers=u.headers() if u.api_key else None,
+                                 timeout=WARMUP_TIMEOUT_S)
+                out[u.name] = {"status": r.status_code, "ms": int((time.perf_counter() - start) * 1000)}
+            except Exception as e:
+                out[u.name] = {"error": type(e).__name__, "ms": int((time.perf_counter() - start) * 1000)}
+        return out
+
+    def stats(self) -> List[Dict[str, Any]]:
+        with self.lock:
+            now = time.time()
+            return [{"name": u.name, "base_url": u.base_url, "weight": u.weight, "models": u.models,
+                     "openrouter": u.openrouter,
+                     "outstanding": u.outstanding, "cooldown_s": round(max(u.cooldown_until - now, 0.0), 1),
+                     "healthy": u.healthy(), **u.stats} for u in self.upstreams]
+
+    def close(self):
+        for u in self.upstreams:
+            u.client.close()
+
+def _from_config() -> UpstreamPool:
+    if OPENROUTER_UPSTREAMS:
+        upstreams = []
+        for i, e in enumerate(OPENROUTER_UPSTREAMS):
+            base_url = e.get("base_url") or OPENROUTER_BASE_URL
+            upstreams.append(Upstream(e.get("name") or f"upstream-{i}", base_url, e.get("api_key"),
+                                      e.get("weight", 1.0), e.get("models"),
+                                      openrouter=e.get("openrouter", "openrouter.ai" in base_url)))
+    else:
+        keys = OPENROUTER_API_KEYS or [OPENROUTER_API_KEY]
+        upstreams = [Upstream(f"key-{i}", OPENROUTER_BASE_URL, key, require_key=True) for i, key in enumerate(keys)]
+    return UpstreamPool(upstreams)
+
+_pool: Optional[UpstreamPool] = None
+_pool_lock = threading.Lock()
+
+def get_pool() -> UpstreamPool:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = _from_config()
+        return _pool
+
+def close_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
@@ -1,7 +1,13 @@
 import json
 from typing import Tuple
 from .config import CASCADE_MIN_CHARS
-from .health_guard import is_health_topic
+
+def normalize_text(t: str) -> str:
+    """Lowercase and fold Turkish letters to ASCII, so keyword matching ignores diacritics"""
+    t = (t or "").lower()
+    # "İ".lower() is "i" plus a combining dot above; drop the dot
+    return (t.replace("\u0307", "").replace("ı", "i").replace("ö", "o").replace("ü", "u")
+             .replace("ş", "s").replace("ğ", "g").replace("ç", "c"))
 
 def parse_json_safe(text: str):
     try:
@@ -16,6 +22,7 @@ def parse_json_safe(text: str):
         return None
 
 def is_valid_chat(text: str) -> bool:
+    from .health_guard import is_health_topic  # health_guard imports this module
     if not text or len(text.strip()) < CASCADE_MIN_CHARS:
         return False
     if not is_health_topic(text):
@@ -0,0 +1,118 @@
+"""Startup warmup, readiness and first-request latency.
+
+main's startup hook runs init_db() and then start(), which runs the warmup phases in a
+background thread so /livez answers at once:
+    guard      exercise the topic/prescription patterns (compiled at import)
+    faq_index  load the FAQ index from the database (FAQ_CACHE_ENABLED)
+    upstreams  open one connection per upstream: DNS, TCP and TLS (UpstreamPool.warm)
+A failing phase is recorded and does not block readiness; the first real request then pays
+for it instead. ready() is true once all phases have run (immediately with WARMUP_ENABLED
+off). BOOT_TIME is taken when main imports this module, so time_to_ready_ms also covers
+imports and schema creation.
+
+FirstRequestTimer records the latency of the first request to each endpoint, which is where
+cold connections and lazily built state show up; report() puts both next to each other.
+"""
+import threading
+import time
+from typing import Dict, Any, Callable, Optional
+from .config import WARMUP_ENABLED, FAQ_CACHE_ENABLED
+
+BOOT_TIME = time.monotonic()
+
+_lock = threading.Lock()
+_phases: Dict[str, Dict[str, Any]] = {}
+_ready_at: Optional[float] = None
+_first_requests: Dict[str, Dict[str, Any]] = {}
+
+def _guard():
+    from .health_guard import is_health_topic, is_prescription_like
+    is_health_topic("Kolesterol 210 mg/dl, LDL yüksek, karaciğer değerlerim nasıl?")
+    is_prescription_like("Günde 2 kez 500 mg alabilir miyim?")
+
+def _faq_index():
+    if not FAQ_CACHE_ENABLED:
+        return "disabled"
+    from .faq_cache import _get_index
+    return {"entries": len(_get_index())}
+
+def _upstreams():
+    from .upstreams import get_pool
+    return get_pool().warm()
+
+PHASES: Dict[str, Callable[[], Any]] = {
+    "guard": _guard,
+    "faq_index": _faq_index,
+    "upstreams": _upstreams,
+}
+
+def _run_phase(name: str, fn: Callable[[], Any]):
+    start = time.perf_counter()
+    entry: Dict[str, Any] = {}
+    try:
+        detail = fn()
+        if detail is not None:
+            entry["detail"] = detail
+    except Exception as e:
+        entry["error"] = f"{type(e).__name__}: {e}"
+        print(f"Warmup: {name} failed: {e}")
+    entry["ms"] = int((time.perf_counter() - start) * 1000)
+    with _lock:
+        _phases[name] = entry
+
+def _mark_ready():
+    global _ready_at
+    with _lock:
+        _ready_at = time.monotonic()
+    print(f"Ready after {int((_ready_at - BOOT_TIME) * 1000)} ms")
+
+def run():
+    for name, fn in PHASES.items():
+        _run_phase(name, fn)
+    _mark_ready()
+
+def start():
+    if not WARMUP_ENABLED:
+        _mark_ready()
+        return
+    threading.Thread(target=run, name="warmup", daemon=True).start()
+
+def ready() -> bool:
+    return _ready_at is not None
+
+def report() -> Dict[str, Any]:
+    with _lock:
+        return {
+            "ready": _ready_at is not None,
+            "time_to_ready_ms": int((_ready_at - BOOT_TIME) * 1000) if _ready_at is not None else None,
+            "phases": dict(_phases),
+            "first_requests": dict(_first_requests),
+        }
+
+def _label(scope) -> Optional[str]:
+    endpoint = scope.get("endpoint")
+    if endpoint is None:
+        return None
+    return f"{scope['method']} {getattr(endpoint, '__name__', type(endpoint).__name__)}"
+
+class FirstRequestTimer:
+    """Pure ASGI middleware; after an endpoint's first request it costs one dict lookup"""
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        start = time.monotonic()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            # The router fills in scope["endpoint"] while dispatching
+            label = _label(scope)
+            if label is not None and label not in _first_requests:
+                with _lock:
+                    _first_requests.setdefault(label, {
+                        "ms": int((time.monotonic() - start) * 1000),
+                        "after_boot_ms": int((start - BOOT_TIME) * 1000),
+                        "before_ready": _ready_at is None or start < _ready_at,
+                    })
@@ -0,0 +1,51 @@
+"""Compare two benchmark records from a results file by label (latest record per label).
+
+Usage:
+    python -m bench.compare bench/results/results.jsonl baseline candidate
+"""
+import argparse
+import json
+from typing import Dict, Any
+
+def _latest(path: str, label: str) -> Dict[str, Any]:
+    found = None
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            record = json.loads(line)
+            if record.get("label") == label:
+                found = record
+    if not found:
+        raise SystemExit(f"No record labelled {label!r} in {path}")
+    return found
+
+def _pct(a: float, b: float) -> str:
+    return f"{(b - a) / a * 100:+.1f}%" if a else "n/a"
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare two benchmark runs")
+    parser.add_argument("results")
+    parser.add_argument("baseline")
+    parser.add_argument("candidate")
+    args = parser.parse_args()
+
+    base = {r["endpoint"]: r for r in _latest(args.results, args.baseline)["results"]}
+    cand = {r["endpoint"]: r for r in _latest(args.results, args.candidate)["results"]}
+    print(f"{'endpoint':12s} {'metric':22s} {'baseline':>10s} {'candidate':>10s} {'delta':>8s}")
+    for endpoint in base:
+        if endpoint not in cand:
+            continue
+        a, b = base[endpoint], cand[endpoint]
+        rows = [
+            ("p50 ms", a["latency_ms"]["p50"], b["latency_ms"]["p50"]),
+            ("p95 ms", a["latency_ms"]["p95"], b["latency_ms"]["p95"]),
+            ("p99 ms", a["latency_ms"]["p99"], b["latency_ms"]["p99"]),
+            ("throughput rps", a["throughput_rps"], b["throughput_rps"]),
+            ("upstream calls/req", a["upstream_calls_per_request"], b["upstream_calls_per_request"]),
+            ("prompt tokens", a["upstream"].get("prompt_tokens", 0), b["upstream"].get("prompt_tokens", 0)),
+            ("completion tokens", a["upstream"].get("completion_tokens", 0), b["upstream"].get("completion_tokens", 0)),
+        ]
+        for name, x, y in rows:
+            print(f"{endpoint:12s} {name:22s} {x:10.1f} {y:10.1f} {_pct(x, y):>8s}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,246 @@
+"""Local OpenRouter-compatible stand-in for offline tests and benchmarks.
+
+Usage:
+    python -m bench.fake_openrouter --port 9100 [--config bench/fake_profile.json]
+    OPENROUTER_BASE_URL=http://127.0.0.1:9100/api/v1 OPENROUTER_API_KEY=fake uvicorn backend.main:app
+
+Config (JSON) sets per-model latency distributions and fault injection; "default" applies to
+models without their own entry:
+    {
+      "default": {"latency_ms": {"dist": "lognormal", "median": 800, "sigma": 0.35},
+                  "error_rate": 0.0, "timeout_rate": 0.0, "rate_limit_rate": 0.0, "timeout_s": 60},
+      "models": {"google/gemini-2.5-flash": {"latency_ms": {"dist": "fixed", "value": 150}}},
+      "max_concurrent": 0
+    }
+"max_concurrent" (0 = unlimited) answers 429 with Retry-After: 1 beyond that many in-flight
+requests, like a per-key rate limit; run several instances on different ports to test the
+gateway's upstream pool (OPENROUTER_UPSTREAMS).
+GET /_stats returns upstream call counts, POST /_reset clears them.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import threading
+import time
+from collections import Counter
+from typing import Dict, Any
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+DEFAULT_PROFILE: Dict[str, Any] = {
+    "default": {
+        "latency_ms": {"dist": "lognormal", "median": 800, "sigma": 0.35},
+        "error_rate": 0.0,
+        "timeout_rate": 0.0,
+        "rate_limit_rate": 0.0,
+        "timeout_s": 60,
+    },
+    "models": {},
+}
+
+CANNED_CHAT = (
+    "D vitamini eksikliğinde yorgunluk, kas güçsüzlüğü, kemik ağrıları ve sık enfeksiyon görülebilir. "
+    "Güneş ışığından yeterli faydalanmak, yağlı balık ve yumurta gibi besinleri tüketmek faydalıdır. "
+    "Takviye kullanmadan önce kan değerlerinizi ölçtürüp hekiminize danışmanız önerilir."
+)
+CANNED = {
+    "quiz": {
+        "nutrition_advice": {"title": "Beslenme Önerileri", "recommendations": ["Sebze tüketimini artırın", "Yeterli su için"]},
+        "lifestyle_advice": {"title": "Yaşam Tarzı Önerileri", "recommendations": ["Düzenli uyuyun", "Haftada 3 gün yürüyün"]},
+        "general_warnings": {"title": "Genel Uyarılar", "warnings": ["Takviyeler için hekiminize danışın"]},
+        "supplement_recommendations": [{
+            "name": "Vitamin D", "description": "Kemik sağlığı ve bağışıklık için",
+            "daily_dose": "600-800 IU (doktorunuza danışın)", "benefits": ["Kalsiyum emilimi"],
+            "warnings": ["Yüksek dozda toksik olabilir"], "priority": "high",
+        }],
+    },
+    "single_lab": {
+        "analysis": {
+            "summary": "Sonuç referans aralığının dışında.", "interpretation": "Hafif sapma görülüyor.",
+            "reference_comparison": "Alt sınırın altında.", "clinical_significance": "Takip edilmeli.",
+            "follow_up_suggestions": "3 ay sonra tekrar ölçüm.",
+        }
+    },
+    "lab_group": {"test_details": {}, "group_summary": "Panel genel olarak dengeli.", "group_status": "normal", "concerns": []},
+    "lab_summary": {
+        "general_assessment": {"overall_summary": "Genel durum iyi.", "patterns_identified": "Belirgin patern yok.",
+                               "areas_of_concern": "D vitamini düşük.", "positive_aspects": "Lipidler normal.",
+                               "metabolic_status": "Normal", "nutritional_status": "Orta"},
+        "overall_status": "dikkat_edilmeli",
+        "lifestyle_recommendations": {"exercise": ["Yürüyüş"], "nutrition": ["Balık"], "sleep": ["7-8 saat"], "stress_management": ["Nefes egzersizi"]},
+        "supplement_recommendations": [],
+        "test_details": {},
+    },
+    "analyze": {
+        "recommendations": [{"name": "D Vitamini", "reason": "Eksiklik belirtileri", "source": "consensus"}],
+        "analysis": {"summary": "D vitamini eksikliği olası", "key_findings": ["Yorgunluk"], "risk_level": "düşük"},
+    },
+}
+
+app = FastAPI(title="Fake OpenRouter")
+_profile: Dict[str, Any] = DEFAULT_PROFILE
+_stats: Counter = Counter()
+_stats_lock = threading.Lock()
+_seen_prefixes: set = set()  # (model, system text) pairs, to report cached prompt tokens like providers do
+_in_flight = 0
+
+def _model_profile(model: str) -> Dict[str, Any]:
+    merged = dict(_profile.get("default", {}))
+    merged.update(_profile.get("models", {}).get(model, {}))
+    return merged
+
+def _sample_latency_s(spec: Dict[str, Any]) -> float:
+    dist = spec.get("dist", "fixed")
+    if dist == "lognormal":
+        ms = random.lognormvariate(0, spec.get("sigma", 0.3)) * spec.get("median", 500)
+    elif dist == "uniform":
+        ms = random.uniform(spec.get("low", 100), spec.get("high", 1000))
+    else:
+        ms = spec.get("value", 100)
+    return max(ms, 0) / 1000
+
+def _text_of(messages) -> str:
+    parts = []
+    for m in messages:
+        content = m.get("content")
+        if isinstance(content, list):
+            parts.extend(p.get("text", "") for p in content if isinstance(p, dict))
+        else:
+            parts.append(str(content or ""))
+    return "\n".join(parts)
+
+def _canned_content(messages) -> str:
+    text = _text_of(messages)
+    if "topic classifier" in text:
+        numbered = re.findall(r"^(\d+)[.)]", text, re.MULTILINE)
+        if numbered:
+            return "\n".join(f"{n}. HEALTH" for n in numbered)
+        return "HEALTH"
+    if "PANEL ANALİZİ" in text:
+        names = re.findall(r"^- ([^:\n]+):", text, re.MULTILINE)
+        data = dict(CANNED["lab_group"])
+        data["test_details"] = {n: {"interpretation": f"{n} değeri değerlendirildi.", "significance": "Orta",
+                                    "suggestions": "Takip edin."} for n in names}
+        return json.dumps(data, ensure_ascii=False)
+    if "GENEL DEĞERLENDİRME" in text or "KAPSAMLI LAB ANALİZİ" in text or "kapsamlı genel test analizi" in text:
+        return json.dumps(CANNED["lab_summary"], ensure_ascii=False)
+    if "LAB ANALİZİ" in text or "tek test analizi" in text:
+        return json.dumps(CANNED["single_lab"], ensure_ascii=False)
+    if "SUPPLEMENT ÖNERİLERİ" in text or "quiz" in text.lower():
+        return json.dumps(CANNED["quiz"], ensure_ascii=False)
+    if "recommendations" in text and "JSON" in text:
+        return json.dumps(CANNED["analyze"], ensure_ascii=False)
+    return CANNED_CHAT
+
+def _count(key: str):
+    with _stats_lock:
+        _stats[key] += 1
+
+@app.post("/api/v1/chat/completions")
+async def chat_completions(request: Request):
+    global _in_flight
+    body = await request.json()
+    model = body.get("model", "unknown")
+    profile = _model_profile(model)
+    limit = _profile.get("max_concurrent", 0)
+    if limit and _in_flight >= limit:
+        _count("concurrency_429")
+        return JSONResponse({"error": {"message": "too many concurrent requests"}}, status_code=429,
+                            headers={"Retry-After": "1"})
+    _count("calls")
+    _count(f"model:{model}")
+
+    _in_flight += 1
+    try:
+        await asyncio.sleep(_sample_latency_s(profile.get("latency_ms", {})))
+    finally:
+        _in_flight -= 1
+    roll = random.random()
+    if roll < profile.get("timeout_rate", 0.0):
+        _count("injected_timeouts")
+        await asyncio.sleep(profile.get("timeout_s", 60))
+    roll = random.random()
+    if roll < profile.get("rate_limit_rate", 0.0):
+        _count("injected_429")
+        return JSONResponse({"error": {"message": "rate limited"}}, status_code=429, headers={"Retry-After": "1"})
+    if roll < profile.get("rate_limit_rate", 0.0) + profile.get("error_rate", 0.0):
+        _count("injected_errors")
+        return JSONResponse({"error": {"message": "upstream error"}}, status_code=500)
+
+    messages = body.get("messages", [])
+    content = _canned_content(messages)
+    max_tokens = int(body.get("max_tokens") or 800)
+    completion_tokens = max(1, len(content) // 4)
+    finish_reason = "stop"
+    if completion_tokens > max_tokens:
+        content = content[: max_tokens * 4]
+        completion_tokens = max_tokens
+        finish_reason = "length"
+    prompt_tokens = max(1, len(_text_of(messages)) // 4)
+    cached_tokens = 0
+    if messages and messages[0].get("role") == "system":
+        prefix = _text_of(messages[:1])
+        with _stats_lock:
+            if (model, prefix) in _seen_prefixes:
+                cached_tokens = len(prefix) // 4
+            _seen_prefixes.add((model, prefix))
+    with _stats_lock:
+        _stats["prompt_tokens"] += prompt_tokens
+        _stats["cached_tokens"] += cached_tokens
+        _stats["completion_tokens"] += completion_tokens
+    return {
+        "id": f"fake-{int(time.time() * 1000)}",
+        "model": model,
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": finish_reason}],
+        "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                  "total_tokens": prompt_tokens + completion_tokens,
+                  "prompt_tokens_details": {"cached_tokens": cached_tokens}},
+    }
+
+@app.get("/api/v1/models")
+def models():
+    return {"data": [{"id": m} for m in _profile.get("models", {})]}
+
+@app.get("/_stats")
+def stats():
+    with _stats_lock:
+        return dict(_stats)
+
+@app.post("/_reset")
+def reset():
+    with _stats_lock:
+        _stats.clear()
+        _seen_prefixes.clear()
+    return {"ok": True}
+
+def load_profile(path: str | None) -> Dict[str, Any]:
+    if not path:
+        return DEFAULT_PROFILE
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    profile = {"default": dict(DEFAULT_PROFILE["default"]), "models": {}}
+    profile["default"].update(data.get("default", {}))
+    profile["models"].update(data.get("models", {}))
+    profile["max_concurrent"] = data.get("max_concurrent", 0)
+    return profile
+
+def main():
+    global _profile
+    parser = argparse.ArgumentParser(description="Fake OpenRouter server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--config", default=os.getenv("FAKE_OPENROUTER_CONFIG"))
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+    if args.seed is not None:
+        random.seed(args.seed)
+    _profile = load_profile(args.config)
+
+    import uvicorn
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+if __name__ == "__main__":
+    main()
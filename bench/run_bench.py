@@ -0,0 +1,268 @@
+"""End-to-end load benchmark for the gateway.
+
+With --spawn (default) a fake OpenRouter and the gateway are started as subprocesses on a
+fresh temporary database, so runs are reproducible offline:
+
+    python -m bench.run_bench --endpoints chat,quiz,lab_single,lab_summary --concurrency 8 --requests 80
+
+Against an already running gateway/fake pair:
+
+    python -m bench.run_bench --no-spawn --target http://127.0.0.1:8000 --fake http://127.0.0.1:9100
+
+Record a cassette once, then replay it against other orchestration strategies with the
+original upstream latencies (see bench/compare.py to diff two runs):
+
+    python -m bench.run_bench --record cassettes/day.jsonl.gz --label baseline
+    python -m bench.run_bench --replay cassettes/day.jsonl.gz --label candidate --env PARALLEL_MODELS=...
+
+--workers N runs the gateway under the pre-fork supervisor (python -m backend.serve); see
+bench/scale_workers.py for a 1..N worker scaling run.
+
+Each run appends one JSON record (throughput, p50/p95/p99 latency, errors and upstream call
+counts per endpoint) to --out.
+"""
+import argparse
+import datetime
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Callable
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Spawned gateways get this admin token; --target gateways need ADMIN_TOKEN set to the same value
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN") or "bench-admin"
+
+QUIZ_VALUES = {
+    "age_range": ["18-25", "26-35", "36-45", "46-55", "56-65", "65+"],
+    "gender": ["erkek", "kadın"],
+    "sleep_pattern": ["düzenli", "düzensiz", "uyku_sorunu_var"],
+    "sleep_hours": ["4-6_saat", "6-8_saat"],
+    "nutrition_type": ["vejetaryen", "karışık"],
+    "exercise_frequency": ["hiç", "haftada_1-2", "günlük"],
+    "stress_level": ["düşük", "orta", "yüksek"],
+}
+CHAT_QUESTIONS = [
+    "D vitamini eksikliği belirtileri nelerdir?",
+    "Magnezyum uykuya iyi gelir mi?",
+    "Ferritin düşüklüğü için nasıl beslenmeliyim?",
+    "Omega 3 takviyesi kolesterolü düşürür mü?",
+    "merhaba",
+]
+LAB_TESTS = [
+    ("Vitamin D", "14", "ng/mL", "30-100"), ("B12", "180", "pg/mL", "200-900"), ("Ferritin", "12", "ng/mL", "15-150"),
+    ("TSH", "5.1", "mIU/L", "0.4-4.0"), ("LDL", "162", "mg/dL", "<130"), ("HDL", "38", "mg/dL", ">40"),
+    ("Trigliserid", "210", "mg/dL", "<150"), ("Glukoz", "104", "mg/dL", "70-100"), ("HbA1c", "5.9", "%", "<5.7"),
+    ("Hemoglobin", "11.8", "g/dL", "12-16"), ("ALT", "52", "U/L", "<40"), ("Kreatinin", "0.9", "mg/dL", "0.6-1.1"),
+    ("CRP", "7", "mg/L", "<5"), ("Magnezyum", "1.6", "mg/dL", "1.7-2.2"), ("Folat", "2.5", "ng/mL", "3-17"),
+    ("Serbest T4", "0.9", "ng/dL", "0.8-1.8"),
+]
+
+def _percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * pct / 100
+    lo, hi = int(k), min(int(k) + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+def _lab_test(rng: random.Random) -> Dict[str, Any]:
+    name, value, unit, ref = rng.choice(LAB_TESTS)
+    return {"name": name, "value": value, "unit": unit, "reference_range": ref}
+
+def make_request_factory(endpoint: str, client: httpx.Client, rng: random.Random) -> Callable[[int], httpx.Response]:
+    headers = {"X-User-Plan": "premium"}
+    if endpoint == "chat":
+        def send(i: int):
+            h = dict(headers, **{"X-User-Id": f"bench-chat-{i}"})
+            conv = client.post("/ai/chat/start", headers=h).json()["conversation_id"]
+            return client.post("/ai/chat", headers=h, json={"conversation_id": conv, "text": rng.choice(CHAT_QUESTIONS)})
+        return send
+    if endpoint == "quiz":
+        def send(i: int):
+            answers = {k: rng.choice(v) for k, v in QUIZ_VALUES.items()}
+            return client.post("/ai/quiz", headers=dict(headers, **{"X-User-Id": f"bench-quiz-{i}"}), json={"answers": answers})
+        return send
+    if endpoint == "lab_single":
+        def send(i: int):
+            return client.post("/ai/lab/single", headers=dict(headers, **{"X-User-Id": f"bench-lab-{i}"}),
+                               json={"test": _lab_test(rng)})
+        return send
+    if endpoint == "lab_summary":
+        def send(i: int):
+            tests = rng.sample([_lab_test(rng) for _ in range(40)], rng.randint(4, 16))
+            return client.post("/ai/lab/summary", headers=dict(headers, **{"X-User-Id": f"bench-sum-{i}"}),
+                               json={"tests": tests, "total_test_sessions": 1})
+        return send
+    raise ValueError(f"unknown endpoint {endpoint}")
+
+def _upstream_stats(target: str, fake: str | None, reset: bool = False) -> Dict[str, Any]:
+    """Call counters from the fake upstream, or from the gateway's cassette in record/replay mode"""
+    try:
+        if fake:
+            if reset:
+                httpx.post(f"{fake}/_reset")
+                return {}
+            return httpx.get(f"{fake}/_stats").json()
+        return httpx.get(f"{target}/debug/cassette", params={"reset": reset},
+                         headers={"X-Admin-Token": ADMIN_TOKEN}).json()
+    except httpx.HTTPError:
+        return {}
+
+def run_endpoint(endpoint: str, target: str, fake: str | None, concurrency: int, requests: int, seed: int) -> Dict[str, Any]:
+    rng = random.Random(seed)
+    client = httpx.Client(base_url=target, timeout=120)
+    send = make_request_factory(endpoint, client, rng)
+    _upstream_stats(target, fake, reset=True)
+
+    latencies: List[float] = []
+    statuses: Dict[str, int] = {}
+    lock = threading.Lock()
+
+    def one(i: int):
+        start = time.perf_counter()
+        try:
+            r = send(i)
+            status = str(r.status_code)
+        except Exception as e:
+            status = type(e).__name__
+        with lock:
+            latencies.append((time.perf_counter() - start) * 1000)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(one, range(requests)))
+    elapsed = time.perf_counter() - start
+    client.close()
+
+    upstream = _upstream_stats(target, fake)
+    return {
+        "endpoint": endpoint,
+        "requests": requests,
+        "concurrency": concurrency,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(requests / elapsed, 3) if elapsed else 0.0,
+        "latency_ms": {
+            "mean": round(statistics.mean(latencies), 1) if latencies else 0.0,
+            "p50": round(_percentile(latencies, 50), 1),
+            "p95": round(_percentile(latencies, 95), 1),
+            "p99": round(_percentile(latencies, 99), 1),
+        },
+        "statuses": statuses,
+        "upstream_calls": upstream.get("calls", 0),
+        "upstream_calls_per_request": round(upstream.get("calls", 0) / requests, 2) if requests else 0.0,
+        "upstream": upstream,
+    }
+
+def _wait_ready(url: str, timeout_s: float = 30):
+    deadline = time.time() + timeout_s
+    while time.time() < deadline:
+        try:
+            httpx.get(url, timeout=1)
+            return
+        except httpx.TransportError:
+            time.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up")
+
+def spawn(fake_port: int, app_port: int, fake_config: str | None, extra_env: Dict[str, str], with_fake: bool = True,
+          workers: int = 1):
+    """Start the fake upstream and the gateway; returns (procs, target, fake, workdir)"""
+    workdir = tempfile.mkdtemp(prefix="longopass-bench-")
+    procs = []
+    if with_fake:
+        fake_cmd = [sys.executable, "-m", "bench.fake_openrouter", "--port", str(fake_port), "--seed", "1"]
+        if fake_config:
+            fake_cmd += ["--config", fake_config]
+        procs.append(subprocess.Popen(fake_cmd, cwd=ROOT))
+    env = dict(os.environ)
+    env.update({
+        "OPENROUTER_BASE_URL": f"http://127.0.0.1:{fake_port}/api/v1",
+        "OPENROUTER_API_KEY": "fake-key",
+        "DB_PATH": os.path.join(workdir, "bench.db"),
+        "DAILY_CHAT_LIMIT": "0",
+        "ADMIN_TOKEN": ADMIN_TOKEN,
+        "PYTHONPATH": ROOT,
+    })
+    env.update(extra_env)
+    if workers == 1:
+        app_cmd = [sys.executable, "-m", "uvicorn", "backend.main:app"]
+    else:
+        app_cmd = [sys.executable, "-m", "backend.serve", "--workers", str(workers)]
+    procs.append(subprocess.Popen(app_cmd + ["--host", "127.0.0.1", "--port", str(app_port), "--log-level", "warning"],
+                                  cwd=ROOT, env=env))
+    fake, target = (f"http://127.0.0.1:{fake_port}" if with_fake else None), f"http://127.0.0.1:{app_port}"
+    if fake:
+        _wait_ready(f"{fake}/_stats")
+    _wait_ready(f"{target}/health")
+    return procs, target, fake, workdir
+
+def main():
+    parser = argparse.ArgumentParser(description="Longopass gateway load benchmark")
+    parser.add_argument("--endpoints", default="chat,quiz,lab_single,lab_summary")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=40, help="requests per endpoint")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--no-spawn", action="store_true", help="use an already running gateway and fake upstream")
+    parser.add_argument("--target", default="http://127.0.0.1:8000")
+    parser.add_argument("--fake", default="http://127.0.0.1:9100", help="fake upstream base ('' to skip upstream stats)")
+    parser.add_argument("--fake-config", default=os.path.join(ROOT, "bench", "fake_profile.json"))
+    parser.add_argument("--fake-port", type=int, default=9100)
+    parser.add_argument("--app-port", type=int, default=8765)
+    parser.add_argument("--workers", type=int, default=1, help="gateway worker processes (0 = one per CPU)")
+    parser.add_argument("--env", action="append", default=[], help="extra KEY=VALUE for the spawned gateway")
+    parser.add_argument("--record", default=None, help="record upstream calls to this cassette while benchmarking")
+    parser.add_argument("--replay", default=None, help="replay upstream calls from this cassette instead of the fake")
+    parser.add_argument("--label", default="", help="free-form label stored with the results")
+    parser.add_argument("--out", default=os.path.join(ROOT, "bench", "results", "results.jsonl"))
+    args = parser.parse_args()
+    if args.record and args.workers != 1:
+        parser.error("--record needs --workers 1: workers would write the cassette concurrently")
+
+    procs: list = []
+    target, fake = args.target, args.fake or None
+    try:
+        if not args.no_spawn:
+            extra_env = dict(kv.split("=", 1) for kv in args.env)
+            if args.record:
+                extra_env.update(OPENROUTER_CASSETTE_MODE="record", OPENROUTER_CASSETTE_PATH=os.path.abspath(args.record))
+            if args.replay:
+                extra_env.update(OPENROUTER_CASSETTE_MODE="replay", OPENROUTER_CASSETTE_PATH=os.path.abspath(args.replay))
+            procs, target, fake, _ = spawn(args.fake_port, args.app_port, args.fake_config, extra_env,
+                                           with_fake=not args.replay, workers=args.workers)
+
+        results = []
+        for i, endpoint in enumerate(e.strip() for e in args.endpoints.split(",") if e.strip()):
+            res = run_endpoint(endpoint, target, fake, args.concurrency, args.requests, args.seed + i)
+            results.append(res)
+            lat = res["latency_ms"]
+            print(f"{endpoint:12s} {res['throughput_rps']:7.2f} rps  p50 {lat['p50']:8.1f}  p95 {lat['p95']:8.1f}  "
+                  f"p99 {lat['p99']:8.1f} ms  upstream/req {res['upstream_calls_per_request']:5.2f}  {res['statuses']}")
+
+        os.makedirs(os.path.dirname(args.out), exist_ok=True)
+        record = {
+            "ts": datetime.datetime.utcnow().isoformat(),
+            "label": args.label,
+            "git": subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True).stdout.strip(),
+            "seed": args.seed,
+            "workers": args.workers,
+            "results": results,
+        }
+        with open(args.out, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        print(f"Results appended to {args.out}")
+    finally:
+        for p in procs:
+            p.terminate()
+        for p in procs:
+            p.wait(timeout=10)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""Throughput of the gateway from 1 to N worker processes (python -m backend.serve).
+
+    python -m bench.scale_workers --workers 1,2,4 --endpoints chat,lab_single --concurrency 32 --requests 400
+
+Each worker count gets a fresh fake upstream, gateway and database. The default fake profile
+(bench/fake_profile_fast.json) answers in ~40 ms so the gateway's own CPU work (guards, JSON,
+SQLite writes), not upstream latency, limits throughput; on a machine with fewer cores than
+workers the extra workers can only add overhead. Prints throughput and p95 per endpoint with
+the speedup over the first worker count, and appends one record to --out.
+"""
+import argparse
+import datetime
+import json
+import os
+import subprocess
+import time
+from .run_bench import ROOT, spawn, run_endpoint
+from backend.serve import cpu_count
+
+def main():
+    parser = argparse.ArgumentParser(description="Gateway throughput scaling over worker processes")
+    parser.add_argument("--workers", default="1,2,4", help="comma separated worker counts")
+    parser.add_argument("--endpoints", default="chat,lab_single")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--requests", type=int, default=400, help="requests per endpoint and worker count")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--fake-config", default=os.path.join(ROOT, "bench", "fake_profile_fast.json"))
+    parser.add_argument("--fake-port", type=int, default=9100)
+    parser.add_argument("--app-port", type=int, default=8765)
+    parser.add_argument("--env", action="append", default=[], help="extra KEY=VALUE for the spawned gateway")
+    parser.add_argument("--label", default="scale")
+    parser.add_argument("--out", default=os.path.join(ROOT, "bench", "results", "results.jsonl"))
+    args = parser.parse_args()
+
+    counts = [int(n) for n in args.workers.split(",") if n.strip()]
+    endpoints = [e.strip() for e in args.endpoints.split(",") if e.strip()]
+    # Upstream slots and per-user limits would otherwise cap throughput before the CPU does
+    extra_env = {"SCHED_UPSTREAM_SLOTS": "0", "MODERATION_MODEL": "google/gemini-2.5-flash"}
+    extra_env.update(kv.split("=", 1) for kv in args.env)
+
+    runs = []
+    for workers in counts:
+        procs, target, fake, _ = spawn(args.fake_port, args.app_port, args.fake_config, extra_env, workers=workers)
+        try:
+            time.sleep(2)  # let warmup finish in every worker
+            results = [run_endpoint(e, target, fake, args.concurrency, args.requests, args.seed + i)
+                       for i, e in enumerate(endpoints)]
+        finally:
+            for p in procs:
+                p.terminate()
+            for p in procs:
+                p.wait(timeout=60)
+        runs.append({"workers": workers, "results": results})
+
+    print(f"{'endpoint':12s} {'workers':>7s} {'rps':>8s} {'speedup':>8s} {'p95 ms':>9s}  statuses")
+    for i, endpoint in enumerate(endpoints):
+        base = runs[0]["results"][i]["throughput_rps"]
+        for run in runs:
+            res = run["results"][i]
+            speedup = res["throughput_rps"] / base if base else 0.0
+            print(f"{endpoint:12s} {run['workers']:7d} {res['throughput_rps']:8.2f} {speedup:7.2f}x "
+                  f"{res['latency_ms']['p95']:9.1f}  {res['statuses']}")
+
+    os.makedirs(os.path.dirname(args.out), exist_ok=True)
+    record = {
+        "ts": datetime.datetime.utcnow().isoformat(),
+        "label": args.label,
+        "git": subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True).stdout.strip(),
+        "cpus": cpu_count(),
+        "seed": args.seed,
+        "scaling": runs,
+    }
+    with open(args.out, "a", encoding="utf-8") as f:
+        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    print(f"Results appended to {args.out}")
+
+if __name__ == "__main__":
+    main()
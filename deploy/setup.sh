@@ -50,11 +50,14 @@ echo "▶️  Starting Longopass AI..."
 docker-compose up -d
 
 echo "⏳ Waiting for service to be ready..."
-sleep 10
+for i in $(seq 1 30); do
+    curl -sf http://localhost:8000/readyz > /dev/null && break
+    sleep 2
+done
 
 # Health check
 echo "🏥 Checking service health..."
-if curl -s http://localhost:8000/docs > /dev/null; then
+if curl -sf http://localhost:8000/readyz > /dev/null; then
     echo "✅ Longopass AI is running successfully!"
     echo "📖 API docs: http://localhost:8000/docs"
     echo "🧪 Demo page: http://localhost:8000/static/index.html"
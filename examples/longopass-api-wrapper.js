@@ -21,6 +21,10 @@ class LongopassAPI {
         
         // Chat conversation tracking
         this.currentConversationId = null;
+        
+        // Idempotency-Key per pending POST body: a retry after a timeout reuses the key
+        // and attaches to the run the server is still processing
+        this.pendingKeys = {};
     }
     
     /**
@@ -35,15 +39,22 @@ class LongopassAPI {
      */
     async request(endpoint, options = {}) {
         const url = `${this.baseURL}${endpoint}`;
+        const pendingKey = options.method === 'POST' ? `${endpoint}|${options.body || ''}` : null;
+        if (pendingKey && !this.pendingKeys[pendingKey]) {
+            this.pendingKeys[pendingKey] = 'idem_' + Date.now().toString(36) + Math.random().toString(36).substr(2, 9);
+        }
         const config = {
             timeout: this.timeout,
+            ...options,
             headers: {
                 'Content-Type': 'application/json',
                 'X-User-Plan': this.userPlan,
                 'X-User-ID': this.userId,
+                // Server-side budget: leave a second for the network so degraded results still arrive
+                'X-Request-Deadline-Ms': String(Math.max(this.timeout - 1000, 1000)),
+                ...(pendingKey ? { 'Idempotency-Key': this.pendingKeys[pendingKey] } : {}),
                 ...options.headers
-            },
-            ...options
+            }
         };
         
         try {
@@ -56,6 +67,9 @@ class LongopassAPI {
             });
             
             clearTimeout(timeoutId);
+            if (pendingKey) {
+                delete this.pendingKeys[pendingKey];
+            }
             
             if (!response.ok) {
                 const errorData = await response.json().catch(() => ({}));
@@ -0,0 +1,30 @@
+"""Test environment: a throwaway database, in-process shared state and no real upstream.
+
+Set before any backend module is imported, since config reads the environment (and .env,
+which does not override variables that are already set) at import time.
+"""
+import os
+import tempfile
+
+_tmp = tempfile.mkdtemp(prefix="longopass-tests-")
+os.environ.update({
+    "DB_PATH": os.path.join(_tmp, "test.db"),
+    "SHARED_STATE_BACKEND": "local",
+    "OPENROUTER_API_KEY": "test-key",
+    "OPENROUTER_BASE_URL": "http://127.0.0.1:9/api/v1",
+    "MAINTENANCE_INTERVAL_S": "0",
+    "WARMUP_ENABLED": "false",
+    "PROFILE_SAMPLE_RATE": "0",
+})
+
+import pytest
+from backend.db import init_db, SessionLocal
+
+@pytest.fixture
+def db():
+    init_db()
+    session = SessionLocal()
+    try:
+        yield session
+    finally:
+        session.close()
@@ -0,0 +1,21 @@
+import pytest
+from fastapi.testclient import TestClient
+from backend import auth, main
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(auth, "ADMIN_TOKEN", "secret")
+    with TestClient(main.app) as c:
+        yield c
+
+def test_cassette_stats_need_admin_token(client):
+    assert client.get("/debug/cassette").status_code == 403
+    assert client.get("/debug/cassette", headers={"X-Admin-Token": "wrong"}).status_code == 403
+    assert client.get("/debug/cassette", headers={"X-Admin-Token": "secret"}).status_code == 200
+
+def test_serve_refuses_to_record_with_several_workers(monkeypatch):
+    from backend import serve
+    monkeypatch.setattr(serve, "OPENROUTER_CASSETTE_MODE", "record")
+    monkeypatch.setattr("sys.argv", ["serve", "--workers", "2", "--port", "0"])
+    with pytest.raises(SystemExit, match="record"):
+        serve.main()
@@ -0,0 +1,53 @@
+import json
+import pytest
+from backend import batch
+from backend.batch import BatchError, parse_items, stream_batch
+
+LAB = {"type": "lab", "test": {"name": "Ferritin", "value": "40", "unit": "ng/mL"}}
+
+def ndjson(*rows):
+    return "\n".join(json.dumps(r, ensure_ascii=False) for r in rows).encode("utf-8")
+
+def test_parse_ndjson_and_csv():
+    items = parse_items(ndjson({"id": "a", **LAB}), "application/x-ndjson")
+    assert items[0]["id"] == "a" and items[0]["payload"]["name"] == "Ferritin"
+    body = "﻿id,type,name,value,unit\nx,lab,Ferritin,40,ng/mL\n".encode("utf-8")
+    assert parse_items(body, "text/csv")[0]["payload"]["value"] == "40"
+
+@pytest.mark.parametrize("body", [
+    b"\xff\xfe{}",
+    b"not json",
+    ndjson({"id": "a", "type": "other"}),
+    b"",
+])
+def test_malformed_batch_is_a_batch_error(body):
+    with pytest.raises(BatchError):
+        parse_items(body, "application/x-ndjson")
+
+@pytest.fixture
+def runs(monkeypatch, db):
+    made = []
+
+    def run_single_lab(db, user_id, payload):
+        made.append(user_id)
+        return {"analysis": {"summary": "ok"}}
+    monkeypatch.setattr(batch, "run_single_lab", run_single_lab)
+    return made
+
+def _stream(user_id, items, token=None):
+    return [json.loads(line) for line in stream_batch(user_id, items, token)]
+
+def test_resume_skips_finished_items(runs):
+    items = parse_items(ndjson({"id": "a", **LAB}, {"id": "b", **LAB}), "")
+    first = _stream(7001, items)
+    again = _stream(7001, items, first[0]["batch_id"])
+    assert runs == [7001]
+    assert again[0]["resumed"] == 1
+    assert {l["id"] for l in again[1:-1]} == {"a", "b"} and all(l.get("resumed") for l in again[1:-1])
+
+def test_resume_token_of_another_user_is_not_honoured(runs):
+    items = parse_items(ndjson({"id": "a", **LAB}), "")
+    token = _stream(7002, items)[0]["batch_id"]
+    other = _stream(7003, items, token)
+    assert other[0]["resumed"] == 0
+    assert runs == [7002, 7003]
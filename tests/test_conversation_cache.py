@@ -0,0 +1,112 @@
+import itertools
+import pytest
+from backend import conversation_cache
+from backend.db import Message
+from backend.shared_state import LocalState, SqliteState
+
+_ids = itertools.count(50_000)
+
+@pytest.fixture(params=["local", "sqlite"])
+def state(request, monkeypatch, tmp_path):
+    s = LocalState() if request.param == "local" else SqliteState(str(tmp_path / "state.db"))
+    monkeypatch.setattr(conversation_cache, "get_state", lambda: s)
+    return s
+
+@pytest.fixture
+def loads(monkeypatch):
+    """Conversation ids read from the database"""
+    made = []
+    real = conversation_cache._load
+
+    def load(db, conversation_id):
+        made.append(conversation_id)
+        return real(db, conversation_id)
+    monkeypatch.setattr(conversation_cache, "_load", load)
+    return made
+
+def _other_worker_writes(db, state, conversation_id, content):
+    db.add(Message(conversation_id=conversation_id, role="user", content=content)); db.commit()
+    state.incr("conversation", str(conversation_id), conversation_cache.VERSION_TTL_S)
+
+def _contents(db, cid):
+    return [t["content"] for t in conversation_cache.recent_turns(db, cid)]
+
+def test_own_writes_are_served_from_cache(db, state, loads):
+    cid = next(_ids)
+    conversation_cache.add_message(db, cid, "user", "merhaba")
+    assert _contents(db, cid) == ["merhaba"]
+    conversation_cache.add_message(db, cid, "assistant", "selam")
+    conversation_cache.add_message(db, cid, "user", "D vitamini?")
+    assert _contents(db, cid) == ["merhaba", "selam", "D vitamini?"]
+    assert loads == [cid]
+
+def test_write_by_another_worker_forces_reload(db, state, loads):
+    cid = next(_ids)
+    conversation_cache.add_message(db, cid, "user", "bir")
+    assert _contents(db, cid) == ["bir"]
+    _other_worker_writes(db, state, cid, "iki")
+    assert _contents(db, cid) == ["bir", "iki"]
+    assert loads == [cid, cid]
+
+def test_own_write_after_foreign_write_drops_the_entry(db, state, loads):
+    cid = next(_ids)
+    conversation_cache.add_message(db, cid, "user", "bir")
+    _contents(db, cid)
+    _other_worker_writes(db, state, cid, "iki")
+    conversation_cache.add_message(db, cid, "assistant", "üç")
+    assert _contents(db, cid) == ["bir", "iki", "üç"]
+    assert len(loads) == 2
+
+def test_write_during_load_is_not_cached(db, state, monkeypatch):
+    cid = next(_ids)
+    real = conversation_cache._load
+
+    def load_while_writing(db_, conversation_id):
+        turns = real(db_, conversation_id)
+        conversation_cache.add_message(db, conversation_id, "user", "yarışan")
+        return turns
+    monkeypatch.setattr(conversation_cache, "_load", load_while_writing)
+    assert _contents(db, cid) == []
+    monkeypatch.setattr(conversation_cache, "_load", real)
+    assert _contents(db, cid) == ["yarışan"]
+
+def test_read_between_commit_and_version_bump_is_not_cached(db, state, monkeypatch):
+    cid = next(_ids)
+    conversation_cache.add_message(db, cid, "user", "bir")
+    real = state.incr
+    seen = []
+
+    def incr_after_read(*args):
+        seen.append(_contents(db, cid))
+        return real(*args)
+    monkeypatch.setattr(state, "incr", incr_after_read)
+    conversation_cache.add_message(db, cid, "assistant", "iki")
+    monkeypatch.setattr(state, "incr", real)
+    assert seen == [["bir", "iki"]]
+    assert _contents(db, cid) == ["bir", "iki"]
+
+def test_overlapping_own_writes_keep_database_order(db, state, monkeypatch):
+    cid = next(_ids)
+    _contents(db, cid)
+    real = state.incr
+    nested = []
+
+    def incr_after_nested_write(*args):
+        if not nested:
+            nested.append(True)
+            conversation_cache.add_message(db, cid, "assistant", "iki")
+        return real(*args)
+    monkeypatch.setattr(state, "incr", incr_after_nested_write)
+    conversation_cache.add_message(db, cid, "user", "bir")
+    monkeypatch.setattr(state, "incr", real)
+    assert _contents(db, cid) == ["bir", "iki"]
+
+def test_least_recently_used_conversation_is_evicted(db, state, monkeypatch):
+    monkeypatch.setattr(conversation_cache, "CONVERSATION_CACHE_SIZE", 2)
+    a, b, c = next(_ids), next(_ids), next(_ids)
+    for cid in (a, b):
+        _contents(db, cid)
+    _contents(db, a)
+    _contents(db, c)
+    with conversation_cache._lock:
+        assert set(conversation_cache._cache) >= {a, c} and b not in conversation_cache._cache
@@ -0,0 +1,54 @@
+import datetime
+import os
+import pytest
+from backend import faq_cache
+from backend.config import FAQ_SIMILARITY_THRESHOLD, FAQ_TTL_DAYS
+from backend.faq_cache import FaqIndex, similarity
+
+@pytest.mark.parametrize("a, b", [
+    ("D vitamini eksikliği belirtileri nelerdir?", "d vitamini eksikliginin belirtileri"),
+    ("Magnezyum ne işe yarar?", "magnezyum ne ise yarar"),
+])
+def test_paraphrases_are_similar(a, b):
+    assert similarity(a, b) >= FAQ_SIMILARITY_THRESHOLD
+
+@pytest.mark.parametrize("a, b", [
+    ("D vitamini eksikliği belirtileri nelerdir?", "B12 eksikliği belirtileri nelerdir?"),
+    ("D vitamini eksikliği belirtileri nelerdir?", "K2 vitamini eksikliği belirtileri nelerdir?"),
+    ("Omega 3 ne işe yarar?", "Omega 6 ne işe yarar?"),
+])
+def test_different_salient_codes_never_match(a, b):
+    assert similarity(a, b) == 0.0
+
+def test_labeled_sample_has_no_false_positives():
+    path = os.path.join(os.path.dirname(os.path.dirname(__file__)), "bench", "faq_labeled.jsonl")
+    report = faq_cache.evaluate(path, FAQ_SIMILARITY_THRESHOLD)
+    assert report["false_positives"] == []
+    assert report["sweep"][f"{FAQ_SIMILARITY_THRESHOLD:.2f}"]["hit_rate"] > 0
+
+def test_best_returns_the_closest_entry():
+    index = FaqIndex()
+    now = datetime.datetime.utcnow()
+    index.add("Demir eksikliği neden olur?", "demir", now)
+    index.add("Çinko eksikliği neden olur?", "cinko", now)
+    score, entry = index.best("demir eksikligi nedenleri")
+    assert entry["answer"] == "demir" and score >= FAQ_SIMILARITY_THRESHOLD
+
+def test_expired_entries_are_skipped():
+    index = FaqIndex()
+    index.add("Demir eksikliği neden olur?", "demir", datetime.datetime.utcnow() - datetime.timedelta(days=FAQ_TTL_DAYS + 1))
+    assert index.best("Demir eksikliği neden olur?")[1] is None
+
+def test_short_questions_are_not_indexed():
+    index = FaqIndex()
+    index.add("B12?", "kısa", datetime.datetime.utcnow())
+    assert len(index) == 0
+
+def test_oldest_entry_goes_when_full(monkeypatch):
+    monkeypatch.setattr(faq_cache, "FAQ_MAX_ENTRIES", 2)
+    index = FaqIndex()
+    start = datetime.datetime.utcnow()
+    for i, q in enumerate(["Demir eksikliği neden olur?", "Çinko eksikliği neden olur?", "Selenyum eksikliği neden olur?"]):
+        index.add(q, q, start + datetime.timedelta(seconds=i))
+    assert len(index) == 2
+    assert index.best("Demir eksikliği neden olur?")[0] < FAQ_SIMILARITY_THRESHOLD
@@ -0,0 +1,111 @@
+import threading
+import time
+import uuid
+import pytest
+from fastapi import HTTPException, Response
+from backend import idempotency
+from backend.db import SessionLocal, IdempotencyKey
+
+@pytest.fixture
+def handler(db):
+    """An idempotent handler that counts its runs; gate holds a run until set"""
+    runs = []
+    gate = threading.Event()
+    gate.set()
+
+    @idempotency.idempotent("test")
+    def handle(body=None, x_user_id=None):
+        runs.append(body)
+        gate.wait(5)
+        if body.get("fail"):
+            raise HTTPException(body["fail"], "hata")
+        return {"answer": body["q"], "run": len(runs)}
+    handle.runs, handle.gate = runs, gate
+    return handle
+
+def call(handle, body, key, user="u1"):
+    response = Response()
+    return handle(body=body, x_user_id=user, idempotency_key=key, idempotency_response=response), response
+
+def test_retry_replays_stored_result(handler):
+    key = uuid.uuid4().hex
+    first, _ = call(handler, {"q": 1}, key)
+    again, response = call(handler, {"q": 1}, key)
+    assert again == first and len(handler.runs) == 1
+    assert response.headers["Idempotent-Replayed"] == "true"
+
+def test_without_key_every_call_runs(handler):
+    handler(body={"q": 1}, x_user_id="u1")
+    handler(body={"q": 1}, x_user_id="u1")
+    assert len(handler.runs) == 2
+
+def test_keys_are_scoped_per_user(handler):
+    key = uuid.uuid4().hex
+    call(handler, {"q": 1}, key, user="a")
+    call(handler, {"q": 1}, key, user="b")
+    assert len(handler.runs) == 2
+
+def test_guests_do_not_share_keys(handler):
+    key = uuid.uuid4().hex
+    first, _ = call(handler, {"q": 1}, key, user=None)
+    second, response = call(handler, {"q": 1}, key, user=None)
+    assert len(handler.runs) == 2 and first != second
+    assert "Idempotent-Replayed" not in response.headers
+
+def test_same_key_different_body_is_rejected(handler):
+    key = uuid.uuid4().hex
+    call(handler, {"q": 1}, key)
+    with pytest.raises(HTTPException) as e:
+        call(handler, {"q": 2}, key)
+    assert e.value.status_code == 422
+
+def test_concurrent_retry_waits_for_the_running_call(handler):
+    key = uuid.uuid4().hex
+    handler.gate.clear()
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(call(handler, {"q": 1}, key)[0])) for _ in range(4)]
+    for t in threads:
+        t.start()
+    time.sleep(0.2)
+    handler.gate.set()
+    for t in threads:
+        t.join()
+    assert len(handler.runs) == 1
+    assert results == [results[0]] * 4
+
+def test_client_errors_are_stored_server_errors_released(handler):
+    key4, key5 = uuid.uuid4().hex, uuid.uuid4().hex
+    for _ in range(2):
+        with pytest.raises(HTTPException) as e:
+            call(handler, {"q": 1, "fail": 400}, key4)
+        assert e.value.status_code == 400
+    assert len(handler.runs) == 1
+    for _ in range(2):
+        with pytest.raises(HTTPException):
+            call(handler, {"q": 1, "fail": 503}, key5)
+    assert len(handler.runs) == 3
+
+def _other_worker_claims(scope, request_hash):
+    db = SessionLocal()
+    db.add(IdempotencyKey(scope_key=scope, request_hash=request_hash, status="in_progress"))
+    db.commit()
+    db.close()
+
+def test_waits_for_a_run_in_another_worker(handler, monkeypatch):
+    monkeypatch.setattr(idempotency, "POLL_INTERVAL_S", 0.02)
+    key = uuid.uuid4().hex
+    scope = f"u1|test|{key}"
+    _other_worker_claims(scope, idempotency._request_hash({"body": {"q": 1}}))
+    threading.Timer(0.1, idempotency._finish, (scope, 200, {"answer": "elsewhere"})).start()
+    result, response = call(handler, {"q": 1}, key)
+    assert result == {"answer": "elsewhere"} and handler.runs == []
+    assert response.headers["Idempotent-Replayed"] == "true"
+
+def test_gives_up_with_409_while_still_running(handler, monkeypatch):
+    monkeypatch.setattr(idempotency, "POLL_INTERVAL_S", 0.02)
+    monkeypatch.setattr(idempotency, "IDEMPOTENCY_WAIT_S", 0.1)
+    key = uuid.uuid4().hex
+    _other_worker_claims(f"u1|test|{key}", idempotency._request_hash({"body": {"q": 1}}))
+    with pytest.raises(HTTPException) as e:
+        call(handler, {"q": 1}, key)
+    assert e.value.status_code == 409
@@ -0,0 +1,77 @@
+import pytest
+from backend.lab_engine import canonical_test, convert, evaluate_test, normalize_unit, parse_range, parse_value
+
+@pytest.mark.parametrize("text, expected", [
+    ("3.5-5.0", (3.5, 5.0)),
+    ("3,5 – 5,0 mmol/L", (3.5, 5.0)),
+    ("<200", (None, 200.0)),
+    ("≤ 5.7 %", (None, 5.7)),
+    ("> 40", (40.0, None)),
+    ("≥30 ng/mL", (30.0, None)),
+    ("negatif", None),
+    ("", None),
+    (None, None),
+])
+def test_parse_range(text, expected):
+    assert parse_range(text) == expected
+
+@pytest.mark.parametrize("value, expected", [
+    (12, 12.0),
+    ("12,5", 12.5),
+    ("< 0.5", 0.5),
+    ("-1.2", -1.2),
+    ("yok", None),
+    (None, None),
+])
+def test_parse_value(value, expected):
+    assert parse_value(value) == expected
+
+@pytest.mark.parametrize("name, key", [
+    ("Vit D", "vitamin_d"),
+    ("25-OH Vitamin D", "vitamin_d"),
+    ("Serum Demir", "iron"),
+    ("Açlık Kan Şekeri", "glucose"),
+    ("bilinmeyen test", None),
+])
+def test_canonical_test(name, key):
+    assert canonical_test(name) == key
+
+def test_normalize_unit_aliases():
+    assert normalize_unit("µg/L") == "ug/l"
+    assert normalize_unit("mcg/L") == "ug/l"
+    assert normalize_unit("mIU/mL") == "uiu/ml"
+    assert normalize_unit(None) == ""
+
+def test_convert():
+    assert convert(20, "ng/mL", "vitamin_d") == 20
+    assert convert(75, "nmol/L", "vitamin_d") == pytest.approx(30.045)
+    assert convert(5.2, "mmol/L", "total_cholesterol") == pytest.approx(201.08, abs=0.01)
+
+def test_convert_missing_or_unknown_unit():
+    assert convert(75, "", "vitamin_d") is None
+    assert convert(75, None, "vitamin_d") is None
+    assert convert(75, "mg/dl", "vitamin_d") is None
+
+def test_evaluate_with_reference_range():
+    res = evaluate_test({"name": "Vitamin D", "value": "18", "unit": "ng/mL", "reference_range": "30-100"})
+    assert (res["test_key"], res["status"], res["range_source"]) == ("vitamin_d", "low", "reference")
+
+def test_evaluate_with_default_range_in_other_unit():
+    res = evaluate_test({"name": "LDL", "value": "4.5", "unit": "mmol/L"})
+    assert res["status"] == "high"
+    assert res["range_source"] == "default"
+    assert res["canonical_unit"] == "mg/dl"
+
+def test_evaluate_without_unit_is_unknown():
+    # 75 nmol/l would be normal, 75 ng/ml is not; neither may be assumed
+    res = evaluate_test({"name": "Vitamin D", "value": "75"})
+    assert res["status"] == "unknown"
+    assert res["canonical_value"] is None
+
+def test_evaluate_without_unit_uses_reference_range():
+    res = evaluate_test({"name": "Vitamin D", "value": "75", "reference_range": "75-250"})
+    assert res["status"] == "normal"
+
+def test_evaluate_unknown_test_and_value():
+    assert evaluate_test({"name": "Bilinmeyen", "value": "3"})["status"] == "unknown"
+    assert evaluate_test({"name": "Ferritin", "value": "pozitif", "unit": "ng/mL"})["status"] == "unknown"
@@ -0,0 +1,45 @@
+import json
+import uuid
+import pytest
+from fastapi.testclient import TestClient
+from backend import main
+from backend.db import LabResult
+from backend.lab_history import load_latest, save_results
+
+def test_load_latest_returns_newest_row_per_test(db):
+    save_results(db, 901, [{"name": "Vitamin D", "value": "18", "unit": "ng/mL"},
+                           {"name": "Ferritin", "value": "40", "unit": "ng/mL"}], {})
+    save_results(db, 901, [{"name": "Vit D", "value": "32", "unit": "ng/mL"}], {})
+    save_results(db, 902, [{"name": "Vitamin D", "value": "50", "unit": "ng/mL"}], {})
+    latest = load_latest(db, 901)
+    assert set(latest) == {"vitamin_d", "ferritin"}
+    assert latest["vitamin_d"].value == "32"
+    assert latest["ferritin"].value == "40"
+
+@pytest.fixture
+def client():
+    with TestClient(main.app) as c:
+        yield c
+
+def test_repeated_summary_is_reused_without_new_history(client, db, monkeypatch):
+    calls = []
+
+    def analyze(tests, total):
+        calls.append(tests)
+        details = {t["name"]: {"status": "normal", "interpretation": "ok"} for t in tests}
+        return {"content": json.dumps({"general_assessment": {}, "test_details": details})}
+    monkeypatch.setattr(main, "parallel_multiple_lab_analyze", analyze)
+    user = f"u-{uuid.uuid4().hex}"
+    headers = {"X-User-Id": user, "X-User-Plan": "premium"}
+    first = {"tests": [{"name": "Vitamin D", "value": "20", "unit": "ng/mL"}], "total_test_sessions": 1}
+    second = {"tests": [{"name": "Vitamin D", "value": "30", "unit": "ng/mL"}], "total_test_sessions": 2}
+
+    assert client.post("/ai/lab/summary", json=first, headers=headers).status_code == 200
+    trended = client.post("/ai/lab/summary", json=second, headers=headers).json()
+    rows = db.query(LabResult).count()
+    repeat = client.post("/ai/lab/summary", json=second, headers=headers).json()
+
+    assert len(calls) == 2
+    assert db.query(LabResult).count() == rows
+    assert repeat["test_details"]["Vitamin D"]["trend"] == trended["test_details"]["Vitamin D"]["trend"]
+    assert repeat["test_details"]["Vitamin D"]["trend"]["direction"] == "artış"
@@ -0,0 +1,36 @@
+import json
+import pytest
+from backend import orchestrator
+
+@pytest.fixture
+def reduce_fails(monkeypatch):
+    """No upstream answers, so the summary degrades to the map output and its worst group status"""
+    def call(model, messages, **kwargs):
+        raise RuntimeError("upstream down")
+    monkeypatch.setattr(orchestrator, "call_chat_model", call)
+
+def _summary(cached, tests):
+    res = orchestrator.incremental_multiple_lab_analyze([], cached, tests, 2)
+    return json.loads(res["content"])
+
+def test_cached_critical_result_sets_overall_status(reduce_fails):
+    tests = [{"name": "Vitamin D", "value": "40", "unit": "ng/mL"}, {"name": "Kreatinin", "value": "4.1", "unit": "mg/dL"}]
+    cached = {"Vitamin D": {"interpretation": "Normal.", "status": "normal"},
+              "Kreatinin": {"interpretation": "Çok yüksek.", "status": "kritik"}}
+    data = _summary(cached, tests)
+    assert data["overall_status"] == "kritik"
+    assert any(c.startswith("Kreatinin") for c in data["general_assessment"]["areas_of_concern"])
+
+def test_cached_details_without_status_use_local_assessment(reduce_fails):
+    tests = [{"name": "LDL", "value": "190", "unit": "mg/dL"}, {"name": "HDL", "value": "55", "unit": "mg/dL"}]
+    cached = {"LDL": {"interpretation": "Yüksek."}, "HDL": {"interpretation": "İyi."}}
+    assert _summary(cached, tests)["overall_status"] == "dikkat_edilmeli"
+
+def test_cached_normal_results_stay_normal(reduce_fails):
+    tests = [{"name": "HDL", "value": "55", "unit": "mg/dL"}]
+    group = orchestrator._cached_group({"HDL": {"interpretation": "İyi."}}, tests)
+    assert group["group_status"] == "normal" and group["concerns"] == []
+
+def test_unknown_cached_status_is_left_out():
+    group = orchestrator._cached_group({"Bilinmeyen": {"interpretation": "?"}}, [{"name": "Bilinmeyen", "value": "3"}])
+    assert "group_status" not in group
@@ -0,0 +1,88 @@
+import threading
+import time
+import pytest
+from backend import health_guard
+
+@pytest.fixture
+def batcher(monkeypatch):
+    b = health_guard.ModerationBatcher()
+    monkeypatch.setattr(health_guard, "_batcher", b)
+    monkeypatch.setattr(health_guard, "MODERATION_BATCH_ENABLED", True)
+    return b
+
+def _fake_model(latency_s: float, batch_reply=None):
+    """call_chat_model stand-in: numbered batch prompts get one label per line (or batch_reply)"""
+    def call(model, messages, **kwargs):
+        time.sleep(latency_s)
+        user = messages[-1]["content"]
+        if user.startswith("Kullanıcı soruları:"):
+            lines = user.splitlines()[1:]
+            if batch_reply is not None:
+                return {"content": batch_reply(lines)}
+            return {"content": "\n".join(f"{i}. HEALTH" for i in range(1, len(lines) + 1))}
+        return {"content": "HEALTH"}
+    return call
+
+def test_classify_batch_maps_numbered_lines(monkeypatch):
+    reply = "1. HEALTH\n2) NON_HEALTH\n 3 - MEDICAL_PROHIBITED\nignored\n7. HEALTH"
+    monkeypatch.setattr(health_guard, "call_chat_model", lambda *a, **k: {"content": reply})
+    assert health_guard._classify_batch(["a", "b", "c", "d"]) == ["HEALTH", "NON_HEALTH", "MEDICAL_PROHIBITED", None]
+
+def test_classify_batch_keeps_first_line_per_number(monkeypatch):
+    monkeypatch.setattr(health_guard, "call_chat_model", lambda *a, **k: {"content": "1. NON_HEALTH\n1. HEALTH"})
+    assert health_guard._classify_batch(["a"]) == ["NON_HEALTH"]
+
+def test_concurrent_callers_do_not_time_out_under_load(batcher, monkeypatch):
+    # 100 callers at ~100 req/s against a 0.3 s upstream: every caller gets a label
+    monkeypatch.setattr(health_guard, "call_chat_model", _fake_model(0.3))
+    monkeypatch.setattr(health_guard, "MODERATION_TIMEOUT_MS", 1000)
+    results, errors = [], []
+
+    def one(i):
+        try:
+            results.append(health_guard.classify_topic_llm(f"yük testi sorusu {i} {time.time()}"))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=one, args=(i,)) for i in range(100)]
+    for t in threads:
+        t.start()
+        time.sleep(0.01)
+    for t in threads:
+        t.join()
+    assert errors == []
+    assert results == ["HEALTH"] * 100
+    assert batcher.stats["batches"] < 100
+
+def test_unlabelled_items_fall_back_in_parallel(batcher, monkeypatch):
+    # The batch reply labels nothing; the four single calls must not run one after another
+    monkeypatch.setattr(health_guard, "call_chat_model", _fake_model(0.2, batch_reply=lambda lines: "?"))
+    monkeypatch.setattr(health_guard, "MODERATION_TIMEOUT_MS", 300)
+    items = [batcher.submit(f"paralel yedek {i} {time.time()}") for i in range(4)]
+    start = time.time()
+    labels = [item.future.result(timeout=2) for item in items]
+    assert labels == ["HEALTH"] * 4
+    assert time.time() - start < 0.2 * 2 + 0.3
+    assert batcher.stats["fallbacks"] == 4
+
+def test_failed_single_call_reaches_every_waiter(batcher, monkeypatch):
+    def boom(*a, **k):
+        raise RuntimeError("upstream down")
+    monkeypatch.setattr(health_guard, "call_chat_model", boom)
+    items = [batcher.submit("aynı metin") for _ in range(3)]
+    for item in items:
+        with pytest.raises(RuntimeError):
+            item.future.result(timeout=2)
+
+@pytest.mark.parametrize("raw, label", [
+    ("HEALTH", "HEALTH"),
+    ("NON_HEALTH", "NON_HEALTH"),
+    (" non_health.", "NON_HEALTH"),
+    ("SAĞLIK DEĞİL", "NON_HEALTH"),
+    ("MEDICAL_PROHIBITED", "MEDICAL_PROHIBITED"),
+    ("AMBIGUOUS", "AMBIGUOUS"),
+    ("", "AMBIGUOUS"),
+    ("???", "AMBIGUOUS"),
+])
+def test_normalize_label(raw, label):
+    assert health_guard._normalize_label(raw) == label
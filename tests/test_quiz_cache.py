@@ -0,0 +1,86 @@
+import datetime
+import threading
+import uuid
+import pytest
+from backend import quiz_cache
+from backend.db import SessionLocal, QuizProfile
+
+def answers(**overrides):
+    base = {"age_range": "26-35", "gender": "kadın", "sleep_pattern": "düzenli", "sleep_hours": "6-8_saat",
+            "nutrition_type": "karışık", "exercise_frequency": "haftada_1-2", "stress_level": "orta",
+            "allergies": [], "health_goals": [uuid.uuid4().hex], "existing_supplements": []}
+    return {**base, **overrides}
+
+@pytest.fixture(autouse=True)
+def empty_profiles(db):
+    db.query(QuizProfile).delete()
+    db.commit()
+
+def test_profile_key_ignores_list_order_and_case():
+    a = answers(health_goals=["Enerji", "uyku"])
+    assert quiz_cache.profile_key(a) == quiz_cache.profile_key({**a, "health_goals": ["UYKU", "enerji"]})
+    assert quiz_cache.profile_key(answers(gender="diğer")) is None
+
+def test_concurrent_record_profile_counts_every_hit(db):
+    a = answers()
+    key = quiz_cache.profile_key(a)
+    errors = []
+
+    def hit():
+        session = SessionLocal()
+        try:
+            for _ in range(5):
+                quiz_cache.record_profile(session, key, a)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            session.close()
+    threads = [threading.Thread(target=hit) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert errors == []
+    assert db.query(QuizProfile.hits).filter(QuizProfile.profile_key == key).scalar() == 40
+
+def test_store_keeps_hits_and_lookup_sees_content(db):
+    a = answers()
+    key = quiz_cache.profile_key(a)
+    quiz_cache.record_profile(db, key, a)
+    quiz_cache.store(db, key, a, '{"supplement_recommendations": []}')
+    quiz_cache.store(db, key, a, '{"supplement_recommendations": [1]}')
+    assert quiz_cache.lookup(db, key) == '{"supplement_recommendations": [1]}'
+    assert db.query(QuizProfile.hits).filter(QuizProfile.profile_key == key).scalar() == 1
+
+def test_top_profiles_skips_fresh_and_orders_by_hits(db):
+    fresh, stale, rare, popular = answers(), answers(), answers(), answers()
+    for a, hits in ((fresh, 9), (stale, 5), (rare, 1), (popular, 7)):
+        for _ in range(hits):
+            quiz_cache.record_profile(db, quiz_cache.profile_key(a), a)
+    quiz_cache.store(db, quiz_cache.profile_key(fresh), fresh, "{}")
+    quiz_cache.store(db, quiz_cache.profile_key(stale), stale, "{}")
+    old = datetime.datetime.utcnow() - datetime.timedelta(days=quiz_cache.QUIZ_CACHE_TTL_DAYS + 1)
+    db.query(QuizProfile).filter(QuizProfile.profile_key == quiz_cache.profile_key(stale)).update({"generated_at": old})
+    db.commit()
+    goals = [p["health_goals"] for p in quiz_cache.top_profiles(db, 2)]
+    assert goals == [popular["health_goals"], stale["health_goals"]]
+
+def test_enumerate_profiles_follows_submitted_values(db):
+    for _ in range(3):
+        a = answers(age_range="46-55", gender="erkek", stress_level="yüksek")
+        quiz_cache.record_profile(db, quiz_cache.profile_key(a), a)
+    a = answers(age_range="18-25")
+    quiz_cache.record_profile(db, quiz_cache.profile_key(a), a)
+
+    profiles = quiz_cache.enumerate_profiles(db, 20)
+    assert len(profiles) == 20
+    assert len({quiz_cache.profile_key(p) for p in profiles}) == 20
+    first = profiles[0]
+    assert (first["age_range"], first["gender"], first["stress_level"]) == ("46-55", "erkek", "yüksek")
+    assert first["sleep_hours"] == "6-8_saat"
+    ages = [p["age_range"] for p in profiles]
+    assert "18-25" in ages and ("65+" not in ages or ages.index("18-25") < ages.index("65+"))
+
+def test_enumerate_profiles_without_submissions(db):
+    profiles = quiz_cache.enumerate_profiles(db, 5)
+    assert len({quiz_cache.profile_key(p) for p in profiles}) == 5
@@ -0,0 +1,88 @@
+import pytest
+from backend import orchestrator
+from backend.routing import route_chat, route_quiz, strip_online
+
+class Calls(list):
+    """Models of every upstream call; replies come from reply(model)"""
+    def reply(self, model):
+        return {"content": "Rica ederim!"}
+
+@pytest.fixture
+def calls(monkeypatch):
+    made = Calls()
+
+    def call(model, messages, **kwargs):
+        made.append(model)
+        return {**made.reply(model), "usage": {}}
+    monkeypatch.setattr(orchestrator, "call_chat_model", call)
+    return made
+
+def test_small_talk_goes_to_fast_profile():
+    route = route_chat("Teşekkürler, çok sağol", "premium")
+    assert route["name"] == "fast"
+    assert route["validate"] is False
+    assert not any(m.endswith(":online") for m in route["models"])
+
+@pytest.mark.parametrize("text", ["Merhaba", "Tamam, anladım", "İyi akşamlar hocam", "Sağolun, teşekkür ederim"])
+def test_pure_small_talk_is_fast(text):
+    assert route_chat(text, "free")["name"] == "fast"
+
+@pytest.mark.parametrize("text", ["Selam, başım ağrıyor", "tamam ama ateşim var", "Selam, göğsümde ağrı var",
+                                  "Merhaba, D vitamini alıyorum", "tamamen halsizim", "peki 500 mg"])
+def test_small_talk_with_health_content_is_validated(text):
+    route = route_chat(text, "premium")
+    assert route["name"] != "fast"
+    assert route["validate"] is True
+
+def test_health_questions_are_validated():
+    route = route_chat("D vitamini eksikliği belirtileri nelerdir?", "free")
+    assert route["name"] == "dual"
+    assert route["validate"] is True
+
+def test_premium_complex_question_gets_full_ensemble():
+    route = route_chat("Hamileyken demir ve magnezyum birlikte kullanılır mı?", "premium")
+    assert route["name"] == "full"
+
+def test_search_intent_keeps_online():
+    route = route_chat("Magnezyum hakkında son araştırmalar ne diyor?", "free")
+    assert route["label"].endswith(":online")
+
+def test_quiz_route_is_never_online():
+    route = route_quiz({"existing_supplements": ["omega 3"]}, "free")
+    assert route["name"] == "full"
+    assert route["models"] == [strip_online(m) for m in route["models"]]
+
+def test_fast_reply_is_accepted_without_health_validation(calls):
+    route = route_chat("Teşekkürler, çok sağol", "premium")
+    res = orchestrator.parallel_chat([{"role": "user", "content": "Teşekkürler, çok sağol"}], route)
+    assert res["content"] == "Rica ederim!"
+    assert calls == route["models"]
+
+def test_fallback_uses_routed_models_only(calls):
+    route = route_chat("Teşekkürler, çok sağol", "premium")
+    calls.reply = lambda model: {"content": ""}
+    res = orchestrator.parallel_chat([{"role": "user", "content": "Teşekkürler, çok sağol"}], route)
+    assert res["content"] == ""
+    # one fan-out call and one fallback call, both to the fast model without :online
+    assert calls == route["models"] * 2
+
+def _quiz_route(**overrides):
+    route = route_quiz({}, "free")
+    return {**route, "models": ["m/a", "m/b"], "synthesis_model": "m/synth", **overrides}
+
+def test_quiz_without_synthesis_returns_first_response(calls):
+    calls.reply = lambda model: {"content": '{"supplement_recommendations": []}'}
+    res = orchestrator.parallel_quiz_analyze({"age_range": "26-35"}, _quiz_route(synthesis=False))
+    assert res["model_used"] in ("m/a", "m/b")
+    assert "m/synth" not in calls
+
+def test_quiz_single_response_skips_synthesis(calls):
+    calls.reply = lambda model: {"content": '{"supplement_recommendations": []}' if model == "m/a" else ""}
+    res = orchestrator.parallel_quiz_analyze({"age_range": "26-35"}, _quiz_route())
+    assert res["model_used"] == "m/a"
+    assert "m/synth" not in calls
+
+def test_quiz_synthesizes_several_responses(calls):
+    calls.reply = lambda model: {"content": '{"supplement_recommendations": []}'}
+    orchestrator.parallel_quiz_analyze({"age_range": "26-35"}, _quiz_route())
+    assert calls[-1] == "m/synth"
@@ -0,0 +1,88 @@
+import threading
+import time
+import pytest
+from backend.scheduler import Scheduler, QueueFull, QueueTimeout, classify
+
+def _wait_for(cond, timeout=5.0):
+    end = time.monotonic() + timeout
+    while not cond():
+        assert time.monotonic() < end, "condition not reached"
+        time.sleep(0.005)
+
+def _queue(sched, classes, order):
+    """One thread per class name in classes; each records its turn while holding the slot"""
+    def run(cls):
+        sched.acquire(cls, timeout=10)
+        order.append(cls)
+        sched.release(cls)
+    threads = [threading.Thread(target=run, args=(cls,)) for cls in classes]
+    for t in threads:
+        t.start()
+    return threads
+
+def test_slots_are_shared_by_weight():
+    sched = Scheduler(1, {"premium": {"weight": 3}, "free": {"weight": 1}})
+    sched.acquire("premium", timeout=1)
+    order = []
+    threads = _queue(sched, ["premium"] * 12 + ["free"] * 12, order)
+    _wait_for(lambda: sched.queued["premium"] == 12 and sched.queued["free"] == 12)
+    sched.release("premium")
+    for t in threads:
+        t.join()
+    assert order[:8].count("premium") == 6
+    assert order[:16].count("free") == 4
+
+def test_burst_in_one_class_does_not_starve_another():
+    sched = Scheduler(1, {"batch": {"weight": 1}, "premium": {"weight": 1}})
+    sched.acquire("batch", timeout=1)
+    order = []
+    threads = _queue(sched, ["batch"] * 20, order)
+    _wait_for(lambda: sched.queued["batch"] == 20)
+    threads += _queue(sched, ["premium"], order)
+    _wait_for(lambda: sched.queued["premium"] == 1)
+    sched.release("batch")
+    for t in threads:
+        t.join()
+    assert order.index("premium") <= 1
+
+def test_queue_limit_rejects():
+    sched = Scheduler(1, {"free": {"weight": 1, "queue_limit": 1}})
+    sched.acquire("free", timeout=1)
+    threads = _queue(sched, ["free"], [])
+    _wait_for(lambda: sched.queued["free"] == 1)
+    assert sched.is_full("free")
+    with pytest.raises(QueueFull):
+        sched.acquire("free", timeout=1)
+    sched.release("free")
+    for t in threads:
+        t.join()
+    assert sched.stats()["classes"]["free"]["rejected"] == 1
+
+def test_timed_out_waiter_is_skipped():
+    sched = Scheduler(1, {"free": {"weight": 1}})
+    sched.acquire("free", timeout=1)
+    with pytest.raises(QueueTimeout):
+        sched.acquire("free", timeout=0.05)
+    sched.release("free")
+    assert sched.free == 1
+    sched.acquire("free", timeout=0)
+    assert sched.stats()["classes"]["free"]["timeouts"] == 1
+
+def test_cancelled_waiter_leaves_queue_early():
+    sched = Scheduler(1, {"free": {"weight": 1}})
+    sched.acquire("free", timeout=1)
+    cancelled = threading.Event()
+    cancelled.set()
+    start = time.monotonic()
+    with pytest.raises(QueueTimeout):
+        sched.acquire("free", timeout=10, cancelled=cancelled)
+    assert time.monotonic() - start < 1
+
+@pytest.mark.parametrize("plan, endpoint, origin, cls", [
+    ("premium", "chat", "api", "premium_chat"),
+    ("premium", "quiz", "api", "premium"),
+    ("free", "chat", "api", "free"),
+    ("premium", "lab", "batch", "batch"),
+])
+def test_classify(plan, endpoint, origin, cls):
+    assert classify(plan, endpoint, origin) == cls
@@ -0,0 +1,71 @@
+import pytest
+from backend import orchestrator, token_budget
+from backend.config import TOKEN_BUDGET_MIN_SAMPLES
+
+@pytest.fixture(autouse=True)
+def fresh_budget(monkeypatch):
+    monkeypatch.setattr(token_budget, "_samples", {})
+    monkeypatch.setattr(token_budget, "_widen", {})
+    monkeypatch.setattr(token_budget, "_stats", {})
+    monkeypatch.setattr(token_budget, "TOKEN_BUDGET_EXPLORE_RATE", 0.0)
+
+def learn(stage, tokens, hinted=False, n=TOKEN_BUDGET_MIN_SAMPLES):
+    for _ in range(n):
+        token_budget.observe(stage, "m", {"usage": {"completion_tokens": tokens}}, adaptive=False, hinted=hinted)
+
+def test_no_budget_before_enough_samples():
+    learn("chat", 100, n=TOKEN_BUDGET_MIN_SAMPLES - 1)
+    assert token_budget.max_tokens_for("chat", "m", 900) is None
+    assert token_budget.length_hint("chat", "m") is None
+
+def test_text_stage_learns_below_default():
+    learn("chat", 100)
+    assert token_budget.max_tokens_for("chat", "m", 900) < 900
+
+def test_json_stage_never_below_default():
+    learn("lab_group", 50)
+    assert token_budget.max_tokens_for("lab_group", "m", 700) == 700
+    assert token_budget.length_hint("lab_group", "m") is None
+
+def test_hinted_replies_are_not_sampled():
+    learn("chat", 300)
+    hint = token_budget.length_hint("chat", "m")
+    learn("chat", 40, hinted=True, n=50)
+    assert token_budget.length_hint("chat", "m") == hint
+
+def test_truncation_widens_budget_and_hint():
+    learn("chat", 200)
+    budget, hint = token_budget.max_tokens_for("chat", "m", 2000), token_budget.length_hint("chat", "m")
+    token_budget.observe("chat", "m", {"usage": {"completion_tokens": budget}, "finish_reason": "length"},
+                         adaptive=True)
+    assert token_budget.max_tokens_for("chat", "m", 2000) > budget
+    assert token_budget.length_hint("chat", "m") != hint
+
+def test_explore_rate_leaves_calls_unhinted(monkeypatch):
+    learn("chat", 200)
+    monkeypatch.setattr(token_budget, "TOKEN_BUDGET_EXPLORE_RATE", 1.0)
+    assert token_budget.length_hint("chat", "m") is None
+
+def test_truncated_call_is_retried_once_with_wider_budget(monkeypatch):
+    learn("lab_group", 400)
+    budgets = []
+
+    def call(model, messages, temperature=0.2, max_tokens=0):
+        budgets.append(max_tokens)
+        reason = "length" if len(budgets) == 1 else "stop"
+        return {"content": "{}", "finish_reason": reason, "usage": {"completion_tokens": max_tokens}}
+    monkeypatch.setattr(orchestrator, "call_chat_model", call)
+    res = orchestrator._call("lab_group", "m", [{"role": "user", "content": "x"}], 0.2, 400)
+    assert res["finish_reason"] == "stop"
+    assert len(budgets) == 2 and budgets[1] > budgets[0]
+    assert token_budget.report()["lab_group"]["truncation_retries"] == 1
+
+def test_static_call_is_not_retried(monkeypatch):
+    budgets = []
+
+    def call(model, messages, temperature=0.2, max_tokens=0):
+        budgets.append(max_tokens)
+        return {"content": "{}", "finish_reason": "length", "usage": {"completion_tokens": max_tokens}}
+    monkeypatch.setattr(orchestrator, "call_chat_model", call)
+    orchestrator._call("lab_group", "m", [{"role": "user", "content": "x"}], 0.2, 400)
+    assert budgets == [400]
@@ -0,0 +1,76 @@
+import json
+import httpx
+import pytest
+from backend import openrouter_client
+from backend.config import PARALLEL_TIMEOUT_MS, UPSTREAM_UNHEALTHY_AFTER
+from backend.upstreams import Upstream, UpstreamPool
+
+def pool_with(handler):
+    upstream = Upstream("test", "http://upstream.test/api/v1", "key")
+    upstream.client = httpx.Client(transport=httpx.MockTransport(handler))
+    return UpstreamPool([upstream])
+
+def timing_out(request):
+    raise httpx.ReadTimeout("timed out", request=request)
+
+@pytest.fixture
+def use_pool(monkeypatch):
+    def use(pool):
+        monkeypatch.setattr(openrouter_client, "get_pool", lambda: pool)
+        return pool
+    return use
+
+def _fail(times, timeout):
+    for _ in range(times):
+        with pytest.raises(httpx.TimeoutException):
+            openrouter_client._post("m", {}, timeout)
+
+def test_shortened_timeouts_do_not_mark_upstream_unhealthy(use_pool):
+    pool = use_pool(pool_with(timing_out))
+    _fail(UPSTREAM_UNHEALTHY_AFTER + 2, 0.5)
+    assert pool.healthy()
+    assert pool.stats()[0]["client_timeouts"] == UPSTREAM_UNHEALTHY_AFTER + 2
+    assert pool.stats()[0]["outstanding"] == 0
+
+def test_full_timeouts_mark_upstream_unhealthy(use_pool):
+    pool = use_pool(pool_with(timing_out))
+    _fail(UPSTREAM_UNHEALTHY_AFTER, PARALLEL_TIMEOUT_MS / 1000)
+    assert not pool.healthy()
+
+def test_server_errors_until_success(use_pool):
+    replies = iter([500] * UPSTREAM_UNHEALTHY_AFTER + [200])
+    pool = use_pool(pool_with(lambda request: httpx.Response(next(replies), json={"choices": []})))
+    for _ in range(UPSTREAM_UNHEALTHY_AFTER):
+        with pytest.raises(httpx.HTTPStatusError):
+            openrouter_client._post("m", {}, 1.0)
+    assert not pool.healthy()
+    openrouter_client._post("m", {}, 1.0)
+    assert pool.healthy()
+
+def test_usage_accounting_only_sent_to_openrouter(use_pool, monkeypatch):
+    bodies = {}
+
+    def handler(request):
+        bodies[request.url.host] = json.loads(request.content)
+        return httpx.Response(200, json={"choices": [{"message": {"content": "ok"}}]})
+    upstreams = [Upstream("or", "https://openrouter.ai/api/v1", "key", openrouter=True),
+                 Upstream("local", "http://local.test/v1", None, openrouter=False)]
+    for u in upstreams:
+        u.client = httpx.Client(transport=httpx.MockTransport(handler))
+    pool = use_pool(UpstreamPool(upstreams))
+    payload = openrouter_client._build_chat_payload("m", [{"role": "user", "content": "x"}])
+    for u in upstreams:
+        monkeypatch.setattr(pool, "acquire", lambda model, exclude=(), u=u: u)
+        openrouter_client._post("m", payload, 1.0)
+    assert bodies["openrouter.ai"]["usage"] == {"include": True}
+    assert "usage" not in bodies["local.test"]
+
+def test_openrouter_flag_defaults_from_base_url(monkeypatch):
+    from backend import upstreams
+    monkeypatch.setattr(upstreams, "OPENROUTER_UPSTREAMS", [
+        {"name": "or", "base_url": "https://openrouter.ai/api/v1", "api_key": "k"},
+        {"name": "local", "base_url": "http://10.0.0.5:8080/v1"},
+        {"name": "proxy", "base_url": "http://proxy.test/v1", "openrouter": True},
+    ])
+    pool = upstreams._from_config()
+    assert [u.openrouter for u in pool.upstreams] == [True, False, True]